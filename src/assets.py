@@ -0,0 +1,373 @@
+"""
+Static asset pipeline.
+
+Every file under src/static is copied into ASSET_BUILD_DIR with a hash
+of its content in the name (styles.css -> styles.3f2a9c1d0b7e.css),
+along with precompressed .gz (and .br when the brotli package is
+installed) siblings for text assets. manifest.json maps each original
+path to its hashed one.
+
+Templates link assets with asset_url('CSS/styles.css'). Hashed files are
+served from /assets with a year long immutable Cache-Control, since a
+changed file always gets a new URL, so browsers never revalidate them.
+Without a manifest asset_url falls back to the plain /static URL.
+
+Scripts every page needs are concatenated and minified into bundles
+(see BUNDLES), linked with bundle_scripts('site'). A page then loads one
+cached file instead of a script per feature. Before a build the bundle
+falls back to one tag per source file.
+
+The build runs at startup, or by hand:
+
+    python -m src.assets             build
+    python -m src.assets --report    build and print bundle sizes and the
+                                     requests / bytes of a walk through
+                                     every page, with and without bundles
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+import stat
+from pathlib import Path
+from typing import Optional
+
+import anyio
+from markupsafe import Markup
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+try:
+    import brotli
+except ImportError:  # optional, only .gz variants are built without it
+    brotli = None
+
+ASSET_SOURCE_DIR = os.getenv("ASSET_SOURCE_DIR", "src/static")
+ASSET_BUILD_DIR = os.getenv("ASSET_BUILD_DIR", "build/static")
+ASSET_URL_PREFIX = "/assets/"
+FALLBACK_URL_PREFIX = "/static/"
+
+# Only text formats are worth compressing
+COMPRESSIBLE = {".css", ".js", ".html", ".svg", ".json", ".txt", ".map"}
+# Directories that hold user content rather than site assets
+SKIP_DIRS = {"uploads"}
+
+# Bundle path -> the sources it is built from, in load order
+BUNDLES = {
+    "JavaScript/site.js": [
+        "JavaScript/Home/Dark_Light_toggle.js",
+        "JavaScript/forms.js",
+    ],
+}
+
+_manifest: dict[str, str] = {}
+
+
+def hashed_name(relative_path: str, content: bytes) -> str:
+    path = Path(relative_path)
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    return str(path.with_name(f"{path.stem}.{digest}{path.suffix}").as_posix())
+
+
+def _write_atomic(target: Path, data: bytes):
+    # Workers may build at the same time, never expose a half written file
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(f".{target.name}.{os.getpid()}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, target)
+
+
+def _strip_comments(source: str) -> str:
+    # One pass, so comment markers inside string and template literals
+    # are left alone
+    kept = []
+    quote = None
+    start = i = 0
+    while i < len(source):
+        char = source[i]
+        if quote:
+            if char == "\\":
+                i += 1
+            elif char == quote or (char == "\n" and quote != "`"):
+                quote = None
+        elif char in "\"'`":
+            quote = char
+        elif source.startswith("//", i) or source.startswith("/*", i):
+            kept.append(source[start:i])
+            if source[i + 1] == "/":
+                end = source.find("\n", i)
+                i = len(source) if end == -1 else end
+            else:
+                end = source.find("*/", i + 2)
+                end = len(source) if end == -1 else end + 2
+                # Keep a line break the comment spanned, for semicolon-less code
+                if "\n" in source[i:end]:
+                    kept.append("\n")
+                i = end
+            start = i
+            continue
+        i += 1
+    kept.append(source[start:])
+    return "".join(kept)
+
+
+def minify_js(source: str) -> str:
+    """
+    Drop comments, indentation and blank lines.
+
+    Deliberately simple, line breaks are kept so semicolon-less code
+    still works. Regex literals containing // or /* are not supported.
+    """
+    lines = (line.strip() for line in _strip_comments(source).splitlines())
+    return "\n".join(line for line in lines if line) + "\n"
+
+
+def build_bundle(source: Path, sources: list[str]) -> bytes:
+    # Each file gets its own scope so top level names cannot clash
+    parts = [
+        f";(function () {{\n{minify_js((source / name).read_text(encoding='utf-8'))}}})();\n"
+        for name in sources
+    ]
+    return "".join(parts).encode("utf-8")
+
+
+def _write_asset(dest: Path, name: str, content: bytes):
+    # Hashed names never change content, but each file is checked on its
+    # own so a deleted sibling, or brotli installed later, gets built
+    target = dest / name
+    outputs = [(target, lambda: content)]
+    if target.suffix in COMPRESSIBLE:
+        outputs.append((target.with_name(target.name + ".gz"), lambda: gzip.compress(content, 9, mtime=0)))
+        if brotli is not None:
+            outputs.append((target.with_name(target.name + ".br"), lambda: brotli.compress(content)))
+    for output, compress in outputs:
+        if not output.exists():
+            _write_atomic(output, compress())
+
+
+def build(source_dir: str = ASSET_SOURCE_DIR, build_dir: str = ASSET_BUILD_DIR) -> dict[str, str]:
+    """
+    Fingerprint and compress every asset, returns the new manifest.
+
+    Files already built are left alone, old hashed files are kept so
+    pages cached before a deploy can still load their assets.
+    """
+    source = Path(source_dir)
+    dest = Path(build_dir)
+    manifest = {}
+
+    for path in sorted(source.rglob("*")):
+        relative = path.relative_to(source)
+        if not path.is_file() or relative.parts[0] in SKIP_DIRS or path.name.startswith("."):
+            continue
+
+        content = path.read_bytes()
+        name = hashed_name(relative.as_posix(), content)
+        manifest[relative.as_posix()] = name
+        _write_asset(dest, name, content)
+
+    for bundle, sources in BUNDLES.items():
+        content = build_bundle(source, sources)
+        name = hashed_name(bundle, content)
+        manifest[bundle] = name
+        _write_asset(dest, name, content)
+
+    _write_atomic(dest / "manifest.json", json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"))
+    return manifest
+
+
+def load_manifest(build_dir: str = ASSET_BUILD_DIR) -> dict[str, str]:
+    global _manifest
+    try:
+        _manifest = json.loads((Path(build_dir) / "manifest.json").read_text())
+    except FileNotFoundError:
+        _manifest = {}
+    return _manifest
+
+
+def asset_url(path: str) -> str:
+    """
+    URL for a file under src/static, fingerprinted when built.
+    """
+    path = path.lstrip("/")
+    hashed = _manifest.get(path)
+    if hashed is None:
+        return FALLBACK_URL_PREFIX + path
+    return ASSET_URL_PREFIX + hashed
+
+
+def bundle_scripts(name: str) -> Markup:
+    """
+    Script tag(s) for the bundle JavaScript/<name>.js.
+    """
+    bundle = f"JavaScript/{name}.js"
+    paths = [bundle] if bundle in _manifest else BUNDLES[bundle]
+    return Markup("\n".join(f'<script src="{asset_url(path)}"></script>' for path in paths))
+
+
+def encoding_quality(accept_encoding: str, encoding: str) -> float:
+    """
+    The q-value an Accept-Encoding header gives encoding, 0 when refused.
+
+    * stands for every coding not listed, and no header means no
+    compression.
+    """
+    wildcard = 0.0
+    for part in accept_encoding.split(","):
+        coding, *params = (item.strip() for item in part.split(";"))
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        coding = coding.lower()
+        if coding == encoding:
+            return quality
+        if coding == "*":
+            wildcard = quality
+    return wildcard
+
+
+def accepts_encoding(accept_encoding: str, encoding: str) -> bool:
+    """
+    Whether an Accept-Encoding header allows encoding, q=0 is a refusal.
+    """
+    return encoding_quality(accept_encoding, encoding) > 0
+
+
+def install(templates):
+    """
+    Make asset_url and bundle_scripts available to a Jinja2Templates instance.
+    """
+    templates.env.globals["asset_url"] = asset_url
+    templates.env.globals["bundle_scripts"] = bundle_scripts
+
+
+class ImmutableStaticFiles(StaticFiles):
+    """
+    StaticFiles for fingerprinted assets.
+
+    Adds an immutable Cache-Control and serves a precompressed sibling
+    when the client accepts it.
+    """
+
+    ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+    CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+    def _preferred(self, accept_encoding: str) -> list[tuple[str, str]]:
+        # Highest q first, our own order breaks ties
+        ranked = [
+            (encoding_quality(accept_encoding, encoding), -position, encoding, suffix)
+            for position, (encoding, suffix) in enumerate(self.ENCODINGS)
+        ]
+        return [(encoding, suffix) for quality, _, encoding, suffix in sorted(ranked, reverse=True) if quality > 0]
+
+    async def get_response(self, path: str, scope):
+        response = None
+        if scope["method"] in ("GET", "HEAD"):
+            request_headers = Headers(scope=scope)
+            for encoding, suffix in self._preferred(request_headers.get("accept-encoding", "")):
+                full_path, stat_result = await anyio.to_thread.run_sync(self.lookup_path, path + suffix)
+                if stat_result is None or not stat.S_ISREG(stat_result.st_mode):
+                    continue
+                # The sibling's own ETag, so If-None-Match is checked
+                # against the variant that would be sent
+                response = FileResponse(
+                    full_path,
+                    stat_result=stat_result,
+                    media_type=mimetypes.guess_type(path)[0] or "text/plain",
+                    headers={"Content-Encoding": encoding},
+                )
+                if self.is_not_modified(response.headers, request_headers):
+                    response = NotModifiedResponse(response.headers)
+                break
+
+        if response is None:
+            response = await super().get_response(path, scope)
+        if response.status_code in (200, 304):
+            response.headers["Cache-Control"] = self.CACHE_CONTROL
+            response.headers["Vary"] = "Accept-Encoding"
+        return response
+
+
+_ASSET_REFERENCE = re.compile(r"(asset_url|bundle_scripts)\('([^']+)'\)")
+
+
+def _page_assets(template: str, bundled: bool) -> list[str]:
+    paths = []
+    for helper, name in _ASSET_REFERENCE.findall(template):
+        if helper == "asset_url":
+            paths.append(name)
+        elif bundled:
+            paths.append(f"JavaScript/{name}.js")
+        else:
+            paths.extend(BUNDLES[f"JavaScript/{name}.js"])
+    return paths
+
+
+def report(source_dir: str = ASSET_SOURCE_DIR, build_dir: str = ASSET_BUILD_DIR,
+           template_dir: str = "src/templates") -> dict:
+    """
+    Sizes of each bundle, and what a visitor with an empty cache
+    downloads walking through every page, with and without the bundles.
+    """
+    source = Path(source_dir)
+    dest = Path(build_dir)
+    manifest = json.loads((dest / "manifest.json").read_text())
+
+    def size(path: str, bundled: bool) -> tuple[int, int]:
+        content = (dest / manifest[path]).read_bytes() if bundled else (source / path).read_bytes()
+        return len(content), len(gzip.compress(content, 9, mtime=0))
+
+    bundles = {}
+    for bundle, sources in BUNDLES.items():
+        raw = sum(size(name, False)[0] for name in sources)
+        built, compressed = size(bundle, True)
+        bundles[bundle] = {"sources": len(sources), "source_bytes": raw,
+                           "minified_bytes": built, "gzip_bytes": compressed}
+
+    templates = [path.read_text(encoding="utf-8") for path in sorted(Path(template_dir).rglob("*.html"))]
+    walk = {}
+    for label, bundled in (("unbundled", False), ("bundled", True)):
+        fetched = {}
+        for template in templates:
+            for path in _page_assets(template, bundled):
+                if path not in fetched:
+                    fetched[path] = size(path, bundled and path in manifest)
+        walk[label] = {
+            "pages": len(templates),
+            "requests": len(fetched),
+            "bytes": sum(raw for raw, _ in fetched.values()),
+            "gzip_bytes": sum(compressed for _, compressed in fetched.values()),
+        }
+    return {"bundles": bundles, "walk": walk}
+
+
+def main(argv: Optional[list] = None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Fingerprint and compress static assets")
+    parser.add_argument("--source", default=ASSET_SOURCE_DIR)
+    parser.add_argument("--out", default=ASSET_BUILD_DIR)
+    parser.add_argument("--clean", action="store_true", help="remove the build directory first")
+    parser.add_argument("--report", action="store_true", help="print bundle sizes and request counts")
+    args = parser.parse_args(argv)
+
+    if args.clean:
+        shutil.rmtree(args.out, ignore_errors=True)
+    manifest = build(args.source, args.out)
+    print(f"Built {len(manifest)} assets into {args.out}")
+    if args.report:
+        print(json.dumps(report(args.source, args.out), indent=2))
+
+
+if __name__ == "__main__":
+    main()
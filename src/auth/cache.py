@@ -0,0 +1,119 @@
+"""
+In-process caches for the authentication path.
+
+Nearly every request runs through auth_service.get_user, which would
+otherwise verify the JWT signature and load the User row each time.
+Two small LRU caches sit in front of that work:
+
+    token_cache   token string -> verified claims, lives until the
+                  token expires or AUTH_TOKEN_CACHE_TTL passes
+    user_cache    user id -> column values of the User row, kept for
+                  AUTH_USER_CACHE_TTL seconds
+
+Anything that writes to a User row must call invalidate_user so the
+next request sees the change. A request that read the row before the
+write could still cache the old values after it, so loaders take the
+key's generation before reading and pass it to set, and invalidating
+bumps it so those late sets are refused. The caches are per process,
+with several workers each one keeps its own copy, which is why the user
+TTL is short.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv("AUTH_TOKEN_CACHE_SIZE", 10000))
+AUTH_TOKEN_CACHE_TTL = float(os.getenv("AUTH_TOKEN_CACHE_TTL", 300))
+AUTH_USER_CACHE_SIZE = int(os.getenv("AUTH_USER_CACHE_SIZE", 10000))
+AUTH_USER_CACHE_TTL = float(os.getenv("AUTH_USER_CACHE_TTL", 5))
+
+
+class TTLCache:
+    """
+    Bounded LRU cache where every entry also carries an expiry time.
+
+    Safe to use from the threadpool FastAPI runs sync dependencies in.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        # Bumped by pop, one small int per key ever popped
+        self._generations: dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+
+    def generation(self, key: Hashable) -> int:
+        """
+        Take before reading the value to cache, and pass it to set.
+        """
+        return self._generations.get(key, 0)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires, value = item
+            if expires <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None, generation: Optional[int] = None):
+        """
+        Cache a value, unless the key was popped since generation was taken.
+        """
+        if ttl is None or ttl > self.ttl:
+            ttl = self.ttl
+        if ttl <= 0:
+            return
+        with self._lock:
+            if generation is not None and generation != self._generations.get(key, 0):
+                return
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+            self._generations[key] = self._generations.get(key, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+token_cache = TTLCache(AUTH_TOKEN_CACHE_SIZE, AUTH_TOKEN_CACHE_TTL)
+user_cache = TTLCache(AUTH_USER_CACHE_SIZE, AUTH_USER_CACHE_TTL)
+
+
+def invalidate_user(user_id):
+    """
+    Drop a cached User row, call after any write to that user.
+    """
+    user_cache.pop(str(user_id))
+
+
+def stats() -> dict:
+    return {"tokens": token_cache.stats(), "users": user_cache.stats()}
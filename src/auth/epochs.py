@@ -0,0 +1,34 @@
+"""
+Per-user token epochs.
+
+Every access token carries the epoch its subject had when it was issued.
+Bumping a user's epoch (role change, deactivation, password change)
+makes every token issued before that point fail validation, which is
+what lets admin checks trust the signed claims.
+
+The epoch is the token_epoch column on User, so revocations survive a
+restart and reach every worker. It is compared against the row the auth
+path loads anyway, which normally comes from the user cache (see
+cache.py), so a worker that cached the row before the bump can accept
+the old token for at most AUTH_USER_CACHE_TTL seconds. A deleted user
+has no row and so no valid tokens.
+"""
+
+from typing import Optional
+
+
+def current(user) -> int:
+    return user.token_epoch or 0
+
+
+def bump(user) -> int:
+    """
+    Revoke every outstanding token for a user, takes effect when the
+    caller commits.
+    """
+    user.token_epoch = current(user) + 1
+    return user.token_epoch
+
+
+def is_current(user, epoch: Optional[int]) -> bool:
+    return user is not None and current(user) == (epoch or 0)
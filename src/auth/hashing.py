@@ -0,0 +1,167 @@
+"""
+Password hashing executor.
+
+bcrypt is deliberately slow (a couple of hundred ms per call), so running
+it inside an async route stalls the whole event loop. Every auth path hands
+its hash / verify work to a bounded worker pool through the helpers below.
+
+The pool is configured through the environment:
+
+    HASH_POOL_KIND      "thread" (default) or "process"
+    HASH_POOL_WORKERS   number of workers (default: cpu count)
+    HASH_QUEUE_LIMIT    max jobs queued or running before we shed load
+    HASH_RETRY_AFTER    seconds sent back in the Retry-After header
+    HASH_BULK_WORKERS   processes for hash_passwords (default: cpu count)
+    HASH_BULK_JOBS      hash_passwords calls run at once, the rest wait
+                        their turn (default 1)
+
+bcrypt releases the GIL, so threads already run in parallel; the process
+pool is there for deployments that want the hashing fully isolated.
+
+Bulk jobs (user imports) get a process pool of their own through
+hash_passwords, so thousands of hashes never queue in front of logins.
+Each call already spreads over every bulk worker, so with the default
+HASH_BULK_JOBS two imports take turns chunk by chunk instead of both
+piling their batches onto the pool.
+"""
+
+import asyncio
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+from fastapi import HTTPException, status
+
+from src.users import models
+
+HASH_POOL_KIND = os.getenv("HASH_POOL_KIND", "thread")
+HASH_POOL_WORKERS = int(os.getenv("HASH_POOL_WORKERS", os.cpu_count() or 2))
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", HASH_POOL_WORKERS * 16))
+HASH_RETRY_AFTER = int(os.getenv("HASH_RETRY_AFTER", 2))
+HASH_BULK_WORKERS = int(os.getenv("HASH_BULK_WORKERS", os.cpu_count() or 2))
+HASH_BULK_JOBS = int(os.getenv("HASH_BULK_JOBS", 1))
+
+_executor: Optional[Executor] = None
+_bulk_executor: Optional[ProcessPoolExecutor] = None
+_bulk_slots: Optional[asyncio.Semaphore] = None
+_bulk_slots_loop: Optional[asyncio.AbstractEventLoop] = None
+_pending = 0
+
+
+def _hash(password: str) -> str:
+    # Module level so the process pool can pickle it
+    return models.pwd_context.hash(password)
+
+
+def _verify(password: str, hashed: str) -> bool:
+    return models.pwd_context.verify(password, hashed)
+
+
+def _hash_many(passwords: list[str]) -> list[str]:
+    return [_hash(password) for password in passwords]
+
+
+def get_executor() -> Executor:
+    """
+    Lazily create the shared hashing pool.
+    """
+    global _executor
+    if _executor is None:
+        if HASH_POOL_KIND == "process":
+            _executor = ProcessPoolExecutor(max_workers=HASH_POOL_WORKERS)
+        else:
+            _executor = ThreadPoolExecutor(
+                max_workers=HASH_POOL_WORKERS, thread_name_prefix="hashing"
+            )
+    return _executor
+
+
+def get_bulk_executor() -> ProcessPoolExecutor:
+    global _bulk_executor
+    if _bulk_executor is None:
+        _bulk_executor = ProcessPoolExecutor(max_workers=HASH_BULK_WORKERS)
+    return _bulk_executor
+
+
+def _bulk_semaphore() -> asyncio.Semaphore:
+    # A semaphore belongs to one event loop, the tests and the CLI each
+    # run their own
+    global _bulk_slots, _bulk_slots_loop
+    loop = asyncio.get_running_loop()
+    if _bulk_slots is None or _bulk_slots_loop is not loop:
+        _bulk_slots = asyncio.Semaphore(HASH_BULK_JOBS)
+        _bulk_slots_loop = loop
+    return _bulk_slots
+
+
+def shutdown():
+    """
+    Stop the pools, called from the app lifespan on shutdown.
+    """
+    global _executor, _bulk_executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+    if _bulk_executor is not None:
+        _bulk_executor.shutdown(wait=False, cancel_futures=True)
+        _bulk_executor = None
+
+
+def pending() -> int:
+    return _pending
+
+
+async def _submit(func, *args):
+    # _pending is only touched from the event loop thread, so no lock needed
+    global _pending
+    if _pending >= HASH_QUEUE_LIMIT:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server busy, please try again shortly.",
+            headers={"Retry-After": str(HASH_RETRY_AFTER)},
+        )
+    _pending += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), func, *args)
+    finally:
+        _pending -= 1
+
+
+async def hash_password(password: str) -> str:
+    """
+    Hash a password on the worker pool.
+    """
+    return await _submit(_hash, password)
+
+
+async def hash_passwords(passwords: list[str]) -> list[str]:
+    """
+    Hash many passwords on the bulk process pool, returned in order.
+
+    At most HASH_BULK_JOBS calls use the pool at once.
+    """
+    if not passwords:
+        return []
+    # A few batches per worker rather than a job per password, fewer
+    # round trips to the pool while still spreading the work evenly
+    size = max(1, -(-len(passwords) // (HASH_BULK_WORKERS * 4)))
+    loop = asyncio.get_running_loop()
+    async with _bulk_semaphore():
+        executor = get_bulk_executor()
+        batches = await asyncio.gather(*(
+            loop.run_in_executor(executor, _hash_many, passwords[start:start + size])
+            for start in range(0, len(passwords), size)
+        ))
+    return [hashed for batch in batches for hashed in batch]
+
+
+async def verify_password(password: Optional[str], hashed: Optional[str]) -> bool:
+    """
+    Check a password against a stored hash on the worker pool.
+
+    Mirrors User.verify_password, a missing password never matches.
+    """
+    if password is None or not hashed:
+        return False
+    return await _submit(_verify, password, hashed)
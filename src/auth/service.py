@@ -6,24 +6,30 @@ from fastapi.security import OAuth2PasswordBearer
 from fastapi.security.utils import get_authorization_scheme_param
 from fastapi.openapi.models import OAuthFlows as OAuthFlowsModel
 
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
 from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from typing import Annotated, Optional, Dict
 from passlib.context import CryptContext
 
 from src.users import models
 from src.users.models import User
 from src import database
+from src.auth import cache as auth_cache
+from src.auth import epochs as token_epochs
 
 import jwt
 from jose import JWTError
 from jwt.exceptions import InvalidTokenError
 
 import logging
+import os
+import time
 from datetime import datetime, timedelta
 import uuid
 
 log = logging.getLogger(__name__)
-log.setLevel(logging.WARNING)
 
 # Token Expires in Minutes
 JWT_TOKEN_EXPIRES = 30
@@ -47,6 +53,11 @@ def get_token_from_cookie(request: Request):
 # Algorithm
 JWT_ALG = "HS256"
 
+# How admin routes are authorised:
+# "claims"   - trust the signed audience claim, checked against the token epoch
+# "database" - load the user row and check is_admin
+ADMIN_AUTH_MODE = os.getenv("ADMIN_AUTH_MODE", "claims")
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 
 class OAuth2PasswordBearerWithCookie(OAuth2):
@@ -85,7 +96,7 @@ class OAuth2PasswordBearerWithCookie(OAuth2):
         if authorization:
             # Beacuse I found the bearer prefix in the cookie ugly We dont actually have one.
             # Therefore just return whatever is in the access token field.
-            log.debug("Auth via Cookie %s", authorization)
+            log.debug("Auth via Cookie")
             return authorization
 
         # If we dont have a cookie try the request header
@@ -95,7 +106,6 @@ class OAuth2PasswordBearerWithCookie(OAuth2):
 
         scheme, param = get_authorization_scheme_param(authorization)
         log.debug("scheme is %s", scheme)
-        log.debug("params %s", param)
         if not authorization or scheme.lower() != "bearer":
             if self.auto_error:
                 raise HTTPException(
@@ -119,7 +129,7 @@ def create_access_token(
     Create a JWT based token, and return it
     """
     if data["audience"] == "admin":
-        print("ADMIN2")
+        log.debug("Issuing admin token for %s", data["subject"])
         to_encode = data.copy()
 
         unique_identifier = str(uuid.uuid4())
@@ -138,7 +148,7 @@ def create_access_token(
         )
         return encoded_jwt
     elif data["audience"] == "user":
-        print("USER2")
+        log.debug("Issuing user token for %s", data["subject"])
         to_encode = data.copy()
 
         unique_identifier = str(uuid.uuid4())
@@ -154,7 +164,6 @@ def create_access_token(
         encoded_jwt = jwt.encode(
             to_encode, JWT_SECRET_KEY, algorithm=JWT_ALG
         )
-        print("JWT ", encoded_jwt)
         return encoded_jwt
 
 def decode_token(
@@ -164,9 +173,8 @@ def decode_token(
     """
     Decode a token and return the relevant user if they exist.
     """
-    print("decoding")
     if token is None:
-        print("Empty Token")
+        log.debug("No token to decode")
         return None
 
     try:
@@ -215,51 +223,123 @@ def validate_login(
     return [db_user, token]
 
 
-async def get_user(
-        token: str = Depends(get_token_from_cookie),
-        session: Session = Depends(database.get_session),
-):
-    try:
-        if isinstance(token, str):
-            token_bytes = token.encode('utf-8')
-        else:
-            token_bytes = token
+def decode_claims(token) -> Optional[dict]:
+    """
+    Verify a token and return its claims, or None if it is invalid.
+
+    Verified claims are kept in the token cache until the token expires,
+    so a token is only HMAC checked once per process. This does not check
+    the epoch, that needs the user row, see _current_user.
+    """
+    if isinstance(token, bytes):
+        token = token.decode("utf-8")
+
+    claims = auth_cache.token_cache.get(token)
+    if claims is None:
+        try:
+            claims = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALG])
+        except (InvalidTokenError, JWTError):
+            return None
+
+        exp = claims.get("exp")
+        auth_cache.token_cache.set(token, claims, exp - time.time() if exp else None)
+    return claims
+
+def _cached_user(session: Session, user_id: str) -> Optional[User]:
+    """
+    Find the user in the session or the user cache without any SQL.
+
+    A cached row is rebuilt and attached to the session as if it had
+    just been loaded, so routes can still modify and commit it.
+    """
+    key = identity_key(User, user_id)
+    if key in session.identity_map:
+        return session.identity_map[key]
 
-        payload = jwt.decode(token_bytes, JWT_SECRET_KEY, algorithms=[JWT_ALG])
-        user_id = payload.get("subject")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Invalid Token (user_id is None)")
+    cached = auth_cache.user_cache.get(user_id)
+    if cached is None:
+        return None
 
+    user = User(**cached)
+    make_transient_to_detached(user)
+    session.add(user)
+    return user
+
+def load_user(session: Session, user_id) -> Optional[User]:
+    """
+    Load a user by id, using the short lived user cache.
+    """
+    user_id = str(user_id)
+    user = _cached_user(session, user_id)
+    if user is None:
+        generation = auth_cache.user_cache.generation(user_id)
         user = session.get(User, user_id)
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
+        if user:
+            auth_cache.user_cache.set(user_id, user.model_dump(), generation=generation)
+    return user
 
-        return user
-    except JWTError as e:
-        print("JWT ERROR:", e)
+async def load_user_async(session: AsyncSession, user_id) -> Optional[User]:
+    """
+    load_user for an AsyncSession.
+    """
+    user_id = str(user_id)
+    user = _cached_user(session.sync_session, user_id)
+    if user is None:
+        generation = auth_cache.user_cache.generation(user_id)
+        user = await session.get(User, user_id)
+        if user:
+            auth_cache.user_cache.set(user_id, user.model_dump(), generation=generation)
+    return user
+
+def _claims(token) -> dict:
+    claims = decode_claims(token)
+    if claims is None:
         raise HTTPException(status_code=401, detail="Invalid Token")
 
+    if claims.get("subject") is None:
+        raise HTTPException(status_code=401, detail="Invalid Token (user_id is None)")
+    return claims
+
+def _current_user(claims: dict, user: Optional[User]) -> User:
+    if not user:
+        raise HTTPException(status_code=401, detail="User not found")
+    # Revoked by a role, status or password change since it was issued
+    if not token_epochs.is_current(user, claims.get("epoch")):
+        raise HTTPException(status_code=401, detail="Invalid Token")
+    return user
+
+async def get_user(
+        token: str = Depends(get_token_from_cookie),
+        session: Session = Depends(database.get_session),
+):
+    claims = _claims(token)
+    return _current_user(claims, load_user(session, claims["subject"]))
+
+async def get_user_async(
+        token: str = Depends(get_token_from_cookie),
+        session: AsyncSession = Depends(database.get_async_session),
+):
+    """
+    get_user for routes running on the async database layer.
+    """
+    claims = _claims(token)
+    return _current_user(claims, await load_user_async(session, claims["subject"]))
+
 async def optional_user(
         token: Optional[str] = Depends(get_token_from_cookie),
         session: Session = Depends(database.get_session),
 ) -> Optional[User]:
     if not token:
         return None
-    try:
-        if isinstance(token, str):
-            token_bytes = token.encode('utf-8')
-        else:
-            token_bytes = token
 
-        payload = jwt.decode(token_bytes, JWT_SECRET_KEY, algorithms=[JWT_ALG])
-        user_id = payload.get("subject")
-        if not user_id:
-            return None
+    claims = decode_claims(token)
+    if not claims or not claims.get("subject"):
+        return None
 
-        user = session.get(User, user_id)
-        return user
-    except JWTError:
+    user = load_user(session, claims["subject"])
+    if not token_epochs.is_current(user, claims.get("epoch")):
         return None
+    return user
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -275,10 +355,43 @@ def authenticate_user(database, username: str, password: str):
         return False
     return user
 
-def get_current_admin(current_user: User = Depends(get_user)) -> User:
-    if not current_user.is_admin:
+def _admin(claims: dict, user: User):
+    if ADMIN_AUTH_MODE == "database":
+        is_admin = bool(user.is_admin)
+    else:
+        user = claims
+        is_admin = claims.get("audience") == "admin"
+
+    if not is_admin:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Admin privileges required."
         )
-    return current_user
\ No newline at end of file
+    return user
+
+async def get_current_admin(
+        token: str = Depends(get_token_from_cookie),
+        session: Session = Depends(database.get_session),
+):
+    """
+    Require an admin.
+
+    In the default "claims" mode the token's audience claim is trusted
+    as long as its epoch matches the user's, the row for that check
+    normally comes from the user cache. Returns the claims, or the User
+    row in "database" mode.
+    """
+    claims = _claims(token)
+    user = _current_user(claims, load_user(session, claims["subject"]))
+    return _admin(claims, user)
+
+async def get_current_admin_async(
+        token: str = Depends(get_token_from_cookie),
+        session: AsyncSession = Depends(database.get_async_session),
+):
+    """
+    get_current_admin for the async database layer.
+    """
+    claims = _claims(token)
+    user = _current_user(claims, await load_user_async(session, claims["subject"]))
+    return _admin(claims, user)
@@ -1,16 +1,135 @@
+"""
+Database engine and session setup.
+
+The engine is configured from the environment:
+
+    DATABASE_URL            SQLAlchemy URL (default sqlite:///database.db)
+    DATABASE_ECHO           "1" to log every SQL statement (default off)
+    DATABASE_POOL_SIZE      connections kept open in the pool (default 10)
+    DATABASE_MAX_OVERFLOW   extra connections allowed under load (default 20)
+    DATABASE_POOL_TIMEOUT   seconds to wait for a free connection (default 30)
+
+For SQLite every new connection also gets these pragmas:
+
+    journal_mode=WAL        readers no longer block on the writer
+    synchronous=NORMAL      safe with WAL, fsync on checkpoint not on commit
+    busy_timeout            SQLITE_BUSY_TIMEOUT ms to wait on a locked db (default 5000)
+    cache_size              SQLITE_CACHE_SIZE_KB of page cache per connection (default 65536)
+    mmap_size               SQLITE_MMAP_SIZE bytes memory mapped (default 256MB)
+    foreign_keys            SQLITE_FOREIGN_KEYS, off by default because the
+                            solve / review tables store user ids as 32 char
+                            hex while user.id keeps the dashed form, so
+                            enforcing would reject every solve
+
+The pool settings only apply to file databases, in-memory SQLite keeps
+SQLAlchemy's single connection pool.
+
+Alongside the sync engine there is an async one (aiosqlite for SQLite)
+used by the hot API routes through get_async_session, so a worker can
+have many queries in flight without blocking the event loop. It reads
+ASYNC_DATABASE_URL, defaulting to DATABASE_URL with the async driver.
+The sync engine and get_session stay for everything else and for tests.
+"""
+
+import os
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from sqlmodel import SQLModel, create_engine, Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src import migrations
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///database.db")
+DATABASE_ECHO = os.getenv("DATABASE_ECHO", "0").lower() in ("1", "true", "yes")
+DATABASE_POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", 10))
+DATABASE_MAX_OVERFLOW = int(os.getenv("DATABASE_MAX_OVERFLOW", 20))
+DATABASE_POOL_TIMEOUT = float(os.getenv("DATABASE_POOL_TIMEOUT", 30))
+
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", 65536))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+SQLITE_FOREIGN_KEYS = os.getenv("SQLITE_FOREIGN_KEYS", "0").lower() in ("1", "true", "yes")
+
+
+def _is_memory_sqlite(url: str) -> bool:
+    url = url.replace("+aiosqlite", "")
+    return url in ("sqlite://", "sqlite:///:memory:") or "mode=memory" in url
+
 
-sqlite_file_name = "database.db"
-sqlite_url = f"sqlite:///{sqlite_file_name}"
-connect_args = {"check_same_thread": False}
+def to_async_url(url: str) -> str:
+    if url.startswith("sqlite://"):
+        return "sqlite+aiosqlite://" + url[len("sqlite://"):]
+    return url
 
-engine = create_engine(sqlite_url, echo=True, connect_args=connect_args)
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", to_async_url(DATABASE_URL))
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    # Negative cache_size is in KiB rather than pages
+    cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA foreign_keys={'ON' if SQLITE_FOREIGN_KEYS else 'OFF'}")
+    cursor.close()
+
+
+def _engine_options(url: str, echo: bool, kwargs: dict) -> dict:
+    is_sqlite = url.startswith("sqlite")
+    options = {"echo": echo}
+    if is_sqlite:
+        options["connect_args"] = {"check_same_thread": False}
+    if not (is_sqlite and _is_memory_sqlite(url)):
+        options.update(
+            pool_size=DATABASE_POOL_SIZE,
+            max_overflow=DATABASE_MAX_OVERFLOW,
+            pool_timeout=DATABASE_POOL_TIMEOUT,
+            pool_pre_ping=not is_sqlite,
+        )
+    options.update(kwargs)
+    return options
+
+
+def create_db_engine(url: str = DATABASE_URL, echo: bool = DATABASE_ECHO, **kwargs) -> Engine:
+    """
+    Build an engine with the settings above, extra kwargs are passed
+    straight to create_engine.
+    """
+    new_engine = create_engine(url, **_engine_options(url, echo, kwargs))
+    if url.startswith("sqlite"):
+        event.listen(new_engine, "connect", set_sqlite_pragmas)
+    return new_engine
+
+
+def create_async_db_engine(url: str = ASYNC_DATABASE_URL, echo: bool = DATABASE_ECHO, **kwargs) -> AsyncEngine:
+    """
+    Async counterpart of create_db_engine.
+    """
+    new_engine = create_async_engine(url, **_engine_options(url, echo, kwargs))
+    if url.startswith("sqlite"):
+        event.listen(new_engine.sync_engine, "connect", set_sqlite_pragmas)
+    return new_engine
+
+
+engine = create_db_engine()
+async_engine = create_async_db_engine()
 
 
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
+    migrations.apply_migrations(engine)
 
 
 def get_session():
     with Session(engine) as session:
-        yield session
\ No newline at end of file
+        yield session
+
+
+async def get_async_session():
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        yield session
@@ -1,48 +1,80 @@
+import asyncio
 import os
 import uuid
 
 from fastapi import FastAPI, HTTPException, Depends, Request, Response
 from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
 
 from contextlib import asynccontextmanager
 from sqlmodel import Session, select
 
 from pydantic import BaseModel
+from src import assets
 from src import database
+from src import metrics
+from src import logging_config
+from src import profiling
 from src.users import models
+from src.users import flag_index
+from src.users import leaderboard
+from src.users import scoreboard_stream
+from src.users import avatars
+from src.users import uploads
 from src.auth import service as auth_service
+from src.auth import hashing
+
+ASSET_BUILD_ON_STARTUP = os.getenv("ASSET_BUILD_ON_STARTUP", "1").lower() in ("1", "true", "yes")
 
 @asynccontextmanager
 async def lifespan_function(app: FastAPI):
     database.create_db_and_tables()
+    with Session(database.engine) as session:
+        flag_index.rebuild(session)
+        leaderboard.leaderboard.load(session)
+    persist_task = asyncio.create_task(leaderboard.persist_periodically())
+    gc_task = None
+    if uploads.UPLOAD_GC_INTERVAL > 0:
+        gc_task = asyncio.create_task(uploads.collect_periodically())
+    if ASSET_BUILD_ON_STARTUP:
+        assets.build()
+    assets.load_manifest()
+    # Pre-rendered after the manifest so the pages link the hashed assets
+    from src.users import view_routes
+    view_routes.prerender_pages(app)
     yield
+    scoreboard_stream.broadcaster.close()
+    persist_task.cancel()
+    if gc_task is not None:
+        gc_task.cancel()
+    leaderboard.persist_now()
+    hashing.shutdown()
+    avatars.shutdown()
 
 def create_app():
+    logging_config.setup_logging()
     app = FastAPI(lifespan=lifespan_function)
+    app.add_middleware(profiling.ProfilingMiddleware)
+    app.add_middleware(metrics.MetricsMiddleware)
+    # Outermost, so everything below logs under the request id
+    app.add_middleware(logging_config.RequestIdMiddleware)
 
     from src.users import routes as user_routes
     from src.auth import routes as auth_routes
     from src.users import view_routes
     from src.users import admin_routes
 
-    UPLOAD_DIR = "static/uploads"
-    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    os.makedirs(uploads.UPLOAD_DIR, exist_ok=True)
 
-    app.mount("/static", StaticFiles(directory="src/static"), name="static")
-    app.mount("/uploads", StaticFiles(directory="static/uploads"), name="uploads")
+    # Unhashed files stay on /static for anything not built yet
+    app.mount("/static", StaticFiles(directory=assets.ASSET_SOURCE_DIR), name="static")
+    app.mount("/assets", assets.ImmutableStaticFiles(directory=assets.ASSET_BUILD_DIR, check_dir=False), name="assets")
+    app.mount("/uploads", StaticFiles(directory=uploads.UPLOAD_DIR), name="uploads")
 
     app.include_router(user_routes.router, prefix="/api", tags=["users"])
     app.include_router(auth_routes.router, prefix="/api/auth", tags=["auth"])
     app.include_router(view_routes.router, prefix="", tags=["routes"])
     app.include_router(admin_routes.router, prefix="/api/admin", tags=["admin"])
+    app.add_api_route("/metrics", metrics.metrics_endpoint, methods=["GET"], include_in_schema=False)
 
-    if os.getenv("ENV") != "TEST":
-        static_dir = "src/static"
-        if os.path.exists(static_dir):
-            app.mount("/static", StaticFiles(directory="src/static"), name="static")
-        else:
-            print(f"Static directory '{static_dir}' does not exist, skipping mounting")
-            app.templates = Jinja2Templates(directory="src/templates")
     return app
 app = create_app()
\ No newline at end of file
@@ -0,0 +1,265 @@
+"""
+Request metrics in the Prometheus text format.
+
+MetricsMiddleware times every request and records, per route template
+(/api/users/{user_id} rather than the raw path, so ids don't blow up the
+number of series):
+
+    http_requests_total               counter, by method, route, status
+    http_request_duration_seconds     histogram, by method and route
+    http_response_size_bytes          histogram, by method and route
+    http_requests_in_progress         gauge, by method
+    db_queries_per_request            histogram, by method and route
+    db_time_per_request_seconds       histogram, by method and route
+    db_repeated_query_requests_total  counter, requests that look like N+1
+
+The database figures come from query_stats, and are also sent to the
+client in a Server-Timing header (queries run before the headers went out).
+
+Everything is exposed on GET /metrics, which needs an
+"Authorization: Bearer <METRICS_TOKEN>" header when METRICS_TOKEN is
+set. The metric types here are a small subset of prometheus_client,
+enough for these series without pulling in the dependency. Recording is
+a couple of dict lookups and a bisect, so it can stay on in production.
+
+Values are per process, with several workers each one reports its own.
+"""
+
+import hmac
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Iterable
+
+from fastapi import HTTPException, Request
+from fastapi.responses import PlainTextResponse
+from starlette.datastructures import MutableHeaders
+
+from src import query_stats
+
+# Seconds, the usual Prometheus defaults
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+UNMATCHED_ROUTE = "<unmatched>"
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_number(value) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, labels)} {_format_number(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                # One count per bucket plus +Inf, then sum and count
+                series = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[bisect_left(self.buckets, value)] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def count(self, *labels) -> int:
+        series = self._values.get(labels)
+        return series[-1] if series else 0
+
+    def render(self) -> list[str]:
+        lines = self.header()
+        for labels, series in sorted(self._values.items()):
+            # Stored per bucket, Prometheus wants cumulative counts
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_number(bound)
+                bucket_labels = _format_labels(self.labels, labels, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {_format_number(series[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {series[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Iterable[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Iterable[str] = (), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        for metric in self._metrics.values():
+            metric.clear()
+
+
+registry = Registry()
+
+REQUESTS = registry.counter(
+    "http_requests_total", "HTTP requests handled.", ("method", "route", "status"))
+LATENCY = registry.histogram(
+    "http_request_duration_seconds", "Time to handle a request, until the body is sent.", ("method", "route"))
+RESPONSE_SIZE = registry.histogram(
+    "http_response_size_bytes", "Response body size.", ("method", "route"), buckets=SIZE_BUCKETS)
+IN_PROGRESS = registry.gauge(
+    "http_requests_in_progress", "Requests being handled right now.", ("method",))
+DB_QUERIES = registry.histogram(
+    "db_queries_per_request", "SQL statements run by a request.", ("method", "route"), buckets=QUERY_BUCKETS)
+DB_TIME = registry.histogram(
+    "db_time_per_request_seconds", "Time a request spent in SQL statements.", ("method", "route"))
+DB_REPEATED = registry.counter(
+    "db_repeated_query_requests_total", "Requests that ran one statement over and over.", ("method", "route"))
+
+
+def route_template(scope, root_path: str) -> str:
+    """
+    The route a request was dispatched to, read back from the scope the
+    router filled in.
+    """
+    route = scope.get("route")
+    if route is not None:
+        return route.path_format
+    # Mounts (static files) only move root_path along
+    mounted = scope.get("root_path", root_path)
+    if mounted != root_path:
+        return mounted[len(root_path):] + "/{path}"
+    return UNMATCHED_ROUTE
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware, so streamed bodies are timed to the last chunk
+    and nothing gets buffered.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        root_path = scope.get("root_path", "")
+        status = 500
+        size = 0
+        stats = query_stats.QueryStats()
+
+        async def send_wrapper(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = MutableHeaders(scope=message)
+                headers.append(
+                    "Server-Timing",
+                    f"{stats.server_timing()}, total;dur={(time.perf_counter() - start) * 1000:.2f}",
+                )
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        IN_PROGRESS.inc(method)
+        token = query_stats.begin(stats)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            query_stats.end(token)
+            IN_PROGRESS.dec(method)
+            route = route_template(scope, root_path)
+            REQUESTS.inc(method, route, str(status))
+            LATENCY.observe(elapsed, method, route)
+            RESPONSE_SIZE.observe(size, method, route)
+            DB_QUERIES.observe(stats.count, method, route)
+            DB_TIME.observe(stats.duration, method, route)
+            if stats.repeated():
+                DB_REPEATED.inc(method, route)
+            query_stats.finish(route, stats)
+
+
+async def metrics_endpoint(request: Request):
+    if METRICS_TOKEN:
+        supplied = request.headers.get("authorization", "")
+        if not hmac.compare_digest(supplied.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+            raise HTTPException(status_code=401, detail="Not authenticated")
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,173 @@
+"""
+Versioned schema migrations.
+
+SQLModel.metadata.create_all only creates missing tables, it never
+touches a table that already exists, so indexes added later would never
+reach an existing database.db. Each migration here is a numbered list of
+SQL statements, applied in order and recorded in the schema_version
+table so it only runs once per database.
+
+Migrations run at startup from database.create_db_and_tables, or by hand:
+
+    python -m src.migrations            apply anything pending
+    python -m src.migrations --list     show applied / pending versions
+
+Statements should be idempotent (IF NOT EXISTS etc), a fresh database
+may already have some of these objects from create_all. SQLite has no
+ADD COLUMN IF NOT EXISTS, so new columns go through add_column, which
+checks the table first.
+"""
+
+import argparse
+from datetime import datetime
+from typing import Callable, NamedTuple, Union
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    # SQL strings, or callables taking the connection
+    statements: list[Union[str, Callable]]
+
+
+def add_column(table: str, column: str, ddl: str) -> Callable:
+    def run(conn):
+        columns = {row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table})")}
+        if column not in columns:
+            conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+    return run
+
+
+def _drop_duplicate_solves(conn):
+    # Older databases could have picked up duplicate solves, keep the first
+    # and recount the score of everyone who had them, it was awarded twice
+    affected = [
+        row[0] for row in conn.exec_driver_sql(
+            "SELECT DISTINCT user_id FROM challengesolve "
+            "GROUP BY user_id, challenge_id HAVING COUNT(*) > 1"
+        )
+    ]
+    conn.exec_driver_sql(
+        "DELETE FROM challengesolve WHERE id NOT IN "
+        "(SELECT MIN(id) FROM challengesolve GROUP BY user_id, challenge_id)"
+    )
+    if affected:
+        # challengesolve.user_id is bare hex, user.id has dashes
+        conn.exec_driver_sql(
+            "UPDATE user SET score = (SELECT COALESCE(SUM(c.points), 0) FROM challengesolve s "
+            "JOIN challenge c ON c.id = s.challenge_id WHERE s.user_id = REPLACE(user.id, '-', '')) "
+            "WHERE REPLACE(id, '-', '') = ?",
+            [(user_id,) for user_id in affected],
+        )
+
+
+MIGRATIONS = [
+    Migration(1, "One solve per user and challenge", [
+        _drop_duplicate_solves,
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_challengesolve_user_challenge "
+        "ON challengesolve (user_id, challenge_id)",
+    ]),
+    Migration(2, "Indexes for the hot query paths", [
+        # Solve counts per challenge
+        "CREATE INDEX IF NOT EXISTS ix_challengesolve_challenge_id "
+        "ON challengesolve (challenge_id)",
+        # Covers the leaderboard load, MAX(solved_at) grouped by user
+        "CREATE INDEX IF NOT EXISTS ix_challengesolve_user_solved_at "
+        "ON challengesolve (user_id, solved_at)",
+        # Reviews for a challenge, newest first
+        "CREATE INDEX IF NOT EXISTS ix_challengereview_challenge_created "
+        "ON challengereview (challenge_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_challenge_flag ON challenge (flag)",
+        # User listings ordered by score, with id as the tie breaker
+        "CREATE INDEX IF NOT EXISTS ix_user_score_id ON user (score DESC, id)",
+    ]),
+    Migration(3, "Resized avatar variants", [
+        add_column("user", "avatar_variants", "JSON"),
+    ]),
+    Migration(4, "Flag index version counter", [
+        # Bumped on every challenge change so each worker's flag index
+        # notices, see flag_index.py
+        "CREATE TABLE IF NOT EXISTS flag_index_version "
+        "(id INTEGER PRIMARY KEY, version INTEGER NOT NULL)",
+        "INSERT OR IGNORE INTO flag_index_version (id, version) VALUES (1, 0)",
+    ]),
+    Migration(5, "Token epochs", [
+        add_column("user", "token_epoch", "INTEGER NOT NULL DEFAULT 0"),
+    ]),
+]
+
+_CREATE_VERSION_TABLE = (
+    "CREATE TABLE IF NOT EXISTS schema_version ("
+    "version INTEGER PRIMARY KEY, "
+    "description VARCHAR NOT NULL, "
+    "applied_at DATETIME NOT NULL)"
+)
+
+
+def applied_versions(engine: Engine) -> set[int]:
+    with engine.begin() as conn:
+        conn.exec_driver_sql(_CREATE_VERSION_TABLE)
+        return {row[0] for row in conn.exec_driver_sql("SELECT version FROM schema_version")}
+
+
+def apply_migrations(engine: Engine) -> list[int]:
+    """
+    Apply every pending migration, returns the versions applied.
+    """
+    applied = applied_versions(engine)
+    done = []
+    for migration in MIGRATIONS:
+        if migration.version in applied:
+            continue
+        with engine.begin() as conn:
+            for statement in migration.statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.exec_driver_sql(statement)
+            # OR IGNORE, another worker may have got here at the same time
+            conn.execute(
+                text(
+                    "INSERT OR IGNORE INTO schema_version (version, description, applied_at) "
+                    "VALUES (:version, :description, :applied_at)"
+                ),
+                {
+                    "version": migration.version,
+                    "description": migration.description,
+                    "applied_at": datetime.utcnow(),
+                },
+            )
+        done.append(migration.version)
+    return done
+
+
+def main(argv=None):
+    from src import database
+
+    parser = argparse.ArgumentParser(description="Apply database schema migrations")
+    parser.add_argument("--url", default=database.DATABASE_URL, help="database URL")
+    parser.add_argument("--list", action="store_true", help="show migration status and exit")
+    args = parser.parse_args(argv)
+
+    engine = database.create_db_engine(args.url)
+    if args.list:
+        applied = applied_versions(engine)
+        for migration in MIGRATIONS:
+            state = "applied" if migration.version in applied else "pending"
+            print(f"{migration.version:>4}  {state:<8} {migration.description}")
+        return
+
+    # Migrations assume the tables exist
+    from sqlmodel import SQLModel
+    from src.users import models  # noqa: F401 registers the tables
+    SQLModel.metadata.create_all(engine)
+
+    done = apply_migrations(engine)
+    print(f"Applied {len(done)} migration(s): {done}" if done else "Database is up to date")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+"""
+Opt-in profiling of single requests.
+
+An admin adds an "X-Profile" header (or a "_profile" query parameter) to
+any request, and that one request runs under cProfile:
+
+    X-Profile: store    (or 1) the profile is saved and its id returned
+                        in an X-Profile-Id header, see /api/admin/profiles
+    X-Profile: inline   the response body is replaced by the text report
+
+The caller must be an admin, checked with
+auth_service.get_current_admin_async on the usual access token (cookie
+or bearer header) and the app's async session, so the check never blocks
+the event loop. For anyone else the flag is ignored and the request runs
+normally.
+
+Saved profiles go to PROFILE_DIR as <id>.prof (pstats format, open with
+snakeviz or python -m pstats) plus <id>.json metadata. Only the newest
+PROFILE_KEEP are kept.
+
+cProfile follows the event loop thread only, so work a sync route does
+in the threadpool is not in the report, and other requests served at the
+same time show up in it. Only one request is profiled at a time.
+"""
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import re
+import time
+import uuid
+from typing import Optional
+from urllib.parse import parse_qs
+
+from fastapi import HTTPException
+from fastapi.security.utils import get_authorization_scheme_param
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import MutableHeaders
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+
+from src import database
+from src import metrics
+from src.auth import service as auth_service
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", 50))
+# Functions listed in a text report
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", 40))
+
+PROFILE_HEADER = b"x-profile"
+PROFILE_QUERY = "_profile"
+MODES = {"1": "store", "store": "store", "inline": "inline"}
+
+_PROFILE_ID = re.compile(r"^[0-9a-f]{32}$")
+_busy = False
+
+
+def _requested_mode(scope) -> Optional[str]:
+    for name, value in scope["headers"]:
+        if name == PROFILE_HEADER:
+            return MODES.get(value.decode("latin-1").strip().lower())
+    if PROFILE_QUERY.encode() in scope.get("query_string", b""):
+        values = parse_qs(scope["query_string"].decode("latin-1")).get(PROFILE_QUERY)
+        if values:
+            return MODES.get(values[0].lower())
+    return None
+
+
+async def _is_admin(scope) -> bool:
+    request = Request(scope)
+    token = request.cookies.get("access_token")
+    if not token:
+        scheme, token = get_authorization_scheme_param(request.headers.get("authorization"))
+        if scheme.lower() != "bearer":
+            return False
+    if not token:
+        return False
+    # The same session the routes get, dependency overrides included
+    get_async_session = scope["app"].dependency_overrides.get(
+        database.get_async_session, database.get_async_session)
+    sessions = get_async_session()
+    try:
+        await auth_service.get_current_admin_async(token, await anext(sessions))
+    except HTTPException:
+        return False
+    finally:
+        await sessions.aclose()
+    return True
+
+
+def report(stats_source, top: int = PROFILE_TOP) -> str:
+    """
+    Text report of a profiler or a saved .prof file, by cumulative time.
+    """
+    out = io.StringIO()
+    pstats.Stats(stats_source, stream=out).sort_stats("cumulative").print_stats(top)
+    return out.getvalue()
+
+
+def profile_path(profile_id: str, directory: Optional[str] = None) -> Optional[str]:
+    if not _PROFILE_ID.match(profile_id):
+        return None
+    path = os.path.join(directory or PROFILE_DIR, profile_id + ".prof")
+    return path if os.path.exists(path) else None
+
+
+def list_profiles(directory: Optional[str] = None) -> list[dict]:
+    """
+    Metadata of every saved profile, newest first.
+    """
+    directory = directory or PROFILE_DIR
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for name in os.listdir(directory):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return sorted(profiles, key=lambda meta: meta["created"], reverse=True)
+
+
+def _store(profiler: cProfile.Profile, meta: dict, directory: str, keep: int):
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(directory, meta["id"])
+    profiler.dump_stats(base + ".prof.tmp")
+    os.replace(base + ".prof.tmp", base + ".prof")
+    with open(base + ".json.tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(base + ".json.tmp", base + ".json")
+
+    # Ring buffer, drop the oldest past the limit
+    for old in list_profiles(directory)[keep:]:
+        for suffix in (".prof", ".json"):
+            try:
+                os.unlink(os.path.join(directory, old["id"] + suffix))
+            except FileNotFoundError:
+                pass
+
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global _busy
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        mode = _requested_mode(scope)
+        # _busy is checked after the await, nothing can slip in between
+        if mode is None or not await _is_admin(scope) or _busy:
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = uuid.uuid4().hex
+        root_path = scope.get("root_path", "")
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if mode == "store":
+                    MutableHeaders(scope=message).append("X-Profile-Id", profile_id)
+            if mode == "store":
+                await send(message)
+
+        _busy = True
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profiler.disable()
+            _busy = False
+        elapsed = time.perf_counter() - start
+
+        if mode == "inline":
+            response = PlainTextResponse(
+                f"{scope['method']} {scope['path']} -> {status} in {elapsed * 1000:.1f}ms\n\n" + report(profiler)
+            )
+            await response(scope, receive, send)
+            return
+
+        meta = {
+            "id": profile_id,
+            "created": time.time(),
+            "method": scope["method"],
+            "path": scope["path"],
+            "route": metrics.route_template(scope, root_path),
+            "status": status,
+            "duration_ms": round(elapsed * 1000, 3),
+        }
+        await run_in_threadpool(_store, profiler, meta, PROFILE_DIR, PROFILE_KEEP)
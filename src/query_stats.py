@@ -0,0 +1,115 @@
+"""
+Per-request SQL statistics.
+
+SQLAlchemy cursor events count every statement and its time into the
+QueryStats of the current request, found through a contextvar that
+MetricsMiddleware sets. The contextvar follows the request into
+threadpool dependencies and streamed bodies, and the async engine fires
+the same events, so every engine is covered.
+
+The totals end up in the Server-Timing response header, which browser
+dev tools show next to the request, and in the /metrics histograms. A
+request running the same statement more than QUERY_REPEAT_THRESHOLD
+times (default 10) is logged as a likely N+1 query.
+
+Tests can capture() the stats of every request to hold an endpoint to a
+query budget, see testing/utils.query_budget.
+"""
+
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+log = logging.getLogger(__name__)
+
+QUERY_REPEAT_THRESHOLD = int(os.getenv("QUERY_REPEAT_THRESHOLD", 10))
+
+
+class QueryStats:
+    __slots__ = ("count", "duration", "statements")
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        # Statement text -> times run, parameters are bound separately
+        # so an N+1 loop shows up as one statement with a big count
+        self.statements: dict[str, int] = {}
+
+    def record(self, statement: str, elapsed: float):
+        self.count += 1
+        self.duration += elapsed
+        self.statements[statement] = self.statements.get(statement, 0) + 1
+
+    def repeated(self, threshold: Optional[int] = None) -> list[tuple[str, int]]:
+        threshold = threshold or QUERY_REPEAT_THRESHOLD
+        return [(statement, count) for statement, count in self.statements.items() if count > threshold]
+
+    def server_timing(self) -> str:
+        return f'db;dur={self.duration * 1000:.2f};desc="{self.count} queries"'
+
+
+_current: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+_captures: list[list] = []
+
+
+def begin(stats: QueryStats) -> Token:
+    return _current.set(stats)
+
+
+def end(token: Token):
+    _current.reset(token)
+
+
+def current() -> Optional[QueryStats]:
+    return _current.get()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    starts = conn.info.get("query_start")
+    if stats is not None and starts:
+        stats.record(statement, time.perf_counter() - starts.pop())
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("query_start"):
+        conn.info["query_start"].pop()
+
+
+def finish(route: str, stats: QueryStats):
+    """
+    Called by the middleware once a request is done.
+    """
+    for statement, count in stats.repeated():
+        log.warning("Possible N+1 on %s: statement ran %d times: %s", route, count, statement)
+    for captured in _captures:
+        captured.append((route, stats))
+
+
+@contextmanager
+def capture():
+    """
+    Collect (route, QueryStats) for every request finished inside the block.
+    """
+    captured = []
+    _captures.append(captured)
+    try:
+        yield captured
+    finally:
+        _captures.remove(captured)
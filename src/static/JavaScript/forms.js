@@ -0,0 +1,65 @@
+// Shared fetch-and-submit logic for the JSON forms (challenge flags etc)
+//
+// A form opts in with data attributes:
+//   data-submit-url   where the form data is POSTed as JSON (required)
+//   data-feedback     id of the element that shows the result message
+//   data-redirect     page to go to on success, stays on the page if left out
+//   data-success      message shown on success
+document.addEventListener("DOMContentLoaded", function () {
+    document.querySelectorAll("form[data-submit-url]").forEach(function (form) {
+        const feedbackMessage = document.getElementById(form.dataset.feedback || "feedbackMessage");
+        const submitBtn = form.querySelector("[type=submit]");
+
+        function showMessage(text, color) {
+            if (feedbackMessage) {
+                feedbackMessage.textContent = text;
+                feedbackMessage.style.color = color;
+            }
+        }
+
+        form.addEventListener("submit", function (event) {
+            event.preventDefault(); // Prevent default form submission (through page reloading)
+            showMessage("Submitting...", "");
+
+            // Create a JSON object from the form data
+            const data = {};
+            new FormData(form).forEach((value, key) => {
+                data[key] = value;
+            });
+
+            fetch(form.dataset.submitUrl, {
+                method: "POST",
+                headers: {
+                    "Content-Type": "application/json"
+                },
+                body: JSON.stringify(data),
+            })
+                .then(response => response.json())
+                .then(data => {
+                    if (data.success) {
+                        showMessage(form.dataset.success || data.message || "Submitted!", "green");
+                        const redirect = data.redirect_url || form.dataset.redirect;
+                        if (redirect) {
+                            window.location.href = redirect;
+                        }
+                    } else {
+                        showMessage(data.message || data.detail || "An error occurred. Please try again.", "red");
+                    }
+                })
+                .catch(error => {
+                    console.error("Error:", error);
+                    showMessage("An error occurred. Please try again.", "red");
+                })
+                .finally(() => {
+                    if (submitBtn) {
+                        submitBtn.disabled = false;
+                    }
+                });
+
+            // Disable the submit button to prevent multiple clicks
+            if (submitBtn) {
+                submitBtn.disabled = true;
+            }
+        });
+    });
+});
@@ -1,13 +1,20 @@
 import uuid
-from http.client import HTTPException
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 from sqlmodel import Session, select
 from pydantic import BaseModel
 from typing import Optional
 from src import database
+from src import profiling
 from src.users import models
+from src.users import flag_index
+from src.users import bulk_import
+from src.users.leaderboard import leaderboard
 from src.auth import service as auth_service
+from src.auth import hashing
+from src.auth import cache as auth_cache
+from src.auth import epochs as token_epochs
 
 router = APIRouter()
 
@@ -57,6 +64,7 @@ async def create_challenge(
     session.add(challenge)
     session.commit()
     session.refresh(challenge)
+    flag_index.changed(session)
     return {"message": "Challenge created", "challenge": challenge}
 
 @router.patch("/challenges/{challenge_id}")
@@ -76,6 +84,7 @@ async def update_challenge(
     session.add(challenge)
     session.commit()
     session.refresh(challenge)
+    flag_index.changed(session)
     return {"message": "Challenge updated", "challenge": challenge}
 
 @router.delete("/challenges/{challenge_id}")
@@ -90,6 +99,7 @@ async def delete_challenge(
 
     session.delete(challenge)
     session.commit()
+    flag_index.changed(session)
     return {"message": "Challenge deleted"}
 
 @router.post("/seed-challenges")
@@ -151,6 +161,7 @@ async def seed_challenges(
             skipped.append(c["title"])
 
     session.commit()
+    flag_index.changed(session)
 
     return {
         "message": "Seeding complete.",
@@ -164,7 +175,7 @@ async def create_user(
         session: Session = Depends(database.get_session),
         admin=Depends(auth_service.get_current_admin)
 ):
-    hashed_pw = models.hash_password(data.password)
+    hashed_pw = await hashing.hash_password(data.password)
     user = models.User(
         username=data.username,
         email=data.email,
@@ -175,8 +186,30 @@ async def create_user(
     session.add(user)
     session.commit()
     session.refresh(user)
+    leaderboard.add_player(user.id, user.username, user.country, user.score)
     return {"message": "User created", "user": user}
 
+@router.post("/users/import")
+async def import_users(
+        request: Request,
+        format: Optional[str] = None,
+        session: Session = Depends(database.get_session),
+        admin=Depends(auth_service.get_current_admin)
+):
+    """
+    Create users in bulk from a CSV or JSON body, streams back an NDJSON
+    line per row, see bulk_import.py
+    """
+    try:
+        content = await bulk_import.read_body(request)
+        rows = bulk_import.parse(content, format or bulk_import.format_for(request.headers.get("content-type", "")))
+    except bulk_import.ImportRejected as exc:
+        raise HTTPException(status_code=exc.status_code, detail=exc.detail)
+    return StreamingResponse(
+        bulk_import.report_lines(session.get_bind(), rows),
+        media_type="application/x-ndjson",
+    )
+
 @router.patch("/users/{user_id}")
 async def update_user(
         user_id: str,
@@ -189,15 +222,21 @@ async def update_user(
         raise HTTPException(status_code=404, detail="User not found")
 
     update_data = data.dict(exclude_unset=True)
+    # Role, status and password changes revoke the user's existing tokens
+    revoke = any(key in update_data for key in ("is_admin", "is_active", "password"))
     if "password" in update_data:
-        update_data["password"] = auth_service.hash_password(update_data["password"])
+        update_data["password"] = await hashing.hash_password(update_data["password"])
 
     for key, value in update_data.items():
         setattr(user, key, value)
+    if revoke:
+        token_epochs.bump(user)
 
     session.add(user)
     session.commit()
     session.refresh(user)
+    auth_cache.invalidate_user(user_id)
+    leaderboard.update_player(user_id, username=user.username)
     return {"message": "User updated", "user": user}
 
 @router.delete("/users/{user_id}")
@@ -212,8 +251,41 @@ async def delete_user(
 
     session.delete(user)
     session.commit()
+    # Without the row its tokens no longer validate
+    auth_cache.invalidate_user(user_id)
+    leaderboard.remove_player(user_id)
     return {"message": "User deleted"}
 
+@router.get("/cache-stats")
+async def cache_stats(admin=Depends(auth_service.get_current_admin)):
+    """
+    Hit / miss counters for the auth token and user caches
+    """
+    return auth_cache.stats()
+
+@router.get("/profiles")
+async def list_profiles(admin=Depends(auth_service.get_current_admin)):
+    """
+    Requests profiled with the X-Profile header, newest first
+    """
+    return profiling.list_profiles()
+
+@router.get("/profiles/{profile_id}")
+async def download_profile(
+        profile_id: str,
+        format: str = "prof",
+        admin=Depends(auth_service.get_current_admin)
+):
+    """
+    A saved profile, as the raw pstats file or with format=text as a report
+    """
+    path = profiling.profile_path(profile_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "text":
+        return PlainTextResponse(profiling.report(path))
+    return FileResponse(path, media_type="application/octet-stream", filename=f"{profile_id}.prof")
+
 
 # -----------------------
 # Review Routes
@@ -0,0 +1,148 @@
+"""
+Resized avatar variants.
+
+Avatars are shown at 32-120px but uploaded at whatever size the camera
+produced. After an upload the picture is cropped square and resized to
+each of AVATAR_SIZES, and the variants are stored on User.avatar_variants
+as {"64": "ab/cd/<sha256>_64.webp", ...}, next to the original.
+Templates use avatar_url / avatar_srcset to pick the smallest variant
+that fits.
+
+Resizing is CPU bound, so it runs in a process pool. A small file can
+still decode to a huge bitmap, so pictures over AVATAR_MAX_PIXELS get no
+variants, checked from their header before anything is decoded.
+
+    AVATAR_SIZES        comma separated pixel sizes (default 64,128,256)
+    AVATAR_FORMAT       "webp" (default) or "jpeg"
+    AVATAR_WORKERS      processes in the pool (default 2)
+    AVATAR_MAX_PIXELS   largest width * height decoded (default 25 million)
+
+Pillow is needed to build variants. Without it, or for an image Pillow
+cannot read, the user just keeps the original picture.
+"""
+
+import asyncio
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # variants are skipped, originals are served
+    Image = None
+
+from src.users import uploads
+
+log = logging.getLogger(__name__)
+
+AVATAR_SIZES = tuple(sorted(int(size) for size in os.getenv("AVATAR_SIZES", "64,128,256").split(",")))
+AVATAR_FORMAT = os.getenv("AVATAR_FORMAT", "webp").lower()
+AVATAR_WORKERS = int(os.getenv("AVATAR_WORKERS", 2))
+AVATAR_MAX_PIXELS = int(os.getenv("AVATAR_MAX_PIXELS", 25_000_000))
+
+_EXTENSIONS = {"webp": ".webp", "jpeg": ".jpg"}
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def _render_variants(source: str, directory: str, stem: str, sizes: tuple, fmt: str, max_pixels: int) -> dict:
+    # Module level so the process pool can pickle it
+    with Image.open(source) as original:
+        # open only reads the header, check before the pixels are decoded
+        width, height = original.size
+        if width * height > max_pixels:
+            raise ValueError(f"{width}x{height} is over AVATAR_MAX_PIXELS")
+        smallest_side = min(original.size)
+        # Don't upscale, a small upload only gets the smallest variant
+        wanted = [size for size in sizes if size <= smallest_side] or [sizes[0]]
+        variants = {str(size): f"{stem}_{size}{_EXTENSIONS[fmt]}" for size in wanted}
+        # Uploads are content addressed, so existing variants are current,
+        # bump their mtime like save_image does for the original so the
+        # GC grace period covers them too
+        missing = []
+        for size in wanted:
+            try:
+                os.utime(os.path.join(directory, variants[str(size)]))
+            except FileNotFoundError:
+                missing.append(size)
+        if not missing:
+            return variants
+        image = ImageOps.exif_transpose(original)
+        image = image.convert("RGBA" if fmt == "webp" and "A" in image.getbands() else "RGB")
+
+    for size in missing:
+        resized = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        target = os.path.join(directory, variants[str(size)])
+        tmp_path = os.path.join(os.path.dirname(target), f".{os.path.basename(target)}.{os.getpid()}.tmp")
+        resized.save(tmp_path, format=fmt.upper(), quality=82)
+        os.replace(tmp_path, target)
+    return variants
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=AVATAR_WORKERS)
+    return _executor
+
+
+def shutdown():
+    """
+    Stop the pool, called from the app lifespan on shutdown.
+    """
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def generate(filename: str, directory: Optional[str] = None) -> Optional[dict]:
+    """
+    Build the variants of an uploaded picture, None if there are none.
+    """
+    if Image is None:
+        return None
+    directory = directory or uploads.UPLOAD_DIR
+    stem = os.path.splitext(filename)[0]
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(
+            get_executor(), _render_variants,
+            os.path.join(directory, filename), directory, stem, AVATAR_SIZES, AVATAR_FORMAT, AVATAR_MAX_PIXELS,
+        )
+    except Exception:
+        log.warning("Could not build avatar variants for %s", filename, exc_info=True)
+        return None
+
+
+def avatar_url(picture: Optional[str], variants: Optional[dict], size: int) -> Optional[str]:
+    """
+    URL of the smallest variant at least size pixels wide, falling back
+    to the largest variant and then the original.
+    """
+    if not picture:
+        return None
+    if variants:
+        fitting = sorted((int(width), name) for width, name in variants.items())
+        for width, name in fitting:
+            if width >= size:
+                return "/uploads/" + name
+        return "/uploads/" + fitting[-1][1]
+    return "/uploads/" + picture
+
+
+def avatar_srcset(variants: Optional[dict]) -> str:
+    if not variants:
+        return ""
+    return ", ".join(
+        f"/uploads/{name} {width}w" for width, name in sorted((int(w), n) for w, n in variants.items())
+    )
+
+
+def install(templates):
+    """
+    Make avatar_url and avatar_srcset available to a Jinja2Templates instance.
+    """
+    templates.env.globals["avatar_url"] = avatar_url
+    templates.env.globals["avatar_srcset"] = avatar_srcset
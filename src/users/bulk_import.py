@@ -0,0 +1,330 @@
+"""
+Bulk user import, for onboarding a whole class or company at once.
+
+The file is CSV with a header row, or a JSON array of objects, with the
+fields username, email, password and optionally country, is_admin and
+is_active (true / false, 1 / 0, yes / no). Admins send it to
+
+    POST /api/admin/users/import        (?format=csv|json, else the Content-Type)
+
+or, on the server, run
+
+    python -m src.users.bulk_import cohort.csv
+
+Every row is checked before anything is written: required fields,
+duplicates inside the file, and usernames or emails already taken,
+the latter in one query for the whole file. Names are compared exactly,
+case included, as login and signup compare them, so "Alice" and "alice"
+are two different users. Passwords of the rows that
+pass are hashed on the bulk process pool (hashing.hash_passwords) and
+the users go in IMPORT_CHUNK_SIZE rows per transaction, so one bad
+chunk never undoes the others.
+
+The result is one JSON line per row, streamed as the chunks commit, and
+a summary at the end. Row numbers count data rows from 1, the CSV
+header is not a row:
+
+    {"row": 2, "username": "bob", "status": "error", "error": "Email already taken"}
+    {"row": 1, "username": "alice", "status": "created", "id": "..."}
+    {"summary": {"rows": 2, "created": 1, "failed": 1}}
+
+    IMPORT_MAX_ROWS     largest file accepted, in rows (default 10000),
+                        over 499 needs SQLite 3.32 or newer, see validate
+    IMPORT_MAX_BYTES    largest file accepted, in bytes (default 5MB)
+    IMPORT_CHUNK_SIZE   users per transaction (default 500)
+"""
+
+import csv
+import io
+import json
+import logging
+import os
+import uuid
+from datetime import datetime
+from typing import AsyncIterator, NamedTuple, Optional
+
+from sqlalchemy import insert, or_
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+from starlette.concurrency import run_in_threadpool
+
+from src.auth import hashing
+from src.users import models
+from src.users.leaderboard import leaderboard
+
+log = logging.getLogger(__name__)
+
+IMPORT_MAX_ROWS = int(os.getenv("IMPORT_MAX_ROWS", 10_000))
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", 5 * 1024 * 1024))
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", 500))
+
+REQUIRED_FIELDS = ("username", "email", "password")
+FORMATS = ("csv", "json")
+
+_TRUE = {"1", "true", "yes", "y"}
+_FALSE = {"0", "false", "no", "n", ""}
+
+
+class ImportRejected(Exception):
+    def __init__(self, status_code: int, detail: str):
+        self.status_code = status_code
+        self.detail = detail
+
+
+class ImportRow(NamedTuple):
+    row: int
+    username: str
+    email: str
+    password: str
+    country: Optional[str]
+    is_admin: bool
+    is_active: bool
+
+
+def format_for(content_type: str) -> str:
+    """
+    csv or json from a Content-Type header, CSV unless it says JSON.
+    """
+    return "json" if "json" in content_type.lower() else "csv"
+
+
+async def read_body(request) -> bytes:
+    """
+    The request body, refused with 413 as soon as it passes IMPORT_MAX_BYTES.
+    """
+    content = bytearray()
+    async for chunk in request.stream():
+        content += chunk
+        if len(content) > IMPORT_MAX_BYTES:
+            raise ImportRejected(413, f"File is larger than {IMPORT_MAX_BYTES} bytes")
+    return bytes(content)
+
+
+def parse(content: bytes, fmt: str) -> list[dict]:
+    """
+    The rows of an import file, raises ImportRejected if it is unreadable
+    or too big.
+    """
+    if len(content) > IMPORT_MAX_BYTES:
+        raise ImportRejected(413, f"File is larger than {IMPORT_MAX_BYTES} bytes")
+    if fmt not in FORMATS:
+        raise ImportRejected(400, f"Unknown format {fmt!r}, use csv or json")
+    try:
+        # utf-8-sig drops the byte order mark spreadsheets like to add
+        text = content.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise ImportRejected(400, "File is not UTF-8")
+
+    if fmt == "json":
+        try:
+            rows = json.loads(text)
+        except ValueError as exc:
+            raise ImportRejected(400, f"Invalid JSON: {exc}")
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ImportRejected(400, "JSON must be an array of objects")
+    else:
+        reader = csv.DictReader(io.StringIO(text))
+        missing = [field for field in REQUIRED_FIELDS if field not in (reader.fieldnames or ())]
+        if missing:
+            raise ImportRejected(400, f"CSV header is missing {', '.join(missing)}")
+        rows = list(reader)
+
+    if len(rows) > IMPORT_MAX_ROWS:
+        raise ImportRejected(413, f"File has more than {IMPORT_MAX_ROWS} rows")
+    return rows
+
+
+def _flag(value, default: bool) -> bool:
+    if value is None:
+        return default
+    if isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value in _TRUE:
+        return True
+    if value in _FALSE:
+        return False if value else default
+    raise ValueError(f"not a true / false value: {value!r}")
+
+
+def _error(row: int, username, message: str) -> dict:
+    return {"row": row, "username": username, "status": "error", "error": message}
+
+
+def validate(session: Session, rows: list[dict]) -> tuple[list[ImportRow], list[dict]]:
+    """
+    Split rows into those that can be created and error lines for the
+    rest. Existing users are looked up in a single query, matching names
+    exactly like login does.
+    """
+    candidates = []
+    errors = []
+    seen_usernames = set()
+    seen_emails = set()
+    for number, raw in enumerate(rows, start=1):
+        username = str(raw.get("username") or "").strip()
+        email = str(raw.get("email") or "").strip()
+        password = raw.get("password")
+        if not username or not email or not password:
+            errors.append(_error(number, username or None, "username, email and password are required"))
+            continue
+        if "@" not in email:
+            errors.append(_error(number, username, "Invalid email"))
+            continue
+        try:
+            is_admin = _flag(raw.get("is_admin"), False)
+            is_active = _flag(raw.get("is_active"), True)
+        except ValueError as exc:
+            errors.append(_error(number, username, str(exc)))
+            continue
+        if username in seen_usernames:
+            errors.append(_error(number, username, "Duplicate username in file"))
+            continue
+        if email in seen_emails:
+            errors.append(_error(number, username, "Duplicate email in file"))
+            continue
+        seen_usernames.add(username)
+        seen_emails.add(email)
+        country = str(raw.get("country") or "").strip() or None
+        candidates.append(ImportRow(number, username, email, str(password), country, is_admin, is_active))
+
+    taken_usernames = set()
+    taken_emails = set()
+    if candidates:
+        # Two parameters per row at most. SQLite 3.32+ allows 32766 bound
+        # variables, so the default IMPORT_MAX_ROWS fits, older versions
+        # stop at 999
+        taken = session.exec(
+            select(models.User.username, models.User.email).where(
+                or_(
+                    models.User.username.in_(seen_usernames),
+                    models.User.email.in_(seen_emails),
+                )
+            )
+        ).all()
+        taken_usernames = {username for username, _ in taken}
+        taken_emails = {email for _, email in taken}
+
+    valid = []
+    for row in candidates:
+        if row.username in taken_usernames:
+            errors.append(_error(row.row, row.username, "Username already taken"))
+        elif row.email in taken_emails:
+            errors.append(_error(row.row, row.username, "Email already taken"))
+        else:
+            valid.append(row)
+    return valid, errors
+
+
+def _validate(bind: Engine, rows: list[dict]) -> tuple[list[ImportRow], list[dict]]:
+    with Session(bind) as session:
+        return validate(session, rows)
+
+
+def _insert_chunk(bind: Engine, chunk: list[ImportRow], hashes: list[str]) -> list[dict]:
+    """
+    Insert one chunk in one transaction, returns a report line per row.
+    """
+    now = datetime.utcnow()
+    users = [
+        {
+            "id": str(uuid.uuid4()), "username": row.username, "email": row.email, "password": hashed,
+            "country": row.country, "is_admin": row.is_admin, "is_active": row.is_active,
+            "created_at": now, "score": 0,
+        }
+        for row, hashed in zip(chunk, hashes)
+    ]
+    failed = set()
+    with Session(bind) as session:
+        try:
+            session.connection().execute(insert(models.User), users)
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+            # Somebody took one of the names since validate, go row by row
+            # to find out which
+            for user in users:
+                try:
+                    session.connection().execute(insert(models.User), [user])
+                    session.commit()
+                except IntegrityError:
+                    session.rollback()
+                    failed.add(user["id"])
+
+    lines = []
+    for row, user in zip(chunk, users):
+        if user["id"] in failed:
+            lines.append(_error(row.row, row.username, "Username or email already taken"))
+        else:
+            leaderboard.add_player(user["id"], row.username, row.country)
+            lines.append({"row": row.row, "username": row.username, "status": "created", "id": user["id"]})
+    return lines
+
+
+async def run_import(bind: Engine, rows: list[dict]) -> AsyncIterator[dict]:
+    """
+    Validate, hash and insert, yielding the report as it goes.
+    """
+    valid, errors = await run_in_threadpool(_validate, bind, rows)
+    for line in errors:
+        yield line
+
+    created = 0
+    for start in range(0, len(valid), IMPORT_CHUNK_SIZE):
+        chunk = valid[start:start + IMPORT_CHUNK_SIZE]
+        hashes = await hashing.hash_passwords([row.password for row in chunk])
+        for line in await run_in_threadpool(_insert_chunk, bind, chunk, hashes):
+            created += line["status"] == "created"
+            yield line
+
+    log.info("Bulk import created %d of %d user(s)", created, len(rows))
+    yield {"summary": {"rows": len(rows), "created": created, "failed": len(rows) - created}}
+
+
+async def report_lines(bind: Engine, rows: list[dict]) -> AsyncIterator[str]:
+    """
+    run_import as NDJSON, for a StreamingResponse.
+    """
+    async for line in run_import(bind, rows):
+        yield json.dumps(line) + "\n"
+
+
+def main(argv=None):
+    import argparse
+    import asyncio
+    import sys
+
+    from src import database
+
+    parser = argparse.ArgumentParser(description="Create users in bulk from a CSV or JSON file")
+    parser.add_argument("path", help="file to import")
+    parser.add_argument("--format", choices=FORMATS, help="default: from the file extension")
+    args = parser.parse_args(argv)
+
+    fmt = args.format or ("json" if args.path.lower().endswith(".json") else "csv")
+    with open(args.path, "rb") as f:
+        try:
+            rows = parse(f.read(), fmt)
+        except ImportRejected as exc:
+            sys.exit(exc.detail)
+
+    database.create_db_and_tables()
+
+    async def run():
+        summary = {}
+        async for line in report_lines(database.engine, rows):
+            sys.stdout.write(line)
+            summary = json.loads(line).get("summary", summary)
+        return summary
+
+    try:
+        summary = asyncio.run(run())
+    finally:
+        hashing.shutdown()
+    if summary.get("failed"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+In-memory flag index.
+
+Wrong guesses are by far the most common request during a competition,
+so submit_flag checks flags against this dict instead of querying the
+challenge table. Flags are stored as an HMAC under a per-process random
+key, so the plaintext flags are not kept around in memory.
+
+The index is built at startup and rebuilt by every admin route that
+changes challenges, through changed(), which also bumps the counter row
+in flag_index_version. Each process compares a cheap stamp (that
+counter plus MAX(id) and COUNT(*) of challenge, so rows added or removed
+behind the app's back count too) at most every FLAG_INDEX_CHECK_INTERVAL
+seconds (default 1) and rebuilds when it moved. With several workers a
+change made through one reaches the others within that interval.
+"""
+
+import hashlib
+import hmac
+import os
+import threading
+import time
+from typing import NamedTuple, Optional
+
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src.users import models
+
+FLAG_INDEX_CHECK_INTERVAL = float(os.getenv("FLAG_INDEX_CHECK_INTERVAL", 1))
+
+_STAMP_SQL = (
+    "SELECT (SELECT version FROM flag_index_version WHERE id = 1), "
+    "(SELECT MAX(id) FROM challenge), (SELECT COUNT(*) FROM challenge)"
+)
+
+_key = os.urandom(32)
+_index: Optional[dict] = None
+_stamp: Optional[tuple] = None
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+class FlagEntry(NamedTuple):
+    challenge_id: int
+    points: int
+
+
+def _digest(flag: str) -> bytes:
+    return hmac.new(_key, flag.encode("utf-8"), hashlib.sha256).digest()
+
+
+def _read_stamp(session: Session) -> tuple:
+    return tuple(session.connection().exec_driver_sql(_STAMP_SQL).one())
+
+
+def rebuild(session: Session):
+    """
+    Reload every challenge flag from the database.
+    """
+    global _index, _stamp, _checked_at
+    # Stamp first, a change landing in between only costs another rebuild
+    stamp = _read_stamp(session)
+    rows = session.exec(
+        select(models.Challenge.id, models.Challenge.points, models.Challenge.flag)
+    ).all()
+    index = {_digest(flag): FlagEntry(challenge_id, points) for challenge_id, points, flag in rows}
+    # Swap the whole dict so readers never see a half built index
+    with _lock:
+        _index = index
+        _stamp = stamp
+        _checked_at = time.monotonic()
+
+
+def changed(session: Session):
+    """
+    Call after committing a change to challenges: tells the other
+    workers through the version row and rebuilds this one's index.
+    """
+    # A transaction of its own, committing the caller's session would
+    # expire the objects it is about to return
+    with session.get_bind().begin() as conn:
+        conn.exec_driver_sql("UPDATE flag_index_version SET version = version + 1 WHERE id = 1")
+    rebuild(session)
+
+
+def _due() -> bool:
+    return _index is None or time.monotonic() - _checked_at >= FLAG_INDEX_CHECK_INTERVAL
+
+
+def _refresh(session: Session):
+    global _checked_at
+    if _index is None or _read_stamp(session) != _stamp:
+        rebuild(session)
+    else:
+        _checked_at = time.monotonic()
+
+
+def lookup(session: Session, flag: str) -> Optional[FlagEntry]:
+    """
+    Find the challenge a flag belongs to, or None for a wrong flag.
+
+    The session is only used to check the stamp and rebuild the index.
+    """
+    if _due():
+        _refresh(session)
+    return _index.get(_digest(flag))
+
+
+async def lookup_async(session: AsyncSession, flag: str) -> Optional[FlagEntry]:
+    """
+    lookup for an AsyncSession.
+    """
+    if _due():
+        await session.run_sync(_refresh)
+    return _index.get(_digest(flag))
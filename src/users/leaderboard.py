@@ -0,0 +1,413 @@
+"""
+Leaderboard engine.
+
+Players are kept in memory ordered by (score desc, last solve time asc),
+ties after that are broken by user id so every player has a distinct
+position. The ordering lives in an indexable skip list, giving O(log n)
+updates, rank lookups and page offsets however many players there are.
+
+The board is loaded from User / ChallengeSolve on startup and updated by
+the routes as solves come in. User.rank is only a persisted copy of the
+board, written in batches by persist_ranks rather than on every solve,
+since a single solve can shift the rank of everyone below that player.
+The board remembers which range of positions moved since the last
+write, so a quiet tick costs nothing and a solve only rewrites the
+players it overtook.
+
+The board is per process and assumes a single worker. With several,
+each one only sees the solves and sign-ups it served itself, and their
+persist_ranks would overwrite each other's User.rank.
+"""
+
+import asyncio
+import logging
+import math
+import os
+import random
+import threading
+import uuid
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import bindparam, func, update
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src import database
+from src.users import models
+
+log = logging.getLogger(__name__)
+
+# Seconds between writes of User.rank
+LEADERBOARD_PERSIST_INTERVAL = float(os.getenv("LEADERBOARD_PERSIST_INTERVAL", 30))
+
+
+class _End:
+    """
+    Sentinel that sorts after every key.
+    """
+
+    def __lt__(self, other):
+        return False
+
+    def __le__(self, other):
+        return False
+
+
+class _Node:
+    __slots__ = ("key", "next", "width")
+
+    def __init__(self, key, levels: int):
+        self.key = key
+        self.next = [None] * levels
+        # width[level] is how many bottom level steps next[level] skips
+        self.width = [1] * levels
+
+
+class RankedSkipList:
+    """
+    Sorted container with positional access.
+
+    Keys must be unique and mutually comparable.
+    """
+
+    def __init__(self, max_levels: int = 24):
+        self.max_levels = max_levels
+        self.size = 0
+        self._end = _Node(_End(), 0)
+        self._head = _Node(None, max_levels)
+        self._head.next = [self._end] * max_levels
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def from_sorted(cls, keys: list, max_levels: int = 24) -> "RankedSkipList":
+        """
+        Build in O(n) from keys that are already sorted.
+        """
+        skiplist = cls(max_levels)
+        last = [skiplist._head] * max_levels
+        last_position = [0] * max_levels
+        for position, key in enumerate(keys, start=1):
+            node = _Node(key, skiplist._random_levels())
+            for level in range(len(node.next)):
+                last[level].next[level] = node
+                last[level].width[level] = position - last_position[level]
+                last[level] = node
+                last_position[level] = position
+        for level in range(max_levels):
+            last[level].next[level] = skiplist._end
+            last[level].width[level] = len(keys) + 1 - last_position[level]
+        skiplist.size = len(keys)
+        return skiplist
+
+    def _random_levels(self) -> int:
+        return min(self.max_levels, 1 - int(math.log(1.0 - random.random(), 2.0)))
+
+    def insert(self, key):
+        chain = [None] * self.max_levels
+        steps_at_level = [0] * self.max_levels
+        node = self._head
+        for level in reversed(range(self.max_levels)):
+            while node.next[level].key < key:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+
+        levels = self._random_levels()
+        new_node = _Node(key, levels)
+        steps = 0
+        for level in range(levels):
+            prev = chain[level]
+            new_node.next[level] = prev.next[level]
+            prev.next[level] = new_node
+            new_node.width[level] = prev.width[level] - steps
+            prev.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(levels, self.max_levels):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self, key):
+        chain = [None] * self.max_levels
+        node = self._head
+        for level in reversed(range(self.max_levels)):
+            while node.next[level].key < key:
+                node = node.next[level]
+            chain[level] = node
+
+        target = chain[0].next[0]
+        if target is self._end or target.key != key:
+            raise KeyError(key)
+
+        for level in range(len(target.next)):
+            prev = chain[level]
+            prev.width[level] += target.width[level] - 1
+            prev.next[level] = target.next[level]
+        for level in range(len(target.next), self.max_levels):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+    def index(self, key) -> int:
+        """
+        Number of keys that sort before key.
+        """
+        node = self._head
+        position = 0
+        for level in reversed(range(self.max_levels)):
+            while node.next[level].key < key:
+                position += node.width[level]
+                node = node.next[level]
+        return position
+
+    def slice(self, offset: int, limit: int) -> list:
+        if offset >= self.size or limit <= 0:
+            return []
+        node = self._head
+        remaining = offset + 1
+        for level in reversed(range(self.max_levels)):
+            while node.width[level] <= remaining:
+                remaining -= node.width[level]
+                node = node.next[level]
+
+        keys = []
+        while node is not self._end and len(keys) < limit:
+            keys.append(node.key)
+            node = node.next[0]
+        return keys
+
+    def __iter__(self):
+        node = self._head.next[0]
+        while node is not self._end:
+            yield node.key
+            node = node.next[0]
+
+
+def _sort_key(user_id: str, score: int, last_solve: Optional[datetime]) -> tuple:
+    # Higher score first, then whoever got there first, players with no
+    # solves go after everyone on the same score
+    return (-score, last_solve.timestamp() if last_solve else math.inf, user_id)
+
+
+class Leaderboard:
+    """
+    Ranked view of every player.
+
+    Mutators are no-ops until the board has been loaded, since loading
+    reads the current state from the database anyway.
+    """
+
+    def __init__(self):
+        self._ranking = RankedSkipList()
+        self._keys: dict[str, tuple] = {}
+        self._players: dict[str, dict] = {}
+        self._persisted: dict[str, Optional[int]] = {}
+        # 1 based positions whose player may have changed since the last
+        # persist_ranks, (low, high) inclusive or None for no change
+        self._dirty: Optional[tuple[int, int]] = None
+        self._lock = threading.RLock()
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._ranking)
+
+    def _mark_dirty(self, low: int, high: int):
+        if low > high:
+            return
+        if self._dirty is not None:
+            low, high = min(low, self._dirty[0]), max(high, self._dirty[1])
+        self._dirty = (low, high)
+
+    def load(self, session: Session):
+        """
+        (Re)build the board from the database.
+        """
+        last_solves = dict(
+            session.exec(
+                select(models.ChallengeSolve.user_id, func.max(models.ChallengeSolve.solved_at))
+                .group_by(models.ChallengeSolve.user_id)
+            ).all()
+        )
+        rows = session.exec(
+            select(
+                models.User.id,
+                models.User.username,
+                models.User.country,
+                models.User.score,
+                models.User.rank,
+            )
+        ).all()
+
+        with self._lock:
+            self._keys.clear()
+            self._players.clear()
+            self._persisted.clear()
+            for user_id, username, country, score, rank in rows:
+                score = score or 0
+                last_solve = last_solves.get(_as_uuid(user_id))
+                self._keys[user_id] = _sort_key(user_id, score, last_solve)
+                self._players[user_id] = {"username": username, "country": country, "score": score}
+                self._persisted[user_id] = rank
+            self._ranking = RankedSkipList.from_sorted(sorted(self._keys.values()))
+            self._dirty = None
+            # Stored ranks may be stale or missing, compare everyone once
+            self._mark_dirty(1, len(self._ranking))
+            self.loaded = True
+
+    def ensure_loaded(self, session: Session):
+        if not self.loaded:
+            self.load(session)
+
+    async def ensure_loaded_async(self, session: AsyncSession):
+        if not self.loaded:
+            await session.run_sync(self.load)
+
+    def _insert(self, user_id, score, last_solve, username, country):
+        key = _sort_key(user_id, score, last_solve)
+        self._ranking.insert(key)
+        self._keys[user_id] = key
+        self._players[user_id] = {"username": username, "country": country, "score": score}
+        # The new player and everyone below moved
+        self._mark_dirty(self._ranking.index(key) + 1, len(self._ranking))
+
+    def add_player(self, user_id, username: str, country: Optional[str] = None, score: int = 0):
+        user_id = str(user_id)
+        with self._lock:
+            if not self.loaded or user_id in self._keys:
+                return
+            self._insert(user_id, score, None, username, country)
+
+    def update_player(self, user_id, **fields):
+        """
+        Update display fields (username, country) for a player.
+        """
+        with self._lock:
+            player = self._players.get(str(user_id))
+            if player is not None:
+                player.update({k: v for k, v in fields.items() if k in ("username", "country")})
+
+    def remove_player(self, user_id):
+        user_id = str(user_id)
+        with self._lock:
+            key = self._keys.pop(user_id, None)
+            if key is not None:
+                position = self._ranking.index(key) + 1
+                self._ranking.remove(key)
+                del self._players[user_id]
+                self._persisted.pop(user_id, None)
+                self._mark_dirty(position, len(self._ranking))
+
+    def record_solve(self, user_id, points: int, solved_at: datetime) -> Optional[tuple[int, int]]:
+        """
+        Apply a solve, returns the player's (old rank, new rank).
+        """
+        user_id = str(user_id)
+        with self._lock:
+            old_key = self._keys.get(user_id)
+            if old_key is None:
+                return None
+            old_rank = self._ranking.index(old_key) + 1
+            self._ranking.remove(old_key)
+
+            player = self._players[user_id]
+            player["score"] += points
+            new_key = _sort_key(user_id, player["score"], solved_at)
+            self._ranking.insert(new_key)
+            self._keys[user_id] = new_key
+            new_rank = self._ranking.index(new_key) + 1
+            # Only the players between the old and new position moved
+            self._mark_dirty(min(old_rank, new_rank), max(old_rank, new_rank))
+            return old_rank, new_rank
+
+    def rank(self, user_id) -> Optional[int]:
+        """
+        1 based rank of a player, None if they are not on the board.
+        """
+        with self._lock:
+            key = self._keys.get(str(user_id))
+            if key is None:
+                return None
+            return self._ranking.index(key) + 1
+
+    def entry(self, user_id) -> Optional[dict]:
+        user_id = str(user_id)
+        with self._lock:
+            rank = self.rank(user_id)
+            if rank is None:
+                return None
+            return {"rank": rank, "id": user_id, **self._players[user_id]}
+
+    def page(self, offset: int, limit: int) -> list[dict]:
+        with self._lock:
+            keys = self._ranking.slice(offset, limit)
+            return [
+                {"rank": offset + i + 1, "id": key[2], **self._players[key[2]]}
+                for i, key in enumerate(keys)
+            ]
+
+    def persist_ranks(self, session: Session) -> int:
+        """
+        Write changed ranks back to User.rank, returns how many changed.
+
+        Only the positions that moved since the last call are looked at.
+        """
+        with self._lock:
+            if not self.loaded or self._dirty is None:
+                return 0
+            low, high = self._dirty
+            self._dirty = None
+            changed = []
+            keys = self._ranking.slice(low - 1, high - low + 1)
+            for position, key in enumerate(keys, start=low):
+                user_id = key[2]
+                if self._persisted.get(user_id) != position:
+                    changed.append({"user_id": user_id, "new_rank": position})
+
+        if changed:
+            try:
+                session.connection().execute(
+                    update(models.User)
+                    .where(models.User.id == bindparam("user_id"))
+                    .values(rank=bindparam("new_rank")),
+                    changed,
+                )
+                session.commit()
+            except Exception:
+                # Try the same range again next time
+                with self._lock:
+                    self._mark_dirty(low, high)
+                raise
+            with self._lock:
+                for row in changed:
+                    if row["user_id"] in self._keys:
+                        self._persisted[row["user_id"]] = row["new_rank"]
+        return len(changed)
+
+
+def _as_uuid(user_id: str):
+    # ChallengeSolve.user_id is a UUID column while User.id is a string
+    try:
+        return uuid.UUID(user_id)
+    except ValueError:
+        return None
+
+
+leaderboard = Leaderboard()
+
+
+def persist_now():
+    with Session(database.engine) as session:
+        return leaderboard.persist_ranks(session)
+
+
+async def persist_periodically(interval: float = LEADERBOARD_PERSIST_INTERVAL):
+    """
+    Background task started from the app lifespan.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(persist_now)
+        except Exception:
+            log.exception("Persisting leaderboard ranks failed")
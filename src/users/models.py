@@ -2,6 +2,7 @@ from datetime import datetime
 import uuid
 from operator import index
 from typing import Optional, List
+from sqlalchemy import JSON, Column, Index
 from sqlmodel import SQLModel, Field, Relationship
 from passlib.context import CryptContext
 
@@ -26,9 +27,13 @@ class User(SQLModel, table=True):
 
     is_admin: bool = Field(default=False)
     is_active: bool = Field(default=True)
+    # Tokens carry the epoch they were issued at, see auth/epochs.py
+    token_epoch: int = Field(default=0, sa_column_kwargs={"server_default": "0"})
 
     profile_bio: Optional[str] = None
     profile_picture: str | None = None
+    # Resized copies of profile_picture by width, see avatars.py
+    avatar_variants: Optional[dict] = Field(default=None, sa_column=Column(JSON))
     country: Optional[str] = None
 
     solved_challenges: List["ChallengeSolve"] = Relationship(back_populates="user")
@@ -97,6 +102,11 @@ class Challenge(SQLModel, table=True):
 Model for saving who has completed what challenge
 '''
 class ChallengeSolve(SQLModel, table=True):
+    # A user can only solve each challenge once, submit_flag relies on this
+    __table_args__ = (
+        Index("uq_challengesolve_user_challenge", "user_id", "challenge_id", unique=True),
+    )
+
     id: Optional[int] = Field(default=None, primary_key = True)
     user_id: uuid.UUID = Field(foreign_key="user.id")
     challenge_id: int = Field(foreign_key="challenge.id")
@@ -0,0 +1,59 @@
+"""
+Keyset pagination over users ordered by (score desc, id asc).
+
+Instead of OFFSET, each page starts strictly after the last row of the
+previous one, so page 1000 costs the same as page 1. The position is
+handed to clients as an opaque cursor string. The ordering matches the
+ix_user_score_id index (see migrations), which lets SQLite seek straight
+to the cursor.
+"""
+
+import base64
+import json
+from typing import Optional
+
+from fastapi import HTTPException
+from sqlalchemy import literal, or_
+
+from src.users import models
+
+
+def encode_cursor(score: int, user_id: str) -> str:
+    raw = json.dumps([score, str(user_id)], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[int, str]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        score, user_id = json.loads(raw)
+        return int(score), str(user_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def by_score(query, cursor: Optional[str] = None):
+    """
+    Order a User query by score and start it after the cursor, if any.
+    """
+    query = query.order_by(models.User.score.desc(), models.User.id)
+    if cursor:
+        score, user_id = decode_cursor(cursor)
+        # The score <= bound is what lets the index seek, the OR only
+        # filters out the players already seen on the same score
+        query = query.where(
+            models.User.score <= score,
+            or_(models.User.score < score, models.User.id > user_id),
+        )
+    return query
+
+
+# The PublicUser columns, without loading whole User rows
+public_user_columns = (
+    models.User.id,
+    models.User.username,
+    models.User.score,
+    models.User.rank,
+    models.User.country,
+    (literal("/uploads/") + models.User.profile_picture).label("avatar_url"),
+)
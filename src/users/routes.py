@@ -3,12 +3,11 @@ from urllib.error import HTTPError
 import os
 
 import jwt
-import shutil
 from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from typing import Annotated, Optional
 from pydantic import BaseModel
 from datetime import datetime
-from uuid import uuid4
 from sqlalchemy import or_
 from starlette.responses import RedirectResponse
 from pathlib import Path
@@ -16,18 +15,33 @@ from pathlib import Path
 import src.auth.service
 from src import database
 from src.users import models
+from src.users import solves
+from src.users import flag_index
+from src.users import pagination
+from src.users import uploads
+from src.users import avatars
+from src.users.leaderboard import leaderboard
+from src.users.scoreboard_stream import broadcaster
 from src.auth import service as auth_service
 from src.auth import routes as auth_routes
+from src.auth import hashing
+from src.auth import cache as auth_cache
+from src import assets
 
-from fastapi import APIRouter, Depends, Request, Form, HTTPException, Cookie, UploadFile, File, Response
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import APIRouter, Depends, Request, Form, HTTPException, Cookie, UploadFile, File, Response, Query
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.security import OAuth2PasswordRequestForm
 
 log = logging.getLogger(__name__)
 router = APIRouter()
 templates = Jinja2Templates(directory="src/templates")
-UPLOAD_DIR = "static/uploads"
+assets.install(templates)
+
+# /api/users paging
+USERS_PAGE_SIZE = 100
+USERS_PAGE_MAX = 1000
+USERS_STREAM_CHUNK = 500
 
 
 @router.get("/current_user")
@@ -39,7 +53,7 @@ async def get_current_user(
 async def login_code(
         *,
         request: Request,
-        session: Session = Depends(database.get_session),
+        session: AsyncSession = Depends(database.get_async_session),
 ):
     body = await request.json()
     identifier = body.get("identifier")
@@ -51,19 +65,20 @@ async def login_code(
             models.User.username == identifier
         )
     )
-    result = session.exec(statement).first()
+    result = (await session.exec(statement)).first()
 
-    if not result or not result.verify_password(password):
+    if not result or not result.is_active or not await hashing.verify_password(password, result.password):
         return JSONResponse(content={"message": "Invalid details"}, status_code=400)
 
     audience = "admin" if result.is_admin else "user"
 
     result.last_login = datetime.utcnow()
     session.add(result)
-    session.commit()
+    await session.commit()
+    auth_cache.invalidate_user(result.id)
 
     encoded_jwt = auth_service.create_access_token(
-        data={"audience": audience, "subject": result.id},
+        data={"audience": audience, "subject": result.id, "epoch": result.token_epoch},
         email=result.email
     )
 
@@ -118,12 +133,14 @@ async def signup_code(*,
         created_at=datetime.utcnow(),
         last_login=datetime.utcnow(),
     )
-    db_user.update_password(password)
+    if password:
+        db_user.password = await hashing.hash_password(password)
     session.add(db_user)
     session.commit()
     session.refresh(db_user)
+    leaderboard.add_player(db_user.id, db_user.username, db_user.country)
 
-    audience = "admin" if email == "arecedia.admin@temp.org" else "user"
+    audience = "admin" if db_user.is_admin else "user"
     encoded_jwt = auth_service.create_access_token(
         email=email, data={
             "audience": audience,
@@ -151,10 +168,79 @@ async def signup_code(*,
     return response
 
 @router.get("/users", response_model=list[models.PublicUser])
-async def get_users(session: Session = Depends(database.get_session)):
-    qry = select(models.User)
-    result = session.exec(qry).all()
-    return result
+async def get_users(
+        response: Response,
+        cursor: Optional[str] = None,
+        limit: int = Query(USERS_PAGE_SIZE, ge=1, le=USERS_PAGE_MAX),
+        format: str = Query("json", pattern="^(json|ndjson)$"),
+        session: AsyncSession = Depends(database.get_async_session),
+):
+    """
+    Players ordered by score, one page at a time.
+
+    The X-Next-Cursor header holds the cursor for the next page. With
+    format=ndjson every player from the cursor on is streamed instead,
+    one JSON object per line.
+    """
+    qry = pagination.by_score(select(*pagination.public_user_columns), cursor)
+
+    if format == "ndjson":
+        return StreamingResponse(_stream_users(session.bind, qry), media_type="application/x-ndjson")
+
+    rows = (await session.exec(qry.limit(limit + 1))).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = pagination.encode_cursor(rows[-1].score, rows[-1].id)
+    return [row._mapping for row in rows]
+
+async def _stream_users(bind, qry):
+    # The request's session is closed once the route returns, so the
+    # stream reads through its own
+    async with AsyncSession(bind) as session:
+        result = await session.stream(qry.execution_options(yield_per=USERS_STREAM_CHUNK))
+        async for rows in result.partitions():
+            yield "".join(
+                models.PublicUser.model_validate(row._mapping).model_dump_json() + "\n" for row in rows
+            ).encode("utf-8")
+
+@router.get("/leaderboard")
+async def get_leaderboard(
+        offset: int = Query(0, ge=0),
+        limit: int = Query(50, ge=1, le=500),
+        session: AsyncSession = Depends(database.get_async_session),
+):
+    """
+    One page of the scoreboard, best player first
+    """
+    await leaderboard.ensure_loaded_async(session)
+    return {
+        "total": len(leaderboard),
+        "offset": offset,
+        "limit": limit,
+        "entries": leaderboard.page(offset, limit),
+    }
+
+@router.get("/leaderboard/me")
+async def get_my_rank(
+        session: AsyncSession = Depends(database.get_async_session),
+        current_user: models.User = Depends(auth_service.get_user_async),
+):
+    await leaderboard.ensure_loaded_async(session)
+    entry = leaderboard.entry(current_user.id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Not on the leaderboard")
+    return {"total": len(leaderboard), **entry}
+
+@router.get("/stream/scoreboard")
+async def stream_scoreboard():
+    """
+    Live solve events as Server-Sent Events
+    """
+    return StreamingResponse(
+        broadcaster.stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @router.get("/reviews")
 async def display_reviews(
@@ -169,43 +255,47 @@ async def display_reviews(
 
 @router.post("/Challenge")
 async def submit_flag(*,
-                      session: Session = Depends(database.get_session),
+                      session: AsyncSession = Depends(database.get_async_session),
                       request:Request,
-                      current_user: models.User = Depends(auth_service.get_user)
+                      current_user: models.User = Depends(auth_service.get_user_async)
                       ):
     body = await request.json()
     flag = body.get("flag")
 
     if not flag:
-        return HTTPException(status_code=400, detail="Flag not found")
+        raise HTTPException(status_code=400, detail="Flag not found")
+    # The index hashes the flag, anything but a string can never match
+    if not isinstance(flag, str):
+        raise HTTPException(status_code=400, detail="Invalid flag")
 
-    challenge = session.exec(
-        select(models.Challenge).where(models.Challenge.flag == flag)).first()
+    challenge = await flag_index.lookup_async(session, flag)
 
     if not challenge:
-        return HTTPException(status_code=400, details="Invalid flag")
-
-    existing_solve = session.exec(
-        select(models.ChallengeSolve)
-        .where(models.ChallengeSolve.user_id == current_user.id)
-        .where(models.ChallengeSolve.challenge_id == challenge.id)
-    ).first()
-
-    if existing_solve:
+        raise HTTPException(status_code=400, detail="Invalid flag")
+
+    # Load the board before the solve is committed, a load afterwards
+    # would already include these points and record_solve add them again
+    await leaderboard.ensure_loaded_async(session)
+    solved_at = datetime.utcnow()
+    if not await solves.record_solve_async(
+            session, current_user.id, challenge.challenge_id, challenge.points, solved_at):
         return {"success": False, "message": "You have already solved this challenge"}
 
-    new_solve = models.ChallengeSolve(
-        user_id=current_user.id,
-        challenge_id=challenge.id,
-        solved_at=datetime.utcnow(),
-    )
-    session.add(new_solve)
-
-    current_user.score += challenge.points
-    session.add(current_user)
-
-    session.commit()
-    session.refresh(current_user)
+    auth_cache.invalidate_user(current_user.id)
+    ranks = leaderboard.record_solve(current_user.id, challenge.points, solved_at)
+    entry = leaderboard.entry(current_user.id)
+    if entry is not None:
+        broadcaster.publish("solve", {
+            "user_id": entry["id"],
+            "username": entry["username"],
+            "challenge_id": challenge.challenge_id,
+            "points": challenge.points,
+            "score": entry["score"],
+            "rank": entry["rank"],
+            "previous_rank": ranks[0] if ranks else None,
+            "solved_at": solved_at.isoformat(),
+        })
+    return {"success": True, "message": "Challenge solved", "points": challenge.points}
 
 @router.post("/Profile/upload/")
 async def upload_profile_picture(
@@ -213,23 +303,14 @@ async def upload_profile_picture(
         session: Session = Depends(database.get_session),
         user: models.User = Depends(auth_service.get_user)
 ):
-    # Ensure the file extension is lowercase and safe
-    ext = os.path.splitext(file.filename)[1].lower()
-    filename = f"user_{user.id}{ext}"
-    filepath = os.path.join(UPLOAD_DIR, filename)
-
-    # Save the uploaded file
-    with open(filepath, "wb") as buffer:
-        print("File absolute path:", os.path.abspath(filepath))
-        buffer.write(await file.read())
+    filename = await uploads.save_image(file)
 
     user.profile_picture = filename
+    user.avatar_variants = await avatars.generate(filename)
     session.add(user)
     session.commit()
-
-    print(os.path.abspath(filepath))
-    print(os.path.exists(filepath))
-    print("Saved profile picture in DB:", user.profile_picture)
+    auth_cache.invalidate_user(user.id)
+    log.info("Saved profile picture %s for user %s", filename, user.id)
 
     return RedirectResponse(url="/Profile/", status_code=303)
 
@@ -252,18 +333,13 @@ async def edit_profile(
 
     # Update profile picture if a file is uploaded
     if file and file.filename:
-        ext = os.path.splitext(file.filename)[1]
-        filename = f"user_{uuid4()}{ext}"
-        filepath = os.path.join(UPLOAD_DIR, filename)
-
-        os.makedirs(UPLOAD_DIR, exist_ok=True)
-        with open(filepath, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-
-        user.profile_picture = filename
+        user.profile_picture = await uploads.save_image(file)
+        user.avatar_variants = await avatars.generate(user.profile_picture)
 
     session.add(user)
     session.commit()
     session.refresh(user)
+    auth_cache.invalidate_user(user.id)
+    leaderboard.update_player(user.id, username=user.username)
 
     return RedirectResponse(url="/Profile/", status_code=303)
\ No newline at end of file
@@ -0,0 +1,90 @@
+"""
+Server-Sent Events fan-out for the live scoreboard.
+
+submit_flag publishes one event per solve, the event is encoded once and
+the same bytes are pushed onto every connected client's queue. Each
+client has a small bounded queue, a client that stops reading long
+enough to fill it is dropped rather than buffering without limit (the
+browser's EventSource reconnects on its own). Idle connections get a
+comment frame every SCOREBOARD_HEARTBEAT seconds so proxies keep them
+open.
+
+All methods must be called from the event loop thread.
+"""
+
+import asyncio
+import json
+import os
+from typing import AsyncIterator, Optional
+
+SCOREBOARD_QUEUE_SIZE = int(os.getenv("SCOREBOARD_QUEUE_SIZE", 64))
+SCOREBOARD_HEARTBEAT = float(os.getenv("SCOREBOARD_HEARTBEAT", 15))
+
+# Ask EventSource to reconnect quickly after a drop
+_RETRY_FRAME = b"retry: 3000\n\n"
+_HEARTBEAT_FRAME = b": ping\n\n"
+
+
+def encode_event(event: str, data: dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n".encode("utf-8")
+
+
+class Broadcaster:
+    def __init__(self, queue_size: int = SCOREBOARD_QUEUE_SIZE, heartbeat: float = SCOREBOARD_HEARTBEAT):
+        self.queue_size = queue_size
+        self.heartbeat = heartbeat
+        self.dropped = 0
+        self._subscribers: set[asyncio.Queue] = set()
+
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+    def publish(self, event: str, data: dict):
+        """
+        Encode an event once and queue it for every client.
+        """
+        frame = encode_event(event, data)
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                self._disconnect(queue)
+                self.dropped += 1
+
+    def _disconnect(self, queue: asyncio.Queue):
+        # Throw away the backlog and leave the end-of-stream marker
+        self._subscribers.discard(queue)
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    def close(self):
+        """
+        End every open stream, used on shutdown.
+        """
+        for queue in list(self._subscribers):
+            self._disconnect(queue)
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        """
+        The frames for a single client, ends if the client is dropped.
+        """
+        queue: asyncio.Queue[Optional[bytes]] = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.add(queue)
+        try:
+            yield _RETRY_FRAME
+            while True:
+                try:
+                    frame = await asyncio.wait_for(queue.get(), self.heartbeat)
+                except asyncio.TimeoutError:
+                    yield _HEARTBEAT_FRAME
+                    continue
+                if frame is None:
+                    break
+                yield frame
+        finally:
+            self._subscribers.discard(queue)
+
+
+broadcaster = Broadcaster()
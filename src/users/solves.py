@@ -0,0 +1,79 @@
+"""
+Recording challenge solves.
+
+A solve is a single transaction: insert the ChallengeSolve row and bump
+the user's score with one SQL UPDATE. The unique (user_id, challenge_id)
+index on ChallengeSolve is what decides whether the solve is new, a
+duplicate shows up as an IntegrityError from the insert, so there is no
+check-then-insert window for concurrent submissions to slip through.
+"""
+
+import uuid
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import insert, update
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src.users import models
+
+
+def _solve_statements(user_id, challenge_id: int, points: int, solved_at: Optional[datetime]):
+    insert_solve = insert(models.ChallengeSolve).values(
+        user_id=uuid.UUID(str(user_id)),
+        challenge_id=challenge_id,
+        solved_at=solved_at or datetime.utcnow(),
+    )
+    add_points = (
+        update(models.User)
+        .where(models.User.id == str(user_id))
+        .values(score=models.User.score + points)
+    )
+    return insert_solve, add_points
+
+
+def record_solve(
+        session: Session,
+        user_id,
+        challenge_id: int,
+        points: int,
+        solved_at: Optional[datetime] = None,
+) -> bool:
+    """
+    Record that a user solved a challenge and award the points.
+
+    Returns False, leaving the score untouched, if the user had
+    already solved it.
+    """
+    insert_solve, add_points = _solve_statements(user_id, challenge_id, points, solved_at)
+    try:
+        session.exec(insert_solve)
+        session.exec(add_points)
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        return False
+    return True
+
+
+async def record_solve_async(
+        session: AsyncSession,
+        user_id,
+        challenge_id: int,
+        points: int,
+        solved_at: Optional[datetime] = None,
+) -> bool:
+    """
+    record_solve for an AsyncSession.
+    """
+    insert_solve, add_points = _solve_statements(user_id, challenge_id, points, solved_at)
+    try:
+        await session.exec(insert_solve)
+        await session.exec(add_points)
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        return False
+    return True
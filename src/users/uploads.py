@@ -0,0 +1,255 @@
+"""
+Shared pipeline for image uploads (profile pictures).
+
+The upload is copied in chunks to a temp file in the upload directory on
+a worker thread, so neither the event loop nor memory ever holds the
+whole file. While copying it is checked against UPLOAD_MAX_BYTES and the
+first bytes are sniffed for the real image type, the client's filename
+and content type are ignored. Only a complete, valid file is renamed
+into place, with os.replace, so nobody ever sees half an image.
+
+Files are content addressed: an image is stored as
+ab/cd/abcd1234...<ext> after the SHA-256 of its bytes, so the same
+picture uploaded twice is kept once, and no directory gets huge.
+User.profile_picture holds that relative path.
+
+Nothing is deleted when a user changes picture, instead collect_garbage
+does a mark and sweep: every file not referenced by a user (picture or
+avatar variant) and older than UPLOAD_GC_GRACE is removed. It runs every
+UPLOAD_GC_INTERVAL seconds from the app, or by hand:
+
+    python -m src.users.uploads [--dry-run]
+
+    UPLOAD_DIR          where files end up (default static/uploads)
+    UPLOAD_MAX_BYTES    largest accepted upload (default 5MB)
+    UPLOAD_CHUNK_SIZE   bytes copied at a time (default 64KB)
+    UPLOAD_GC_INTERVAL  seconds between collections, 0 disables (default 3600)
+    UPLOAD_GC_GRACE     minimum age in seconds before an unreferenced file
+                        is removed, covers uploads not committed yet (default 3600)
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from typing import BinaryIO, Iterable, Optional
+
+from fastapi import HTTPException, UploadFile
+from sqlmodel import Session, select
+from starlette.concurrency import run_in_threadpool
+
+from src import database
+from src.users import models
+
+log = logging.getLogger(__name__)
+
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "static/uploads")
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", 5 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", 64 * 1024))
+UPLOAD_GC_INTERVAL = float(os.getenv("UPLOAD_GC_INTERVAL", 3600))
+UPLOAD_GC_GRACE = float(os.getenv("UPLOAD_GC_GRACE", 3600))
+
+TEMP_PREFIX = ".upload-"
+
+# Enough of the file to recognise every type below
+SNIFF_BYTES = 12
+
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """
+    File extension for the image type in the first bytes, None if it
+    is not an image we accept.
+    """
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return ".png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return ".jpg"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return ".gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return ".webp"
+    return None
+
+
+class UploadRejected(Exception):
+    def __init__(self, status_code: int, detail: str):
+        self.status_code = status_code
+        self.detail = detail
+
+
+def _copy_to_temp(source: BinaryIO, directory: str, max_bytes: int) -> tuple[str, str, str]:
+    """
+    Blocking part of save_image, runs on a worker thread.
+    """
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=TEMP_PREFIX, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            head = source.read(SNIFF_BYTES)
+            ext = sniff_image_type(head)
+            if ext is None:
+                raise UploadRejected(415, "File is not a PNG, JPEG, GIF or WebP image")
+            out.write(head)
+            digest.update(head)
+            size = len(head)
+            while chunk := source.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadRejected(413, f"File is larger than {max_bytes} bytes")
+                out.write(chunk)
+                digest.update(chunk)
+        return tmp_path, ext, digest.hexdigest()
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def stored_name(digest: str, ext: str) -> str:
+    return f"{digest[:2]}/{digest[2:4]}/{digest}{ext}"
+
+
+def _finish(tmp_path: str, directory: str, digest: str, ext: str) -> str:
+    filename = stored_name(digest, ext)
+    target = os.path.join(directory, filename)
+    if os.path.exists(target):
+        # Already stored, bump the mtime so the GC grace period covers
+        # the window before the new reference is committed
+        os.unlink(tmp_path)
+        os.utime(target)
+    else:
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(tmp_path, target)
+        except FileNotFoundError:
+            # The GC removed the shard directory while it was still empty
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(tmp_path, target)
+    return filename
+
+
+async def save_image(file: UploadFile, directory: Optional[str] = None,
+                     max_bytes: Optional[int] = None) -> str:
+    """
+    Store an uploaded image, returns its path relative to the upload
+    directory.
+
+    Raises 413 for files over max_bytes and 415 for anything that is not
+    an image.
+    """
+    directory = directory or UPLOAD_DIR
+    max_bytes = max_bytes or UPLOAD_MAX_BYTES
+
+    # Multipart parsing already counted the bytes, fail before copying
+    if file.size is not None and file.size > max_bytes:
+        raise HTTPException(status_code=413, detail=f"File is larger than {max_bytes} bytes")
+
+    await file.seek(0)
+    try:
+        tmp_path, ext, digest = await run_in_threadpool(_copy_to_temp, file.file, directory, max_bytes)
+    except UploadRejected as exc:
+        raise HTTPException(status_code=exc.status_code, detail=exc.detail)
+    return await run_in_threadpool(_finish, tmp_path, directory, digest, ext)
+
+
+def referenced_files(session: Session) -> set[str]:
+    """
+    Every upload some user still points at (the mark phase).
+    """
+    qry = (
+        select(models.User.profile_picture, models.User.avatar_variants)
+        .where(models.User.profile_picture.is_not(None))
+        .execution_options(yield_per=1000)
+    )
+    referenced = set()
+    for picture, variants in session.exec(qry):
+        referenced.add(picture)
+        if variants:
+            referenced.update(variants.values())
+    return referenced
+
+
+def _walk(directory: str) -> Iterable[os.DirEntry]:
+    for entry in os.scandir(directory):
+        if entry.is_dir(follow_symlinks=False):
+            yield from _walk(entry.path)
+            yield entry
+        else:
+            yield entry
+
+
+def collect_garbage(referenced: set[str], directory: Optional[str] = None,
+                    grace: Optional[float] = None, dry_run: bool = False) -> list[str]:
+    """
+    Remove uploads nobody references (the sweep phase), returns the
+    removed paths relative to the upload directory.
+    """
+    directory = directory or UPLOAD_DIR
+    grace = UPLOAD_GC_GRACE if grace is None else grace
+    if not os.path.isdir(directory):
+        return []
+    cutoff = time.time() - grace
+    removed = []
+
+    for entry in _walk(directory):
+        relative = os.path.relpath(entry.path, directory).replace(os.sep, "/")
+        if entry.is_dir(follow_symlinks=False):
+            # Shard directories are dropped once empty
+            if not dry_run:
+                try:
+                    os.rmdir(entry.path)
+                except OSError:
+                    pass
+            continue
+        if relative in referenced:
+            continue
+        try:
+            if entry.stat(follow_symlinks=False).st_mtime > cutoff:
+                continue
+            if not dry_run:
+                os.unlink(entry.path)
+        except FileNotFoundError:
+            # Another worker got there first
+            continue
+        removed.append(relative)
+    return removed
+
+
+def collect_now(dry_run: bool = False) -> list[str]:
+    with Session(database.engine) as session:
+        referenced = referenced_files(session)
+    removed = collect_garbage(referenced, dry_run=dry_run)
+    if removed:
+        log.info("Upload GC removed %d unreferenced file(s)", len(removed))
+    return removed
+
+
+async def collect_periodically(interval: float = UPLOAD_GC_INTERVAL):
+    """
+    Background task started from the app lifespan.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(collect_now)
+        except Exception:
+            log.exception("Upload garbage collection failed")
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Remove uploads no user references")
+    parser.add_argument("--dry-run", action="store_true", help="only list what would be removed")
+    args = parser.parse_args(argv)
+
+    removed = collect_now(dry_run=args.dry_run)
+    for path in removed:
+        print(path)
+    print(f"{'Would remove' if args.dry_run else 'Removed'} {len(removed)} file(s)")
+
+
+if __name__ == "__main__":
+    main()
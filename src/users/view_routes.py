@@ -1,17 +1,33 @@
+import gzip
+import hashlib
 import logging
 from sqlmodel import Session, select
-from typing import Optional
+from typing import NamedTuple, Optional
+from src import assets
 from src import database
-from fastapi import APIRouter, Depends, Request, Form
-from fastapi.responses import HTMLResponse
+from fastapi import APIRouter, Depends, Request, Form, Query, HTTPException, Response
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from src.users import models
+from src.users import pagination
+from src.users import avatars
 
 import src.auth.service as auth_service
 
 log = logging.getLogger(__name__)
 router = APIRouter()
 templates = Jinja2Templates(directory="src/templates")
+assets.install(templates)
+avatars.install(templates)
+
+# /user.html paging
+USER_LIST_PAGE_SIZE = 100
+USER_LIST_PAGE_MAX = 1000
+USER_LIST_STREAM_CHUNK = 500
+USER_LIST_COLUMNS = (
+    models.User.id, models.User.username, models.User.email, models.User.score,
+    models.User.profile_picture, models.User.avatar_variants,
+)
 
 @router.get("/", response_class=HTMLResponse)
 async def home(request: Request):
@@ -59,6 +75,7 @@ async def profile_page(
             "request": request,
             "username": user.username,
             "profile_picture": user.profile_picture,
+            "avatar_variants": user.avatar_variants,
             "profile_bio": user.profile_bio
         },
     )
@@ -66,83 +83,52 @@ async def profile_page(
 @router.get("/user.html", response_class=HTMLResponse)
 async def user_view(*,
                     request: Request,
+                    cursor: Optional[str] = None,
+                    limit: int = Query(USER_LIST_PAGE_SIZE, ge=1, le=USER_LIST_PAGE_MAX),
+                    stream: bool = False,
                     session: Session = Depends(database.get_session)
                     ):
-    qry = select(models.User)
-    users = session.exec(qry).all()
+    """
+    Player list, one keyset page at a time.
+
+    With stream=true the whole list from the cursor on is rendered
+    incrementally and sent as it is produced, rows are read from the
+    database as the template reaches them.
+    """
+    qry = pagination.by_score(select(*USER_LIST_COLUMNS), cursor)
+
+    if stream:
+        return StreamingResponse(
+            _stream_user_list(session.get_bind(), qry, request),
+            media_type="text/html",
+        )
+
+    users = session.exec(qry.limit(limit + 1)).all()
+    next_cursor = None
+    if len(users) > limit:
+        users = users[:limit]
+        next_cursor = pagination.encode_cursor(users[-1].score, users[-1].id)
 
     return templates.TemplateResponse(
         request=request,
         name="Home/User.html",
-        context={"users": users}
+        context={"users": users, "next_cursor": next_cursor, "limit": limit}
     )
 
-@router.get("/challenge/1", response_class=HTMLResponse)
-async def challenge_1_view(request: Request):
-    return templates.TemplateResponse("Challenges/Challenge_1.html", {"request": request})
-
-
-@router.get("/challenge/2", response_class=HTMLResponse)
-async def challenge_2_view(request: Request):
-    return templates.TemplateResponse("Challenges/Challenge_2.html", {"request": request})
-
-
-@router.get("/challenge/3", response_class=HTMLResponse)
-async def challenge_3_view(request: Request):
-    return templates.TemplateResponse("Challenges/Challenge_3.html", {"request": request})
-
-@router.get("/challenge/4", response_class=HTMLResponse)
-async def challenge_4_view(request: Request):
-    return templates.TemplateResponse("Challenges/Challenge_4.html", {"request": request})
-
-
-@router.get("/challenge/5", response_class=HTMLResponse)
-async def challenge_5_view(request: Request):
-    return templates.TemplateResponse("Challenges/Challenge_5.html", {"request": request})
-
-@router.get("/tutorial/1", response_class=HTMLResponse)
-async def tutorial_1_view(request: Request):
-    return templates.TemplateResponse(
-        request = request,
-        name = "Tutorials/Tutorial_1.html",
-        context = {}
-    )
-
-
-@router.get("/tutorial/2", response_class=HTMLResponse)
-async def tutorial_2_view(request: Request):
-    return templates.TemplateResponse(
-        request = request,
-        name = "Tutorials/Tutorial_2.html",
-        context = {}
-    )
-
-
-@router.get("/tutorial/3", response_class=HTMLResponse)
-async def tutorial_3_view(request: Request):
-    return templates.TemplateResponse(
-        request = request,
-        name = "Tutorials/Tutorial_3.html",
-        context = {}
-    )
-
-
-@router.get("/tutorial/4", response_class=HTMLResponse)
-async def tutorial_4_view(request: Request):
-    return templates.TemplateResponse(
-        request = request,
-        name = "Tutorials/Tutorial_4.html",
-        context = {}
-    )
-
-
-@router.get("/tutorial/5", response_class=HTMLResponse)
-async def tutorial_5_view(request: Request):
-    return templates.TemplateResponse(
-        request = request,
-        name = "Tutorials/Tutorial_5.html",
-        context = {}
-    )
+def _stream_user_list(bind, qry, request: Request):
+    # Sync generator, StreamingResponse runs it in the threadpool. It has
+    # its own session because the request's one is closed by then
+    with Session(bind) as session:
+        users = session.exec(qry.execution_options(yield_per=USER_LIST_STREAM_CHUNK))
+        template = templates.get_template("Home/User.html")
+        buffer = []
+        for part in template.generate(request=request, users=users, next_cursor=None):
+            buffer.append(part)
+            # Jinja yields tiny fragments, batch them into sensible writes
+            if len(buffer) >= 256:
+                yield "".join(buffer)
+                buffer.clear()
+        yield "".join(buffer)
 
 @router.get("/Reviews/", response_class=HTMLResponse)
 async def reviews_view(request: Request):
@@ -152,42 +138,85 @@ async def reviews_view(request: Request):
         context={}
     )
 
-@router.get("/Review-Submission/1", response_class=HTMLResponse)
-async def review_submission_1_view(request: Request):
-    return templates.TemplateResponse(
-        request = request,
-        name = "Reviews/Review_1.html",
-        context = {}
-    )
-
-@router.get("/Review-Submission/2", response_class=HTMLResponse)
-async def review_submission_2_view(request: Request):
-    return templates.TemplateResponse(
-        request = request,
-        name = "Reviews/Review_2.html",
-        context = {}
+# -----------------------
+# Static pages
+# -----------------------
+# Challenge, tutorial and review pages do not depend on the user, so each
+# one is rendered once and then served from memory with an ETag and a
+# gzip variant.
+STATIC_PAGES = {
+    "challenge": {str(i): f"Challenges/Challenge_{i}.html" for i in range(1, 6)},
+    "tutorial": {str(i): f"Tutorials/Tutorial_{i}.html" for i in range(1, 6)},
+    "Review-Submission": {str(i): f"Reviews/Review_{i}.html" for i in range(1, 6)},
+}
+
+class RenderedPage(NamedTuple):
+    body: bytes
+    gzip_body: bytes
+    etag: str
+    gzip_etag: str
+
+_rendered_pages: dict[tuple[str, str], RenderedPage] = {}
+
+def render_page(app, template_name: str) -> RenderedPage:
+    # url_for normally needs the request, pages rendered ahead of time
+    # link with root relative paths instead
+    def url_for(name, **path_params):
+        return app.url_path_for(name, **path_params)
+
+    body = templates.get_template(template_name).render(url_for=url_for).encode("utf-8")
+    digest = hashlib.sha256(body).hexdigest()[:32]
+    return RenderedPage(
+        body=body,
+        gzip_body=gzip.compress(body, mtime=0),
+        etag=f'"{digest}"',
+        gzip_etag=f'"{digest}-gzip"',
     )
 
-@router.get("/Review-Submission/3", response_class=HTMLResponse)
-async def review_submission_3_view(request: Request):
-    return templates.TemplateResponse(
-        request = request,
-        name = "Reviews/Review_3.html",
-        context = {}
+def prerender_pages(app):
+    """
+    Render every static page, called from the app lifespan.
+    """
+    for section, pages in STATIC_PAGES.items():
+        for page_id, template_name in pages.items():
+            _rendered_pages[section, page_id] = render_page(app, template_name)
+
+def _serve_static_page(request: Request, section: str, page_id: str) -> Response:
+    template_name = STATIC_PAGES[section].get(page_id)
+    if template_name is None:
+        raise HTTPException(status_code=404, detail="Page not found")
+
+    page = _rendered_pages.get((section, page_id))
+    if page is None:
+        page = _rendered_pages[section, page_id] = render_page(request.app, template_name)
+
+    use_gzip = assets.accepts_encoding(request.headers.get("accept-encoding", ""), "gzip")
+    etag = page.gzip_etag if use_gzip else page.etag
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+
+    # Only the variant being served counts, a cached gzip body is no use
+    # to a client that now wants it plain
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if "*" in tags or etag in tags:
+            return Response(status_code=304, headers=headers)
+
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+        return Response(page.gzip_body, media_type="text/html", headers=headers)
+    return Response(page.body, media_type="text/html", headers=headers)
+
+def _static_page_route(section: str):
+    async def static_page(request: Request, page_id: str):
+        return _serve_static_page(request, section, page_id)
+    return static_page
+
+for _section in STATIC_PAGES:
+    router.add_api_route(
+        f"/{_section}/{{page_id}}",
+        _static_page_route(_section),
+        methods=["GET"],
+        response_class=HTMLResponse,
+        name=f"{_section}_page",
     )
-
-@router.get("/Review-Submission/4", response_class=HTMLResponse)
-async def review_submission_4_view(request: Request):
-    return templates.TemplateResponse(
-        request = request,
-        name = "Reviews/Review_4.html",
-        context = {}
-    )
-
-@router.get("/Review-Submission/5", response_class=HTMLResponse)
-async def review_submission_5_view(request: Request):
-    return templates.TemplateResponse(
-        request = request,
-        name = "Reviews/Review_5.html",
-        context = {}
-    )
\ No newline at end of file
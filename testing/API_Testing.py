@@ -0,0 +1,946 @@
+"""
+API level tests
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import random
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pytest
+from sqlmodel import SQLModel, Session, create_engine, select, func
+
+from src import migrations
+from testing import benchmarks
+from testing import dataset
+from testing import utils
+from src.users import models
+from src.users import solves
+from src.users import flag_index
+from src.users import uploads
+from src.users.leaderboard import Leaderboard, RankedSkipList, leaderboard
+
+
+def test_record_solve_is_exact_under_concurrency(tmp_path):
+    """
+    Hammer record_solve from many threads with repeated submissions,
+    every (user, challenge) pair must be counted exactly once.
+    """
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'stress.db'}",
+        connect_args={"check_same_thread": False, "timeout": 30},
+    )
+    SQLModel.metadata.create_all(engine)
+
+    with Session(engine) as session:
+        users = [models.User(username=f"user{i}", email=f"user{i}@test.org", password="x") for i in range(20)]
+        challenges = [
+            models.Challenge(title=f"Challenge {i}", category="Test", description="", points=10 * i, flag=f"flag{i}")
+            for i in range(1, 6)
+        ]
+        session.add_all(users + challenges)
+        session.commit()
+        user_ids = [u.id for u in users]
+        points = {c.id: c.points for c in challenges}
+
+    # Every pair submitted 20 times, shuffled so duplicates race each other
+    submissions = [(u, c) for u in user_ids for c in points for _ in range(20)]
+    random.shuffle(submissions)
+
+    def submit(item):
+        user_id, challenge_id = item
+        with Session(engine) as session:
+            return solves.record_solve(session, user_id, challenge_id, points[challenge_id])
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        results = list(pool.map(submit, submissions))
+
+    assert sum(results) == len(user_ids) * len(points)
+    with Session(engine) as session:
+        solve_count = session.exec(select(func.count()).select_from(models.ChallengeSolve)).one()
+        assert solve_count == len(user_ids) * len(points)
+        for user in session.exec(select(models.User)).all():
+            assert user.score == sum(points.values())
+            solved = session.exec(
+                select(models.ChallengeSolve.challenge_id).where(models.ChallengeSolve.user_id == uuid.UUID(user.id))
+            ).all()
+            assert sorted(solved) == sorted(points)
+
+
+def test_ranked_skiplist_matches_sorted_list():
+    keys = [(-random.randint(0, 50), random.random(), str(i)) for i in range(2000)]
+    ranking = RankedSkipList.from_sorted(sorted(keys[:1000]))
+    for key in keys[1000:]:
+        ranking.insert(key)
+    for key in random.sample(keys, 300):
+        ranking.remove(key)
+        keys.remove(key)
+    keys.sort()
+
+    assert list(ranking) == keys
+    assert all(ranking.index(key) == i for i, key in enumerate(keys))
+    assert ranking.slice(500, 25) == keys[500:525]
+    assert ranking.slice(len(keys) - 5, 25) == keys[-5:]
+
+
+def test_leaderboard_orders_by_score_then_solve_time(session):
+    users = [models.User(username=name, email=f"{name}@test.org", password="x") for name in ("a", "b", "c")]
+    challenge = models.Challenge(title="Lb", category="Test", description="", points=100, flag="lb")
+    session.add_all(users + [challenge])
+    session.commit()
+
+    board = Leaderboard()
+    board.load(session)
+    for user in (users[1], users[0]):
+        solved_at = datetime.utcnow()
+        solves.record_solve(session, user.id, challenge.id, challenge.points, solved_at)
+        board.record_solve(user.id, challenge.points, solved_at)
+
+    assert [entry["username"] for entry in board.page(0, 10)] == ["b", "a", "c"]
+    assert board.rank(users[2].id) == 3
+
+    # A fresh load from the database gives the same order
+    reloaded = Leaderboard()
+    reloaded.load(session)
+    assert reloaded.page(0, 10) == board.page(0, 10)
+
+    assert board.persist_ranks(session) == 3
+    assert session.get(models.User, users[1].id).rank == 1
+    assert board.persist_ranks(session) == 0
+
+
+def test_persist_ranks_only_writes_players_that_moved(session):
+    users = [models.User(username=f"r{i}", email=f"r{i}@test.org", password="x", score=10 * (200 - i))
+             for i in range(200)]
+    session.add_all(users)
+    session.commit()
+
+    board = Leaderboard()
+    board.load(session)
+    assert board.persist_ranks(session) == 200
+    assert board.persist_ranks(session) == 0
+
+    # r49 (rank 50) overtakes r39..r48, only those 11 ranks change
+    assert board.record_solve(users[49].id, 105, datetime.utcnow()) == (50, 40)
+    assert board.persist_ranks(session) == 11
+    newcomer = models.User(username="newcomer", email="newcomer@test.org", password="x")
+    session.add(newcomer)
+    session.commit()
+    board.add_player(newcomer.id, "newcomer")
+    assert board.persist_ranks(session) == 1
+    # Everyone below the leader moves up
+    board.remove_player(users[0].id)
+    assert board.persist_ranks(session) == 200
+
+    for user in users[1:] + [newcomer]:
+        session.refresh(user)
+        assert user.rank == board.rank(user.id)
+
+
+def test_submit_flag_through_the_api(client, session):
+    user = models.User(username="player", email="player@test.org", password=models.hash_password("pw"))
+    challenge = models.Challenge(title="Api", category="Test", description="", points=50, flag="api-flag")
+    session.add_all([user, challenge])
+    session.commit()
+    flag_index.rebuild(session)
+    leaderboard.load(session)
+
+    assert client.post("/api/login", json={"identifier": "player", "password": "pw"}).status_code == 200
+
+    assert client.post("/api/Challenge", json={"flag": "wrong"}).status_code == 400
+    for not_a_string in (123, ["api-flag"], {"flag": "api-flag"}):
+        assert client.post("/api/Challenge", json={"flag": not_a_string}).json()["detail"] == "Invalid flag"
+    assert client.post("/api/Challenge", json={"flag": "api-flag"}).json()["success"] is True
+    assert client.post("/api/Challenge", json={"flag": "api-flag"}).json()["success"] is False
+
+    assert client.get("/api/leaderboard/me").json()["score"] == 50
+    session.refresh(user)
+    assert user.score == 50
+
+
+def test_first_solve_on_an_unloaded_board_counts_once(client, session):
+    user = models.User(username="early", email="early@test.org", password=models.hash_password("pw"))
+    challenge = models.Challenge(title="Early", category="Test", description="", points=50, flag="early-flag")
+    session.add_all([user, challenge])
+    session.commit()
+    flag_index.rebuild(session)
+    # As after startup on a worker that has not served the leaderboard yet
+    leaderboard.loaded = False
+
+    assert client.post("/api/login", json={"identifier": "early", "password": "pw"}).status_code == 200
+    assert client.post("/api/Challenge", json={"flag": "early-flag"}).json()["success"] is True
+
+    session.refresh(user)
+    assert user.score == 50
+    assert leaderboard.entry(user.id)["score"] == 50
+
+
+def test_flag_index_follows_admin_changes(client, session):
+    session.add(models.User(username="setter", email="setter@test.org",
+                            password=models.hash_password("pw"), is_admin=True))
+    session.commit()
+    flag_index.rebuild(session)
+    assert client.post("/api/login", json={"identifier": "setter", "password": "pw"}).status_code == 200
+
+    def lookup(flag):
+        return flag_index.lookup(session, flag)
+
+    assert lookup("fresh-flag") is None
+    created = client.post("/api/admin/create-challenge", json={
+        "title": "Fresh", "category": "Test", "description": "", "points": 30, "flag": "fresh-flag"}).json()
+    challenge_id = created["challenge"]["id"]
+    assert lookup("fresh-flag") == (challenge_id, 30)
+
+    client.patch(f"/api/admin/challenges/{challenge_id}", json={"flag": "moved-flag", "points": 40})
+    assert lookup("fresh-flag") is None
+    assert lookup("moved-flag") == (challenge_id, 40)
+
+    client.delete(f"/api/admin/challenges/{challenge_id}")
+    assert lookup("moved-flag") is None
+
+    client.post("/api/admin/seed-challenges")
+    assert lookup("P3rm1551ons").points == 100
+
+
+def test_flag_index_notices_changes_from_other_workers(session, monkeypatch):
+    session.add(models.Challenge(title="Old", category="Test", description="", points=10, flag="old-flag"))
+    session.commit()
+    flag_index.rebuild(session)
+
+    # Another worker re-flags the challenge and bumps the version
+    session.connection().exec_driver_sql("UPDATE challenge SET flag = 'new-flag' WHERE title = 'Old'")
+    session.connection().exec_driver_sql("UPDATE flag_index_version SET version = version + 1")
+    session.commit()
+    # Not looked at again until the interval is up
+    assert flag_index.lookup(session, "old-flag") is not None
+    monkeypatch.setattr(flag_index, "FLAG_INDEX_CHECK_INTERVAL", 0)
+    assert flag_index.lookup(session, "old-flag") is None
+    assert flag_index.lookup(session, "new-flag").points == 10
+
+    # Rows inserted behind the app's back change MAX(id) all the same
+    session.connection().exec_driver_sql(
+        "INSERT INTO challenge (title, category, description, points, flag, created_at) "
+        "VALUES ('Raw', 'Test', '', 20, 'raw-flag', '2024-01-01 00:00:00')")
+    session.commit()
+    assert flag_index.lookup(session, "raw-flag").points == 20
+
+
+def test_admin_changes_revoke_tokens(client, session):
+    from fastapi.testclient import TestClient
+    from src.auth import cache as auth_cache
+
+    session.add(models.User(username="boss", email="boss@test.org",
+                            password=models.hash_password("pw"), is_admin=True))
+    players = [
+        models.User(username=f"revoked{i}", email=f"revoked{i}@test.org", password=models.hash_password("pw"))
+        for i in range(4)
+    ]
+    session.add_all(players)
+    session.commit()
+    assert client.post("/api/login", json={"identifier": "boss", "password": "pw"}).status_code == 200
+
+    def logged_in(user):
+        player = TestClient(client.app)
+        assert player.post("/api/login", json={"identifier": user.username, "password": "pw"}).status_code == 200
+        assert player.get("/api/current_user").status_code == 200
+        return player
+
+    changes = [
+        lambda user: client.patch(f"/api/admin/users/{user.id}", json={"is_admin": True}),
+        lambda user: client.patch(f"/api/admin/users/{user.id}", json={"is_active": False}),
+        lambda user: client.patch(f"/api/admin/users/{user.id}", json={"password": "changed"}),
+        lambda user: client.delete(f"/api/admin/users/{user.id}"),
+    ]
+    for user, change in zip(players, changes):
+        player = logged_in(user)
+        assert change(user).status_code == 200
+        assert player.get("/api/current_user").status_code == 401
+        # Still revoked with cold caches, as after a restart
+        auth_cache.token_cache.clear()
+        auth_cache.user_cache.clear()
+        assert player.get("/api/current_user").status_code == 401
+
+    # Untouched tokens keep working
+    assert client.get("/api/admin/cache-stats").status_code == 200
+
+
+def test_login_sheds_load_when_the_hash_pool_is_full(client, session, monkeypatch):
+    from src.auth import hashing
+
+    session.add(models.User(username="busy", email="busy@test.org", password=models.hash_password("pw")))
+    session.commit()
+
+    monkeypatch.setattr(hashing, "_pending", hashing.HASH_QUEUE_LIMIT)
+    response = client.post("/api/login", json={"identifier": "busy", "password": "pw"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == str(hashing.HASH_RETRY_AFTER)
+
+    monkeypatch.setattr(hashing, "_pending", 0)
+    assert client.post("/api/login", json={"identifier": "busy", "password": "pw"}).status_code == 200
+
+
+def test_bulk_hashing_runs_one_job_at_a_time(monkeypatch):
+    import threading
+    import time
+    from src.auth import hashing
+
+    active = {}
+    overlaps = []
+    lock = threading.Lock()
+
+    def hash_many(passwords):
+        job = passwords[0][0]
+        with lock:
+            overlaps.extend(other for other, count in active.items() if count and other != job)
+            active[job] = active.get(job, 0) + 1
+        time.sleep(0.01)
+        with lock:
+            active[job] -= 1
+        return [password.upper() for password in passwords]
+
+    # Threads instead of processes so the stand in needs no pickling
+    monkeypatch.setattr(hashing, "_hash_many", hash_many)
+    monkeypatch.setattr(hashing, "_bulk_executor", ThreadPoolExecutor(max_workers=4))
+    monkeypatch.setattr(hashing, "HASH_BULK_WORKERS", 4)
+
+    async def imports():
+        return await asyncio.gather(*(
+            hashing.hash_passwords([f"{job}{i}" for i in range(16)]) for job in "abc"
+        ))
+
+    try:
+        results = asyncio.run(imports())
+    finally:
+        hashing._bulk_executor.shutdown()
+    assert results == [[f"{job.upper()}{i}" for i in range(16)] for job in "abc"]
+    assert overlaps == []
+
+
+def test_user_cache_hits_and_invalidation(client, session):
+    from src.auth import cache as auth_cache
+
+    user = models.User(username="cached", email="cached@test.org", password=models.hash_password("pw"))
+    challenge = models.Challenge(title="Cached", category="Test", description="", points=50, flag="cached-flag")
+    session.add_all([user, challenge])
+    session.add(models.User(username="keeper", email="keeper@test.org",
+                            password=models.hash_password("pw"), is_admin=True))
+    session.commit()
+    flag_index.rebuild(session)
+    leaderboard.load(session)
+    auth_cache.user_cache.clear()
+
+    def cached():
+        return auth_cache.user_cache._data.get(user.id, (None, None))[1]
+
+    assert client.post("/api/login", json={"identifier": "cached", "password": "pw"}).status_code == 200
+    assert cached() is None
+    # /api/leaderboard/me loads the user on a fresh async session every time
+    client.get("/api/leaderboard/me")
+    hits = auth_cache.user_cache.hits
+    client.get("/api/leaderboard/me")
+    assert auth_cache.user_cache.hits == hits + 1
+
+    assert client.post("/api/Challenge", json={"flag": "cached-flag"}).json()["success"] is True
+    assert cached() is None
+    client.get("/api/leaderboard/me")
+    assert cached()["score"] == 50
+
+    client.post("/api/Profile/edit/", data={"new_bio": "Hello"})
+    assert cached() is None
+    client.get("/api/leaderboard/me")
+    assert cached()["profile_bio"] == "Hello"
+
+    client.cookies.clear()
+    assert client.post("/api/login", json={"identifier": "keeper", "password": "pw"}).status_code == 200
+    stats = client.get("/api/admin/cache-stats").json()
+    assert stats["users"]["hits"] >= 1 and stats["users"]["size"] >= 1
+    assert stats["tokens"]["maxsize"] == auth_cache.token_cache.maxsize
+
+
+def test_user_cache_refuses_rows_read_before_an_invalidation(session, monkeypatch):
+    from src.auth import cache as auth_cache
+    from src.auth import service as auth_service
+
+    cache = auth_cache.TTLCache(10, 60)
+    generation = cache.generation("u")
+    cache.pop("u")
+    cache.set("u", {"score": 0}, generation=generation)
+    assert cache.get("u") is None
+    cache.set("u", {"score": 50}, generation=cache.generation("u"))
+    assert cache.get("u") == {"score": 50}
+
+    user = models.User(username="racer", email="racer@test.org", password="x")
+    session.add(user)
+    session.commit()
+    user_id = user.id
+    session.expunge_all()
+    auth_cache.user_cache.clear()
+
+    # A solve commits and invalidates while this request is reading the row
+    get = session.get
+
+    def racing_get(*args, **kwargs):
+        row = get(*args, **kwargs)
+        auth_cache.invalidate_user(user_id)
+        return row
+
+    monkeypatch.setattr(session, "get", racing_get)
+    assert auth_service.load_user(session, user_id).username == "racer"
+    assert auth_cache.user_cache.get(user_id) is None
+
+
+def test_broadcaster_fans_out_and_drops_slow_clients():
+    from src.users.scoreboard_stream import Broadcaster, encode_event
+
+    async def scenario():
+        board = Broadcaster(queue_size=2, heartbeat=60)
+        streams = [board.stream() for _ in range(3)]
+        for stream in streams:
+            assert await anext(stream) == b"retry: 3000\n\n"
+        assert board.subscribers == 3
+
+        # Every client gets the same frame
+        board.publish("solve", {"points": 50})
+        for stream in streams:
+            assert await anext(stream) == encode_event("solve", {"points": 50})
+
+        # The last one stops reading, the third event overflows its queue
+        fast, slow = streams[:2], streams[2]
+        for points in (1, 2, 3):
+            board.publish("solve", {"points": points})
+            for stream in fast:
+                assert await anext(stream) == encode_event("solve", {"points": points})
+        assert board.dropped == 1
+        assert board.subscribers == 2
+        with pytest.raises(StopAsyncIteration):
+            await anext(slow)
+
+        board.close()
+        for stream in fast:
+            with pytest.raises(StopAsyncIteration):
+                await anext(stream)
+        assert board.subscribers == 0
+
+    asyncio.run(scenario())
+
+
+def test_broadcaster_heartbeat():
+    from src.users.scoreboard_stream import Broadcaster
+
+    async def scenario():
+        stream = Broadcaster(heartbeat=0.01).stream()
+        assert await anext(stream) == b"retry: 3000\n\n"
+        assert await anext(stream) == b": ping\n\n"
+        assert await anext(stream) == b": ping\n\n"
+        await stream.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_scoreboard_stream_sees_solves(client, session):
+    import httpx
+    from src.users.scoreboard_stream import broadcaster
+
+    user = models.User(username="streamer", email="streamer@test.org", password=models.hash_password("pw"))
+    challenge = models.Challenge(title="Stream", category="Test", description="", points=75, flag="stream-flag")
+    session.add_all([user, challenge])
+    session.commit()
+    flag_index.rebuild(session)
+    leaderboard.load(session)
+    app = client.app
+
+    async def scenario():
+        # The stream never ends by itself, so it is driven over plain ASGI
+        # to read its frames as they come
+        frames = asyncio.Queue()
+
+        async def receive():
+            await asyncio.Event().wait()
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                frames.put_nowait(dict(message["headers"])[b"content-type"])
+            elif message.get("body"):
+                frames.put_nowait(message["body"])
+
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+            "scheme": "http", "path": "/api/stream/scoreboard", "raw_path": b"/api/stream/scoreboard",
+            "root_path": "", "query_string": b"", "headers": [], "server": ("test", 80), "client": ("test", 1),
+        }
+        request = asyncio.create_task(app(scope, receive, send))
+        assert (await asyncio.wait_for(frames.get(), 5)).startswith(b"text/event-stream")
+        assert await asyncio.wait_for(frames.get(), 5) == b"retry: 3000\n\n"
+
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as http:
+            assert (await http.post("/api/login", json={"identifier": "streamer", "password": "pw"})).status_code == 200
+            assert (await http.post("/api/Challenge", json={"flag": "stream-flag"})).json()["success"] is True
+
+        frame = (await asyncio.wait_for(frames.get(), 5)).decode()
+        broadcaster.close()
+        await asyncio.wait_for(request, 5)
+        return frame
+
+    frame = asyncio.run(scenario())
+    assert frame.startswith("event: solve\ndata: ")
+    event = json.loads(frame.split("data: ", 1)[1])
+    assert event["username"] == "streamer"
+    assert event["points"] == event["score"] == 75
+    assert event["rank"] == 1
+
+
+def test_sqlite_connections_get_the_pragmas(tmp_path):
+    import subprocess
+    import sys
+    from src import database
+
+    def pragmas(connection):
+        return {
+            name: connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+            for name in ("journal_mode", "synchronous", "busy_timeout", "cache_size", "foreign_keys")
+        }
+
+    engine = database.create_db_engine(f"sqlite:///{tmp_path / 'pragmas.db'}")
+    with engine.connect() as connection:
+        assert pragmas(connection) == {
+            "journal_mode": "wal", "synchronous": 1, "busy_timeout": database.SQLITE_BUSY_TIMEOUT,
+            "cache_size": -database.SQLITE_CACHE_SIZE_KB, "foreign_keys": int(database.SQLITE_FOREIGN_KEYS),
+        }
+    engine.dispose()
+
+    # The settings are read at import, so the overrides get a fresh interpreter
+    script = (
+        "import json\n"
+        "from src import database\n"
+        "with database.engine.connect() as connection:\n"
+        "    print(json.dumps({name: connection.exec_driver_sql(f'PRAGMA {name}').scalar()\n"
+        "                      for name in ('journal_mode', 'busy_timeout', 'cache_size', 'foreign_keys')}))\n"
+    )
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{tmp_path / 'override.db'}",
+               SQLITE_BUSY_TIMEOUT="1234", SQLITE_CACHE_SIZE_KB="2048", SQLITE_FOREIGN_KEYS="yes")
+    output = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True,
+                            check=True, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout
+    assert json.loads(output) == {"journal_mode": "wal", "busy_timeout": 1234, "cache_size": -2048, "foreign_keys": 1}
+
+
+def query_plan(session, sql, params=()):
+    rows = session.connection().exec_driver_sql("EXPLAIN QUERY PLAN " + sql, params).all()
+    return " | ".join(row[-1] for row in rows)
+
+
+@pytest.mark.parametrize("sql, params, index", [
+    ("SELECT id FROM challengesolve WHERE user_id = ? AND challenge_id = ?",
+     ("0" * 32, 1), "uq_challengesolve_user_challenge"),
+    ("SELECT count(*) FROM challengesolve WHERE challenge_id = ?",
+     (1,), "ix_challengesolve_challenge_id"),
+    ("SELECT user_id, max(solved_at) FROM challengesolve GROUP BY user_id",
+     (), "COVERING INDEX ix_challengesolve_user_solved_at"),
+    ("SELECT id, rating, comment FROM challengereview WHERE challenge_id = ? ORDER BY created_at DESC",
+     (1,), "ix_challengereview_challenge_created"),
+    ("SELECT id, points FROM challenge WHERE flag = ?",
+     ("flag",), "ix_challenge_flag"),
+    ("SELECT id, username, score FROM user ORDER BY score DESC, id LIMIT 50",
+     (), "ix_user_score_id"),
+    ("SELECT id, username, score FROM user WHERE score <= ? AND (score < ? OR id > ?) "
+     "ORDER BY score DESC, id LIMIT 50",
+     (10, 10, "x"), "SEARCH user USING INDEX ix_user_score_id"),
+])
+def test_hot_queries_use_their_index(session, sql, params, index):
+    plan = query_plan(session, sql, params)
+    assert index in plan, plan
+    assert "TEMP B-TREE" not in plan, plan
+
+
+def test_migrations_upgrade_an_old_database(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    SQLModel.metadata.create_all(engine)
+    with engine.begin() as conn:
+        # What a database created before the unique index looked like
+        conn.exec_driver_sql("DROP INDEX uq_challengesolve_user_challenge")
+        conn.exec_driver_sql("ALTER TABLE user DROP COLUMN avatar_variants")
+        conn.exec_driver_sql(
+            "INSERT INTO challenge (id, title, category, description, points, flag, created_at) "
+            "VALUES (1, 'Old', 'Test', '', 50, 'old', '2024-01-01 00:00:00')")
+        # The triple solve was awarded three times, the other score is untouched
+        conn.exec_driver_sql(
+            "INSERT INTO user (id, username, email, password, created_at, score, is_admin, is_active) "
+            "VALUES (?, ?, ?, 'x', '2024-01-01 00:00:00', ?, 0, 1)",
+            [(str(uuid.UUID("a" * 32)), "twice", "twice@test.org", 150),
+             (str(uuid.UUID("b" * 32)), "clean", "clean@test.org", 70)],
+        )
+        for _ in range(3):
+            conn.exec_driver_sql(
+                "INSERT INTO challengesolve (user_id, challenge_id, solved_at) VALUES (?, ?, ?)",
+                ("a" * 32, 1, "2024-01-01 00:00:00"),
+            )
+
+    assert migrations.apply_migrations(engine) == [m.version for m in migrations.MIGRATIONS]
+    assert migrations.apply_migrations(engine) == []
+    with Session(engine) as session:
+        assert session.exec(select(func.count()).select_from(models.ChallengeSolve)).one() == 1
+        assert "uq_challengesolve_user_challenge" in query_plan(
+            session, "SELECT id FROM challengesolve WHERE user_id = ? AND challenge_id = ?", ("a" * 32, 1))
+        session.exec(select(models.User.avatar_variants)).all()
+        scores = dict(session.exec(select(models.User.username, models.User.score)).all())
+        assert scores == {"twice": 50, "clean": 70}
+
+
+def test_users_keyset_pages_cover_every_player_once(client, session):
+    session.add_all([
+        models.User(username=f"p{i}", email=f"p{i}@test.org", password="x", score=(i % 4) * 10)
+        for i in range(23)
+    ])
+    session.commit()
+
+    seen = []
+    params = {"limit": 5}
+    while True:
+        response = client.get("/api/users", params=params)
+        assert response.status_code == 200
+        seen += response.json()
+        if "X-Next-Cursor" not in response.headers:
+            break
+        params["cursor"] = response.headers["X-Next-Cursor"]
+
+    assert len({user["id"] for user in seen}) == 23
+    assert [user["score"] for user in seen] == sorted((user["score"] for user in seen), reverse=True)
+    assert "email" not in seen[0]
+
+    lines = client.get("/api/users", params={"format": "ndjson"}).text.splitlines()
+    assert [json.loads(line)["id"] for line in lines] == [user["id"] for user in seen]
+
+
+def test_profile_picture_upload_is_checked(client, session, tmp_path, monkeypatch):
+    upload_dir = tmp_path / "uploads"
+    monkeypatch.setattr(uploads, "UPLOAD_DIR", str(upload_dir))
+    monkeypatch.setattr(uploads, "UPLOAD_MAX_BYTES", 1024)
+    user = models.User(username="uploader", email="up@test.org", password=models.hash_password("pw"))
+    session.add(user)
+    session.commit()
+    assert client.post("/api/login", json={"identifier": "uploader", "password": "pw"}).status_code == 200
+
+    def upload(name, content):
+        return client.post("/api/Profile/upload/", files={"file": (name, content)}, follow_redirects=False)
+
+    png = b"\x89PNG\r\n\x1a\n" + b"\0" * 100
+    digest = hashlib.sha256(png).hexdigest()
+    # The extension comes from the content, not the client's file name
+    assert upload("me.exe", png).status_code == 303
+    session.refresh(user)
+    assert user.profile_picture == f"{digest[:2]}/{digest[2:4]}/{digest}.png"
+    assert (upload_dir / user.profile_picture).read_bytes() == png
+
+    assert upload("me.png", b"<?php echo 1; ?>").status_code == 415
+    assert upload("big.png", png + b"\0" * 2048).status_code == 413
+    # Rejected uploads leave nothing behind
+    assert [p.relative_to(upload_dir).as_posix() for p in upload_dir.rglob("*") if p.is_file()] == [user.profile_picture]
+
+
+def test_avatar_variants_are_generated(client, session, tmp_path, monkeypatch):
+    Image = pytest.importorskip("PIL.Image")
+    import io
+    from src.users import avatars
+
+    upload_dir = tmp_path / "uploads"
+    monkeypatch.setattr(uploads, "UPLOAD_DIR", str(upload_dir))
+    user = models.User(username="avatar", email="avatar@test.org", password=models.hash_password("pw"))
+    session.add(user)
+    session.commit()
+    assert client.post("/api/login", json={"identifier": "avatar", "password": "pw"}).status_code == 200
+
+    picture = io.BytesIO()
+    Image.new("RGB", (300, 200), "red").save(picture, format="PNG")
+    response = client.post("/api/Profile/upload/", files={"file": ("me.png", picture.getvalue())},
+                           follow_redirects=False)
+    assert response.status_code == 303
+
+    session.refresh(user)
+    # 256 is larger than the picture, so it is skipped
+    assert sorted(user.avatar_variants, key=int) == ["64", "128"]
+    with Image.open(upload_dir / user.avatar_variants["64"]) as variant:
+        assert variant.size == (64, 64)
+
+    assert avatars.avatar_url(user.profile_picture, user.avatar_variants, 100) == "/uploads/" + user.avatar_variants["128"]
+    assert avatars.avatar_url(user.profile_picture, user.avatar_variants, 500) == "/uploads/" + user.avatar_variants["128"]
+    assert avatars.avatar_url(user.profile_picture, None, 64) == "/uploads/" + user.profile_picture
+
+    # Uploading the same picture again reuses the variants and restarts
+    # their GC grace period
+    variant = upload_dir / user.avatar_variants["64"]
+    os.utime(variant, (0, 0))
+    client.post("/api/Profile/upload/", files={"file": ("again.png", picture.getvalue())}, follow_redirects=False)
+    assert variant.stat().st_mtime > 0
+
+    # Too many pixels to decode safely, the original is kept as it is
+    monkeypatch.setattr(avatars, "AVATAR_MAX_PIXELS", 300 * 200 - 1)
+    assert asyncio.run(avatars.generate(user.profile_picture)) is None
+    avatars.shutdown()
+
+
+def test_uploads_are_deduplicated_and_collected(client, session, tmp_path, monkeypatch):
+    upload_dir = tmp_path / "uploads"
+    monkeypatch.setattr(uploads, "UPLOAD_DIR", str(upload_dir))
+    users = [
+        models.User(username=f"dedupe{i}", email=f"dedupe{i}@test.org", password=models.hash_password("pw"))
+        for i in range(2)
+    ]
+    session.add_all(users)
+    session.commit()
+
+    def upload_as(user, content):
+        client.cookies.clear()
+        assert client.post("/api/login", json={"identifier": user.username, "password": "pw"}).status_code == 200
+        response = client.post("/api/Profile/edit/", files={"file": ("me.gif", content)}, follow_redirects=False)
+        assert response.status_code == 303
+        session.refresh(user)
+        return user.profile_picture
+
+    first = b"GIF89a" + b"\1" * 50
+    second = b"GIF89a" + b"\2" * 50
+    # Same picture, one file
+    assert upload_as(users[0], first) == upload_as(users[1], first)
+    upload_as(users[0], second)
+    current = upload_as(users[1], second)
+    stored = {p.relative_to(upload_dir).as_posix() for p in upload_dir.rglob("*") if p.is_file()}
+    assert len(stored) == 2
+
+    referenced = uploads.referenced_files(session)
+    # Inside the grace period nothing goes
+    assert uploads.collect_garbage(referenced, str(upload_dir)) == []
+    removed = uploads.collect_garbage(referenced, str(upload_dir), grace=0)
+    assert removed == [name for name in stored if name != current]
+    assert (upload_dir / current).exists()
+    # Emptied shard directories are removed too
+    assert len(list(upload_dir.iterdir())) == 1
+
+
+def test_metrics_are_labelled_by_route(client):
+    from src import metrics
+
+    metrics.registry.clear()
+    client.get("/api/users", params={"limit": 5})
+    client.get("/api/users", params={"limit": 5})
+    client.get("/no/such/page")
+    client.get("/static/CSS/styles.css")
+
+    assert metrics.REQUESTS.value("GET", "/api/users", "200") == 2
+    assert metrics.REQUESTS.value("GET", metrics.UNMATCHED_ROUTE, "404") == 1
+    assert metrics.REQUESTS.value("GET", "/static/{path}", "200") == 1
+    assert metrics.LATENCY.count("GET", "/api/users") == 2
+
+    body = client.get("/metrics").text
+    assert '# TYPE http_request_duration_seconds histogram' in body
+    assert 'http_request_duration_seconds_count{method="GET",route="/api/users"} 2' in body
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/api/users",le="+Inf"} 2' in body
+    assert 'http_requests_in_progress{method="GET"} 1' in body
+
+
+def test_request_query_counts(client, session):
+    from src import query_stats
+
+    user = models.User(username="budget", email="budget@test.org", password=models.hash_password("pw"))
+    challenge = models.Challenge(title="Budget", category="Test", description="", points=10, flag="budget-flag")
+    session.add_all([user, challenge])
+    session.commit()
+    flag_index.rebuild(session)
+    leaderboard.load(session)
+    assert client.post("/api/login", json={"identifier": "budget", "password": "pw"}).status_code == 200
+
+    with query_stats.capture() as captured:
+        response = client.get("/api/users", params={"limit": 5})
+    assert response.headers["Server-Timing"].startswith("db;dur=")
+    (route, stats), = captured
+    assert route == "/api/users"
+    assert f'desc="{stats.count} queries"' in response.headers["Server-Timing"]
+
+    with utils.query_budget(1, route="/api/users"):
+        client.get("/api/users", params={"limit": 5})
+    with utils.query_budget(3, route="/api/Challenge"):
+        assert client.post("/api/Challenge", json={"flag": "budget-flag"}).json()["success"] is True
+    with pytest.raises(AssertionError, match="budget is 0"):
+        with utils.query_budget(0, route="/api/users"):
+            client.get("/api/users", params={"limit": 5})
+
+
+def test_logging_is_structured_and_quiet(client, session, caplog, monkeypatch):
+    import io
+    import logging
+    from src import logging_config
+
+    # Everything logged goes through the listener thread, listen in on it
+    listener = logging_config._listener
+    lines = io.StringIO()
+    capture = logging.StreamHandler(lines)
+    monkeypatch.setattr(listener, "handlers", listener.handlers + (capture,))
+    # The token is issued with a DEBUG line, which must not carry it
+    caplog.set_level(logging.DEBUG, logger="src.auth.service")
+
+    user = models.User(username="quiet", email="quiet@test.org", password=models.hash_password("pw"))
+    session.add(user)
+    session.commit()
+    response = client.post("/api/login", json={"identifier": "quiet", "password": "pw"},
+                           headers={"X-Request-ID": "req-123"})
+    assert response.headers["X-Request-ID"] == "req-123"
+
+    # Stopping drains the queue, then carry on as before
+    listener.stop()
+    listener.start()
+    entries = [json.loads(line) for line in lines.getvalue().splitlines()]
+    issued = [entry for entry in entries if entry["message"] == f"Issuing user token for {user.id}"]
+    assert len(issued) == 1
+    assert issued[0]["request_id"] == "req-123"
+    assert issued[0]["level"] == "DEBUG" and issued[0]["logger"] == "src.auth.service"
+    assert set(issued[0]) >= {"ts", "level", "logger", "message", "request_id"}
+    assert response.cookies["access_token"] not in lines.getvalue()
+
+    assert len(client.get("/api/users", headers={"X-Request-ID": "bad id\n"}).headers["X-Request-ID"]) == 32
+
+    record = logging.LogRecord("src.test", logging.INFO, __file__, 1, "hello %s", ("there",), None)
+    record.request_id = "req-123"
+    record.user_id = "u1"
+    entry = json.loads(logging_config.JsonFormatter().format(record))
+    assert entry["message"] == "hello there"
+    assert entry["request_id"] == "req-123"
+    assert entry["user_id"] == "u1"
+
+
+def test_admins_can_profile_a_request(client, session, tmp_path, monkeypatch):
+    from src import profiling
+
+    monkeypatch.setattr(profiling, "PROFILE_DIR", str(tmp_path / "profiles"))
+    monkeypatch.setattr(profiling, "PROFILE_KEEP", 2)
+    admin = models.User(username="profiler", email="profiler@test.org",
+                        password=models.hash_password("pw"), is_admin=True)
+    player = models.User(username="curious", email="curious@test.org", password=models.hash_password("pw"))
+    session.add_all([admin, player])
+    session.commit()
+
+    # Ignored for anyone but an admin
+    assert client.post("/api/login", json={"identifier": "curious", "password": "pw"}).status_code == 200
+    response = client.get("/api/users", headers={"X-Profile": "inline"})
+    assert response.headers["content-type"].startswith("application/json")
+    assert "X-Profile-Id" not in client.get("/api/users", headers={"X-Profile": "1"}).headers
+    assert client.get("/api/admin/profiles").status_code == 403
+
+    client.cookies.clear()
+    assert client.post("/api/login", json={"identifier": "profiler", "password": "pw"}).status_code == 200
+    report = client.get("/api/users", headers={"X-Profile": "inline"}).text
+    assert report.startswith("GET /api/users -> 200") and "cumulative" in report
+
+    ids = [client.get("/api/users", params={"_profile": "1"}).headers["X-Profile-Id"] for _ in range(3)]
+    listed = client.get("/api/admin/profiles").json()
+    # Only the newest PROFILE_KEEP are kept
+    assert [meta["id"] for meta in listed] == ids[:0:-1]
+    assert listed[0]["route"] == "/api/users"
+
+    assert "function calls" in client.get(f"/api/admin/profiles/{ids[-1]}", params={"format": "text"}).text
+    assert client.get(f"/api/admin/profiles/{ids[-1]}").content
+    assert client.get(f"/api/admin/profiles/{ids[0]}").status_code == 404
+    assert client.get("/api/admin/profiles/..%2F..%2Fdatabase").status_code == 404
+
+    # The admin check reads the user on the app's async session
+    from src.auth import service as auth_service
+    monkeypatch.setattr(auth_service, "ADMIN_AUTH_MODE", "database")
+    assert "X-Profile-Id" in client.get("/api/users", headers={"X-Profile": "1"}).headers
+
+
+def test_benchmarks_report_and_compare():
+    results = benchmarks.run(["flag_wrong", "users", "challenge_page"], iterations=20, concurrency=4, players=50)
+    for name, result in results.items():
+        assert result["requests"] == 20 and result["errors"] == 0, name
+        assert result["p50_ms"] <= result["p95_ms"] <= result["p99_ms"]
+        assert result["throughput_rps"] > 0
+
+    assert benchmarks.compare(results, results, tolerance=0.25) == []
+    slower = {name: dict(result, p95_ms=result["p95_ms"] * 2) for name, result in results.items()}
+    assert benchmarks.compare(slower, results, tolerance=0.25) == [
+        f"{name}: p95_ms {slower[name]['p95_ms']} vs baseline {results[name]['p95_ms']}" for name in results
+    ]
+    assert benchmarks.percentile([1.0, 2.0, 3.0, 4.0], 50) == 2.0
+    assert benchmarks.percentile([1.0, 2.0, 3.0, 4.0], 99) == 4.0
+
+
+def test_generated_dataset_is_consistent(client, session, generate_dataset):
+    summary = generate_dataset(users=400, challenges=20, solves=3_000, reviews=200, seed=7)
+    assert summary["users"] == 400 and summary["reviews"] == 200
+    assert abs(summary["solves"] - 3_000) < 150
+
+    conn = session.connection()
+    assert conn.exec_driver_sql("SELECT COUNT(*) FROM challengesolve").scalar() == summary["solves"]
+    # Scores add up to the points of the solves
+    mismatched = conn.exec_driver_sql(
+        "SELECT COUNT(*) FROM user u WHERE u.score != (SELECT COALESCE(SUM(c.points), 0) "
+        "FROM challengesolve s JOIN challenge c ON c.id = s.challenge_id WHERE s.user_id = REPLACE(u.id, '-', ''))"
+    ).scalar()
+    assert mismatched == 0
+    # Power law, some solve everything and lots solve one or nothing
+    per_user = sorted((count for (count,) in conn.exec_driver_sql(
+        "SELECT COUNT(*) FROM challengesolve GROUP BY user_id")), reverse=True)
+    assert per_user[0] == 20
+    assert 400 - len(per_user) + per_user.count(1) > 400 / 5
+    # and the indexes dropped for the load are back
+    indexes = {name for (name,) in conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {"uq_challengesolve_user_challenge", "ix_user_score_id"} <= indexes
+
+    # The fixture brought the leaderboard and the flag index up to date
+    top = client.get("/api/users", params={"limit": 1}).json()[0]
+    assert top["score"] == conn.exec_driver_sql("SELECT MAX(score) FROM user").scalar()
+    assert len(leaderboard) == 400
+    assert flag_index.lookup(session, "flag{dataset-7-0}").points == 50
+    assert client.post("/api/login", json={
+        "identifier": "player7-0", "password": dataset.DATASET_PASSWORD}).status_code == 200
+
+    # Into tables that already have rows, the indexes stay put
+    statements = []
+    sqlite = session.connection().connection.driver_connection
+    sqlite.set_trace_callback(statements.append)
+    try:
+        generate_dataset(users=10, challenges=0, solves=0, reviews=0, seed=8)
+    finally:
+        sqlite.set_trace_callback(None)
+    assert any(sql.startswith("INSERT INTO user") for sql in statements)
+    assert not any(sql.startswith("DROP INDEX") for sql in statements)
+    assert len(leaderboard) == 410
+
+
+def test_admins_can_bulk_import_users(client, session):
+    session.add_all([
+        models.User(username="registrar", email="registrar@test.org",
+                    password=models.hash_password("pw"), is_admin=True),
+        models.User(username="taken", email="taken@test.org", password="x"),
+    ])
+    session.commit()
+    assert client.post("/api/login", json={"identifier": "registrar", "password": "pw"}).status_code == 200
+
+    cohort = (
+        "username,email,password,country,is_admin\n"
+        "ada,ada@uni.ac.uk,first-pw,GB,\n"
+        "taken,other@uni.ac.uk,pw,,\n"
+        "grace,grace@uni.ac.uk,second-pw,,yes\n"
+        "linus,ada@uni.ac.uk,pw,,\n"
+        "nopass,nopass@uni.ac.uk,,,\n"
+    )
+    response = client.post("/api/admin/users/import", content=cohort, headers={"Content-Type": "text/csv"})
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines[-1] == {"summary": {"rows": 5, "created": 2, "failed": 3}}
+    by_row = {line["row"]: line for line in lines[:-1]}
+    assert {row: line["status"] for row, line in by_row.items()} == {
+        1: "created", 2: "error", 3: "created", 4: "error", 5: "error"}
+    assert by_row[2]["error"] == "Username already taken"
+    assert by_row[4]["error"] == "Duplicate email in file"
+
+    grace = session.exec(select(models.User).where(models.User.username == "grace")).one()
+    assert grace.is_admin and grace.verify_password("second-pw")
+    assert client.post("/api/login", json={"identifier": "ada", "password": "first-pw"}).status_code == 200
+
+    # Not an admin any more, and a broken file is refused outright
+    assert client.post("/api/admin/users/import", content=cohort).status_code == 403
+    client.cookies.clear()
+    client.post("/api/login", json={"identifier": "registrar", "password": "pw"})
+    response = client.post("/api/admin/users/import", params={"format": "json"}, content=b'{"username": "x"}')
+    assert response.status_code == 400
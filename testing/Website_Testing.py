@@ -0,0 +1,195 @@
+"""
+Website (HTML page) tests
+"""
+
+import asyncio
+import time
+from urllib.parse import urlencode
+
+import pytest
+
+
+def timed_get(app, path: str, params: dict) -> tuple[float, float, int]:
+    """
+    Call the ASGI app directly, TestClient buffers whole responses so
+    it cannot see when the first byte went out.
+
+    Returns (time to first byte, total time, body size).
+    """
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "GET", "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": urlencode(params).encode(), "headers": [(b"host", b"testserver")],
+        "client": ("testclient", 50000), "server": ("testserver", 80), "root_path": "",
+    }
+    timings = {"first": None, "size": 0}
+
+    async def run():
+        disconnected = asyncio.Event()
+        request_sent = False
+
+        async def receive():
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.body" and message.get("body"):
+                if timings["first"] is None:
+                    timings["first"] = time.perf_counter()
+                timings["size"] += len(message["body"])
+
+        start = time.perf_counter()
+        await app(scope, receive, send)
+        disconnected.set()
+        return start, time.perf_counter()
+
+    start, end = asyncio.run(run())
+    return timings["first"] - start, end - start, timings["size"]
+
+
+@pytest.fixture(name="big_client")
+def big_client_fixture(client, generate_dataset):
+    generate_dataset(users=50_000, challenges=0, solves=0, reviews=0)
+    return client
+
+
+def test_user_list_is_paginated(big_client):
+    response = big_client.get("/user.html", params={"limit": 100})
+    assert response.status_code == 200
+    assert response.text.count("<tr>") == 101  # header row + one page
+    assert "cursor=" in response.text
+
+
+def test_user_list_benchmark(big_client, record_property):
+    """
+    Page size and time to first byte on 50k players, paged vs streamed.
+    """
+    app = big_client.app
+    page_ttfb, page_time, page_size = timed_get(app, "/user.html", {})
+    stream_ttfb, stream_time, stream_size = timed_get(app, "/user.html", {"stream": "true"})
+
+    for name, value in [
+        ("page_bytes", page_size), ("page_ttfb", page_ttfb), ("page_seconds", page_time),
+        ("stream_bytes", stream_size), ("stream_ttfb", stream_ttfb), ("stream_seconds", stream_time),
+    ]:
+        record_property(name, value)
+    print(f"\npage: {page_size} bytes, first byte {page_ttfb:.4f}s, total {page_time:.4f}s"
+          f"\nstream: {stream_size} bytes, first byte {stream_ttfb:.4f}s, total {stream_time:.4f}s")
+
+    # One page stays small however many players there are
+    assert page_size < 50_000
+    # The full list is large, but its first bytes go out long before the end
+    assert stream_size > 40 * page_size
+    assert stream_ttfb < stream_time / 5
+
+
+@pytest.mark.parametrize("path", ["/challenge/1", "/tutorial/3", "/Review-Submission/5"])
+def test_static_pages_are_cached(client, path):
+    plain = client.get(path, headers={"Accept-Encoding": "identity"})
+    assert plain.status_code == 200
+    assert "Content-Encoding" not in plain.headers
+    assert 'href="/static/CSS/styles.css"' in plain.text or "/static/" not in plain.text
+
+    compressed = client.get(path, headers={"Accept-Encoding": "gzip"})
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert compressed.text == plain.text
+    assert compressed.headers["ETag"] != plain.headers["ETag"]
+
+    for refused in ("gzip;q=0", "gzip; q=0.0, identity", "br, *;q=0"):
+        assert "Content-Encoding" not in client.get(path, headers={"Accept-Encoding": refused}).headers
+    assert client.get(path, headers={"Accept-Encoding": "br;q=1, *;q=0.5"}).headers["Content-Encoding"] == "gzip"
+
+    revalidated = client.get(path, headers={"Accept-Encoding": "identity", "If-None-Match": plain.headers["ETag"]})
+    assert revalidated.status_code == 304
+    assert revalidated.content == b""
+    # The other variant's tag is not a match
+    changed = client.get(path, headers={"Accept-Encoding": "identity", "If-None-Match": compressed.headers["ETag"]})
+    assert changed.status_code == 200 and changed.content == plain.content
+
+
+def test_unknown_static_page_is_404(client):
+    assert client.get("/challenge/6").status_code == 404
+
+
+def test_assets_are_fingerprinted(tmp_path):
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    from src import assets
+
+    manifest = assets.build(assets.ASSET_SOURCE_DIR, str(tmp_path))
+    hashed = manifest["CSS/styles.css"]
+    assert hashed.startswith("CSS/styles.") and hashed.endswith(".css")
+    assert (tmp_path / (hashed + ".gz")).exists()
+    # Rebuilding unchanged files gives the same names
+    assert assets.build(assets.ASSET_SOURCE_DIR, str(tmp_path)) == manifest
+
+    assets.load_manifest(str(tmp_path))
+    try:
+        assert assets.asset_url("CSS/styles.css") == "/assets/" + hashed
+        assert assets.asset_url("nope.js") == "/static/nope.js"
+    finally:
+        assets.load_manifest(str(tmp_path / "missing"))
+
+    app = FastAPI()
+    app.mount("/assets", assets.ImmutableStaticFiles(directory=str(tmp_path)), name="assets")
+    client = TestClient(app)
+
+    plain = client.get("/assets/" + hashed, headers={"Accept-Encoding": "identity"})
+    assert plain.status_code == 200
+    assert "immutable" in plain.headers["Cache-Control"]
+    assert "Content-Encoding" not in plain.headers
+
+    compressed = client.get("/assets/" + hashed, headers={"Accept-Encoding": "gzip"})
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert compressed.headers["Content-Type"].startswith("text/css")
+    assert compressed.content == plain.content
+    refused = client.get("/assets/" + hashed, headers={"Accept-Encoding": "gzip;q=0, br;q=0"})
+    assert "Content-Encoding" not in refused.headers
+
+    # Revalidation is against the variant being sent, and 304s keep the caching headers
+    cached = client.get("/assets/" + hashed, headers={"Accept-Encoding": "gzip", "If-None-Match": compressed.headers["ETag"]})
+    assert cached.status_code == 304
+    assert "immutable" in cached.headers["Cache-Control"] and cached.headers["Vary"] == "Accept-Encoding"
+    other = client.get("/assets/" + hashed, headers={"Accept-Encoding": "gzip", "If-None-Match": plain.headers["ETag"]})
+    assert other.status_code == 200 and other.headers["Content-Encoding"] == "gzip"
+    cached = client.get("/assets/" + hashed, headers={"Accept-Encoding": "identity", "If-None-Match": plain.headers["ETag"]})
+    assert cached.status_code == 304 and "immutable" in cached.headers["Cache-Control"]
+
+    # The highest q wins, br only on a tie
+    (tmp_path / (hashed + ".br")).write_bytes(b"not really brotli")
+    assert client.get("/assets/" + hashed, headers={"Accept-Encoding": "gzip;q=1, br;q=0.1"}).headers["Content-Encoding"] == "gzip"
+    assert client.get("/assets/" + hashed, headers={"Accept-Encoding": "gzip, br"}).headers["Content-Encoding"] == "br"
+
+    # A lost sibling is rebuilt
+    (tmp_path / (hashed + ".gz")).unlink()
+    assets.build(assets.ASSET_SOURCE_DIR, str(tmp_path))
+    assert (tmp_path / (hashed + ".gz")).exists()
+
+
+def test_site_bundle(tmp_path):
+    from src import assets
+
+    assert assets.minify_js('  const a = "http://x"; // note\n\n/* block */b();\n') == 'const a = "http://x";\nb();\n'
+    # Comment markers inside strings and template literals are kept
+    source = 'const glob = "src/*.js"; /* real */ const t = `/* not\n a comment */`;\nlet u = \'//x\' // gone\n'
+    assert assets.minify_js(source) == 'const glob = "src/*.js";  const t = `/* not\na comment */`;\nlet u = \'//x\'\n'
+    assert assets.minify_js("a()/* spans\nlines */b()\n") == "a()\nb()\n"
+
+    # Unbuilt, every source is linked on its own
+    assets.load_manifest(str(tmp_path / "missing"))
+    assert assets.bundle_scripts("site").count("<script") == len(assets.BUNDLES["JavaScript/site.js"])
+
+    manifest = assets.build(assets.ASSET_SOURCE_DIR, str(tmp_path))
+    assets.load_manifest(str(tmp_path))
+    try:
+        tags = assets.bundle_scripts("site")
+        assert tags == f'<script src="/assets/{manifest["JavaScript/site.js"]}"></script>'
+    finally:
+        assets.load_manifest(str(tmp_path / "missing"))
+
+    walk = assets.report(assets.ASSET_SOURCE_DIR, str(tmp_path))["walk"]
+    assert walk["bundled"]["requests"] < walk["unbundled"]["requests"]
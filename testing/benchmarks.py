@@ -0,0 +1,302 @@
+"""
+In-process benchmarks for the hot endpoints.
+
+Each scenario fires its requests through httpx.AsyncClient straight into
+create_app() (no server, no network), a few at a time, against a fresh
+database in a temp directory. The report is JSON, per scenario:
+
+    {"users": {"requests": 500, "errors": 0, "p50_ms": 2.1, "p95_ms": 3.4,
+               "p99_ms": 5.0, "mean_ms": 2.3, "throughput_rps": 1710.2}, ...}
+
+Run from the repository root:
+
+    python -m testing.benchmarks                        everything, JSON on stdout
+    python -m testing.benchmarks -s users -s login      just some scenarios
+    python -m testing.benchmarks -o baseline.json       also save the report
+    python -m testing.benchmarks --baseline baseline.json
+        compare with a saved report, exit 1 when a scenario's p50 / p95
+        got slower or its throughput dropped by more than --tolerance
+
+Timings depend on the machine, only compare with a baseline taken on the
+same one.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import struct
+import sys
+import tempfile
+import time
+import uuid
+import zlib
+from typing import Awaitable, Callable, NamedTuple, Optional
+
+import httpx
+from sqlmodel import SQLModel, Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from src import database
+from src import migrations
+from src.auth import hashing
+from src.main import create_app
+from src.users import avatars
+from src.users import flag_index
+from src.users import models
+from src.users import uploads
+from src.users.leaderboard import leaderboard
+from testing import dataset
+
+BENCH_PASSWORD = "bench-password"
+DEFAULT_CONCURRENCY = 10
+DEFAULT_PLAYERS = 2000
+# Compared against the baseline, lower is better except for throughput
+COMPARED = ("p50_ms", "p95_ms", "throughput_rps")
+
+
+class Scenario(NamedTuple):
+    # Builds and sends request number i, returns the response
+    send: Callable[[httpx.AsyncClient, int], Awaitable[httpx.Response]]
+    expected: tuple
+    iterations: int
+    logged_in: bool = False
+
+
+def _png(seed: int, size: int = 256) -> bytes:
+    """
+    A valid, solid colour PNG, different for every seed.
+    """
+    row = b"\x00" + bytes((seed % 256, (seed // 256) % 256, 90)) * size
+    raw = row * size
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b"")
+
+
+SCENARIOS = {
+    "login": Scenario(
+        lambda client, i: client.post("/api/login", json={"identifier": "bench", "password": BENCH_PASSWORD}),
+        (200,), 40,
+    ),
+    "signup": Scenario(
+        lambda client, i: client.post("/api/signup", json={
+            "username": f"signup-{i}-{uuid.uuid4().hex[:8]}", "email": f"signup-{i}-{uuid.uuid4().hex[:8]}@bench.org",
+            "password": BENCH_PASSWORD, "password_confirm": BENCH_PASSWORD,
+        }),
+        (201,), 40,
+    ),
+    "flag_right": Scenario(
+        lambda client, i: client.post("/api/Challenge", json={"flag": f"bench-flag-{i}"}),
+        (200,), 300, logged_in=True,
+    ),
+    "flag_wrong": Scenario(
+        lambda client, i: client.post("/api/Challenge", json={"flag": f"not-a-flag-{i}"}),
+        (400,), 500, logged_in=True,
+    ),
+    "users": Scenario(
+        lambda client, i: client.get("/api/users", params={"limit": 100}),
+        (200,), 500,
+    ),
+    "user_list_page": Scenario(
+        lambda client, i: client.get("/user.html", params={"limit": 100}),
+        (200,), 300,
+    ),
+    "challenge_page": Scenario(
+        lambda client, i: client.get(f"/challenge/{i % 5 + 1}"),
+        (200,), 500,
+    ),
+    "avatar_upload": Scenario(
+        lambda client, i: client.post("/api/Profile/upload/", files={"file": ("avatar.png", _png(i))}),
+        (303,), 40, logged_in=True,
+    ),
+}
+
+
+def seed(session: Session, players: int, challenges: int):
+    """
+    The bench login, a synthetic competition for the listings and a flag
+    for every flag_right request.
+    """
+    session.add(models.User(username="bench", email="bench@bench.org", password=models.hash_password(BENCH_PASSWORD)))
+    session.commit()
+    dataset.generate(session, users=players, challenges=50, solves=players * 5, reviews=players // 10)
+    if challenges:
+        session.connection().exec_driver_sql(
+            "INSERT INTO challenge (title, category, description, points, flag, created_at) "
+            "VALUES (?, 'Bench', '', ?, ?, '2024-01-01 00:00:00')",
+            [(f"Bench {i}", 10 + i % 50, f"bench-flag-{i}") for i in range(challenges)],
+        )
+    session.commit()
+
+
+def percentile(ordered: list[float], pct: float) -> float:
+    # Nearest rank
+    if not ordered:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarise(latencies: list[float], errors: int, elapsed: float) -> dict:
+    ordered = sorted(latencies)
+    count = len(ordered)
+    return {
+        "requests": count,
+        "errors": errors,
+        "p50_ms": round(percentile(ordered, 50) * 1000, 3),
+        "p95_ms": round(percentile(ordered, 95) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 99) * 1000, 3),
+        "mean_ms": round(sum(ordered) / count * 1000, 3) if count else 0.0,
+        "throughput_rps": round(count / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+async def run_scenario(app, scenario: Scenario, iterations: int, concurrency: int) -> dict:
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        if scenario.logged_in:
+            response = await client.post("/api/login", json={"identifier": "bench", "password": BENCH_PASSWORD})
+            response.raise_for_status()
+
+        latencies = []
+        errors = 0
+        next_request = 0
+
+        async def worker():
+            nonlocal errors, next_request
+            while next_request < iterations:
+                i = next_request
+                next_request += 1
+                start = time.perf_counter()
+                response = await scenario.send(client, i)
+                latencies.append(time.perf_counter() - start)
+                if response.status_code not in scenario.expected:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return summarise(latencies, errors, time.perf_counter() - start)
+
+
+def build_app(directory: str, players: int, challenges: int):
+    """
+    create_app() on a database of its own in directory.
+    """
+    db_path = os.path.join(directory, "bench.db")
+    engine = database.create_db_engine(f"sqlite:///{db_path}")
+    async_engine = database.create_async_db_engine(f"sqlite+aiosqlite:///{db_path}")
+    SQLModel.metadata.create_all(engine)
+    migrations.apply_migrations(engine)
+
+    with Session(engine) as session:
+        seed(session, players, challenges)
+        flag_index.rebuild(session)
+        leaderboard.load(session)
+
+    def get_session_override():
+        with Session(engine) as session:
+            yield session
+
+    async def get_async_session_override():
+        async with AsyncSession(async_engine, expire_on_commit=False) as session:
+            yield session
+
+    app = create_app()
+    app.dependency_overrides[database.get_session] = get_session_override
+    app.dependency_overrides[database.get_async_session] = get_async_session_override
+    return app
+
+
+def run(names: Optional[list] = None, iterations: Optional[int] = None,
+        concurrency: int = DEFAULT_CONCURRENCY, players: int = DEFAULT_PLAYERS) -> dict:
+    """
+    Run the named scenarios (all by default), returns the report.
+    iterations overrides every scenario's own request count.
+    """
+    names = names or list(SCENARIOS)
+    counts = {name: iterations or SCENARIOS[name].iterations for name in names}
+
+    with tempfile.TemporaryDirectory() as directory:
+        upload_dir = uploads.UPLOAD_DIR
+        uploads.UPLOAD_DIR = os.path.join(directory, "uploads")
+        try:
+            app = build_app(directory, players, counts.get("flag_right", 0))
+
+            async def run_all():
+                return {
+                    name: await run_scenario(app, SCENARIOS[name], counts[name], concurrency)
+                    for name in names
+                }
+
+            return asyncio.run(run_all())
+        finally:
+            uploads.UPLOAD_DIR = upload_dir
+            # The lifespan never ran, so its shutdown neither
+            hashing.shutdown()
+            avatars.shutdown()
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Regressions against a baseline report, as readable lines.
+    """
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if current["errors"] > previous.get("errors", 0):
+            regressions.append(f"{name}: {current['errors']} errors, baseline had {previous.get('errors', 0)}")
+        for key in COMPARED:
+            before, now = previous.get(key), current[key]
+            if not before:
+                continue
+            if key == "throughput_rps":
+                worse = now < before * (1 - tolerance)
+            else:
+                worse = now > before * (1 + tolerance)
+            if worse:
+                regressions.append(f"{name}: {key} {now} vs baseline {before}")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the hot endpoints in-process")
+    parser.add_argument("-s", "--scenario", action="append", choices=list(SCENARIOS),
+                        help="scenario to run, repeat for several (default all)")
+    parser.add_argument("-n", "--iterations", type=int, help="requests per scenario (default per scenario)")
+    parser.add_argument("-c", "--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--players", type=int, default=DEFAULT_PLAYERS, help="players in the database")
+    parser.add_argument("-o", "--output", help="write the JSON report here too")
+    parser.add_argument("--baseline", help="report to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown as a fraction of the baseline (default 0.25)")
+    args = parser.parse_args(argv)
+
+    # One line per request from httpx would drown the report
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    results = run(args.scenario, args.iterations, args.concurrency, args.players)
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print("REGRESSION " + line, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,13 +13,16 @@ import os
 import pytest
 from fastapi.testclient import TestClient
 from sqlmodel import SQLModel, Session, create_engine
-from sqlmodel.pool import StaticPool
-from webapp.main import create_app
-from webapp.database import get_session
+from sqlmodel.ext.asyncio.session import AsyncSession
+from src.main import create_app
+from src.database import get_session, get_async_session, create_async_db_engine
+from src import migrations
+from src.users import flag_index
+from src.users.leaderboard import leaderboard
 from unittest.mock import patch
 
 # And our utilites
-from testing import utils
+from testing import dataset, utils
 
 # Remove the somewhat irritating message on __about__ from passlib
 logging.getLogger("passlib").setLevel(logging.ERROR)
@@ -28,20 +31,28 @@ logging.getLogger("httpx").setLevel(logging.ERROR)
 
 os.environ["ENV"] = "TEST"
 
+@pytest.fixture(name="db_path")
+def db_path_fixture(tmp_path):
+    """
+    The testing database lives in a temporary file, so the sync
+    session and the routes on the async layer can share it.
+    """
+    return tmp_path / "testing.db"
+
+
 @pytest.fixture(name="session")
-def session_fixture():
+def session_fixture(db_path):
     """
     Overload the get_session dependency to give us
     an independent testing database.
-
-    The Database is in memory to avoid writing to disk
     """
 
     engine = create_engine(
-        "sqlite://", echo=False, connect_args={"check_same_thread": False}, poolclass=StaticPool
+        f"sqlite:///{db_path}", echo=False, connect_args={"check_same_thread": False}
     )
 
     SQLModel.metadata.create_all(engine)
+    migrations.apply_migrations(engine)
 
     with Session(engine) as session:
         utils.create_db(session)
@@ -55,22 +66,45 @@ def client():
 
 
 @pytest.fixture(name="client")
-def client_fixture(session: Session):
+def client_fixture(session: Session, db_path):
     """
     Fixture to set up the web client.
 
-    This creates the session override etc,
+    This creates the session overrides etc,
     and allows us to use the testing db
     """
+    async_engine = create_async_db_engine(f"sqlite+aiosqlite:///{db_path}")
 
     def get_session_override():
         return session
 
-    create_app.dependency_overrides[get_session] = get_session_override
-    client = TestClient(create_app)
+    async def get_async_session_override():
+        async with AsyncSession(async_engine, expire_on_commit=False) as async_session:
+            yield async_session
+
+    app = create_app()
+    app.dependency_overrides[get_session] = get_session_override
+    app.dependency_overrides[get_async_session] = get_async_session_override
+    client = TestClient(app)
     yield client
 
-    create_app.dependency_overrides.clear()
+    app.dependency_overrides.clear()
+
+@pytest.fixture(name="generate_dataset")
+def generate_dataset_fixture(session: Session):
+    """
+    Fill the testing database with a synthetic competition,
+    generate_dataset(users=..., solves=...), see testing/dataset.py
+
+    The rows go in behind the app's back, so the flag index and the
+    leaderboard are brought up to date afterwards.
+    """
+    def generate(**kwargs):
+        counts = dataset.generate(session, **kwargs)
+        flag_index.rebuild(session)
+        leaderboard.load(session)
+        return counts
+    return generate
 
 @pytest.fixture(name="")
 def account_creation_fixture(session: Session):
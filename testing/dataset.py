@@ -0,0 +1,257 @@
+"""
+Synthetic competition data for scale testing.
+
+Fills a database with players, challenges, solves and reviews shaped
+roughly like a real CTF: player activity follows a power law (a handful
+solve nearly everything, most solve one or two), the easy low point
+challenges collect most of the solves, and reviews come from players who
+solved the challenge. Scores match the solves, so the leaderboard and
+the user list behave as they would after a real event.
+
+Rows go in with executemany straight on the connection, and every player
+shares one bcrypt hash of DATASET_PASSWORD computed once, so a million
+solves load in seconds. Any generated player can log in with it.
+
+From a shell, into a new database file:
+
+    python -m testing.dataset scale.db --users 100000 --solves 1000000
+
+From tests, through the generate_dataset fixture in conftest.py, which
+also rebuilds the flag index and reloads the leaderboard afterwards:
+
+    def test_something(client, generate_dataset):
+        generate_dataset(users=50_000, solves=500_000)
+
+The same seed always gives the same data.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import accumulate
+from typing import Optional
+
+from sqlmodel import SQLModel, Session
+
+from src import database
+from src import migrations
+from src.users import models
+
+DATASET_PASSWORD = "dataset-password"
+# Power law exponent for player activity and challenge popularity
+DEFAULT_ALPHA = 1.2
+COMPETITION_START = datetime(2024, 1, 1)
+COMPETITION_LENGTH = timedelta(hours=48)
+
+CATEGORIES = ("Web", "Crypto", "Pwn", "Reversing", "Forensics", "Misc")
+COUNTRIES = (None, "GB", "US", "DE", "FR", "IN", "JP", "BR", "AU", "CA")
+COMMENTS = (None, None, "Great challenge", "Too guessy", "Learned a lot", "Nice one")
+
+
+@lru_cache(maxsize=None)
+def password_hash(password: str = DATASET_PASSWORD) -> str:
+    # bcrypt is slow on purpose, once per process is plenty
+    return models.hash_password(password)
+
+
+def _timestamps(start: datetime, length: timedelta, step: int = 1) -> list[str]:
+    # Formatted up front, strftime on a million solves is slow
+    minutes = [
+        (start + timedelta(minutes=minute)).strftime("%Y-%m-%d %H:%M")
+        for minute in range(int(length.total_seconds()) // 60)
+    ]
+    return [f"{minute}:{second:02d}.000000" for minute in minutes for second in range(0, 60, step)]
+
+
+def _solve_counts(rng: random.Random, users: int, challenges: int, solves: int, alpha: float) -> list[int]:
+    """
+    Solves per player, power law distributed and adding up to solves as
+    far as nobody goes over the number of challenges.
+    """
+    # Pareto shifted to start at 0, plenty of players solve nothing or one
+    weights = [rng.paretovariate(alpha) - 1 for _ in range(users)]
+    remaining, total_weight = solves, sum(weights)
+    counts = [0] * users
+    # The most active are capped first, their excess goes to everyone else
+    order = sorted(range(users), key=weights.__getitem__, reverse=True)
+    for position, i in enumerate(order):
+        if total_weight <= 0 or weights[i] * remaining / total_weight < challenges:
+            break
+        counts[i] = challenges
+        remaining -= challenges
+        total_weight -= weights[i]
+    else:
+        return counts
+    scale = remaining / total_weight if total_weight > 0 else 0
+    for i in order[position:]:
+        counts[i] = min(challenges, int(weights[i] * scale + rng.random()))
+    return counts
+
+
+def _pick_challenges(rng: random.Random, count: int, challenge_ids: range, cum_weights: list) -> list:
+    """
+    count distinct challenges, favouring the popular ones.
+    """
+    picked = dict.fromkeys(rng.choices(challenge_ids, cum_weights=cum_weights, k=count + count // 2))
+    if len(picked) < count:
+        # Heavy players run out of popular challenges, they get the next
+        # most popular ones they are missing
+        for challenge in challenge_ids:
+            picked.setdefault(challenge)
+            if len(picked) == count:
+                break
+    return list(picked)[:count]
+
+
+def generate(
+        session: Session,
+        users: int = 1_000,
+        challenges: int = 50,
+        solves: int = 10_000,
+        reviews: int = 1_000,
+        seed: int = 0,
+        alpha: float = DEFAULT_ALPHA,
+) -> dict:
+    """
+    Add a synthetic competition to the database behind session.
+
+    solves is a target, it comes out a little off from rounding and can
+    fall short when users * challenges is not much bigger. Returns the
+    number of rows added per table and the seconds it took.
+    """
+    started = time.perf_counter()
+    rng = random.Random(seed)
+    conn = session.connection()
+    stamps = _timestamps(COMPETITION_START, COMPETITION_LENGTH)
+    joined = _timestamps(COMPETITION_START - timedelta(days=30), timedelta(days=30), step=60)
+
+    # Challenges, ordered from most to least popular, harder ones are worth more
+    first_challenge = (conn.exec_driver_sql("SELECT MAX(id) FROM challenge").scalar() or 0) + 1
+    challenge_ids = range(first_challenge, first_challenge + challenges)
+    points = [50 + 50 * (9 * rank // max(1, challenges - 1)) for rank in range(challenges)]
+    if challenges:
+        conn.exec_driver_sql(
+            "INSERT INTO challenge (id, title, category, description, points, flag, created_at) "
+            "VALUES (?, ?, ?, '', ?, ?, ?)",
+            [
+                (challenge_id, f"Dataset {seed}-{rank}", CATEGORIES[rank % len(CATEGORIES)], points[rank],
+                 f"flag{{dataset-{seed}-{rank}}}", joined[0])
+                for rank, challenge_id in enumerate(challenge_ids)
+            ],
+        )
+    cum_weights = list(accumulate(1 / (rank + 1) ** alpha for rank in range(challenges)))
+    points_by_id = dict(zip(challenge_ids, points))
+
+    # Players, each solving a power law share of the target
+    user_rows = []
+    solve_rows = []
+    hashed = password_hash()
+    for i, solved in enumerate(_solve_counts(rng, users, challenges, solves, alpha) if challenges else [0] * users):
+        user_id = uuid.UUID(int=rng.getrandbits(128), version=4)
+        score = 0
+        # ChallengeSolve.user_id is stored as bare hex, User.id with dashes
+        for challenge_id in _pick_challenges(rng, solved, challenge_ids, cum_weights) if solved else ():
+            solve_rows.append((user_id.hex, challenge_id, stamps[int(rng.random() * len(stamps))]))
+            score += points_by_id[challenge_id]
+        user_rows.append((
+            str(user_id), f"player{seed}-{i}", f"player{seed}-{i}@example.org", hashed,
+            joined[int(rng.random() * len(joined))], score, rng.choice(COUNTRIES),
+        ))
+
+    # Filling indexes row by row is most of the insert time, building
+    # them once afterwards is several times quicker. Only into empty
+    # tables, on a database in use the unique indexes are what keeps
+    # the rows already there consistent
+    empty = not conn.exec_driver_sql(
+        "SELECT EXISTS (SELECT 1 FROM user) OR EXISTS (SELECT 1 FROM challengesolve) "
+        "OR EXISTS (SELECT 1 FROM challengereview)"
+    ).scalar()
+    indexes = conn.exec_driver_sql(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL "
+        "AND tbl_name IN ('user', 'challengesolve', 'challengereview')"
+    ).all() if empty else []
+    for name, _ in indexes:
+        conn.exec_driver_sql(f'DROP INDEX "{name}"')
+
+    conn.exec_driver_sql(
+        "INSERT INTO user (id, username, email, password, created_at, score, country, is_admin, is_active) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, 0, 1)",
+        user_rows,
+    )
+    if solve_rows:
+        conn.exec_driver_sql(
+            "INSERT INTO challengesolve (user_id, challenge_id, solved_at) VALUES (?, ?, ?)",
+            solve_rows,
+        )
+
+    # Reviews, from a sample of the solves
+    review_rows = [
+        (user_id, challenge_id, rng.choices((1, 2, 3, 4, 5), weights=(1, 1, 2, 4, 3))[0],
+         rng.choice(COMMENTS), solved_at)
+        for user_id, challenge_id, solved_at in rng.sample(solve_rows, min(reviews, len(solve_rows)))
+    ]
+    if review_rows:
+        conn.exec_driver_sql(
+            "INSERT INTO challengereview (user_id, challenge_id, rating, comment, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            review_rows,
+        )
+    for _, sql in indexes:
+        conn.exec_driver_sql(sql)
+    session.commit()
+
+    return {
+        "users": len(user_rows),
+        "challenges": challenges,
+        "solves": len(solve_rows),
+        "reviews": len(review_rows),
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+
+
+def create_database(path: str, replace: bool = False):
+    """
+    A new SQLite database file with the current schema.
+    """
+    if os.path.exists(path):
+        if not replace:
+            raise FileExistsError(f"{path} already exists, use --replace to overwrite it")
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.unlink(path + suffix)
+    engine = database.create_db_engine(f"sqlite:///{path}")
+    SQLModel.metadata.create_all(engine)
+    migrations.apply_migrations(engine)
+    return engine
+
+
+def main(argv: Optional[list] = None) -> int:
+    parser = argparse.ArgumentParser(description="Fill a SQLite database with a synthetic competition")
+    parser.add_argument("path", help="database file to create")
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--challenges", type=int, default=100)
+    parser.add_argument("--solves", type=int, default=100_000, help="target number of solves")
+    parser.add_argument("--reviews", type=int, default=5_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--alpha", type=float, default=DEFAULT_ALPHA, help="power law exponent")
+    parser.add_argument("--replace", action="store_true", help="overwrite an existing file")
+    args = parser.parse_args(argv)
+
+    try:
+        engine = create_database(args.path, args.replace)
+    except FileExistsError as exc:
+        print(exc, file=sys.stderr)
+        return 1
+    with Session(engine) as session:
+        summary = generate(session, args.users, args.challenges, args.solves, args.reviews, args.seed, args.alpha)
+    print(", ".join(f"{value} {name}" for name, value in summary.items()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,9 @@
+from contextlib import contextmanager
+
 import pytest
 from sqlmodel import SQLModel, Session, create_engine
-from webapp.users.models import user_models
+from src import query_stats
+from src.users import models
 from fastapi.testclient import TestClient
 from unittest.mock import patch
 
@@ -19,4 +22,21 @@ def create_db(session):
     with Session(engine) as session:
         yield session
 
-    return
\ No newline at end of file
+    return
+
+@contextmanager
+def query_budget(max_queries, route=None):
+    """
+    Fail if any request made in the block (or only those to route)
+    runs more than max_queries SQL statements.
+    """
+    with query_stats.capture() as captured:
+        yield captured
+    for request_route, stats in captured:
+        if route is not None and request_route != route:
+            continue
+        if stats.count > max_queries:
+            statements = "\n".join(f"  {count}x {sql}" for sql, count in stats.statements.items())
+            raise AssertionError(
+                f"{request_route} ran {stats.count} queries, the budget is {max_queries}:\n{statements}"
+            )